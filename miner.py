@@ -8,8 +8,11 @@ through a REST API by the wallet.
 __all__ = []
 
 import argparse
+import os
+from binascii import hexlify, unhexlify
+from threading import Event
 from urllib.parse import urlparse
-from typing import Tuple
+from typing import Optional, Tuple
 
 import logging
 
@@ -17,12 +20,15 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(me
 
 from src.config import *
 from src.crypto import Key
-from src.protocol import Protocol
+from src.addressbook import AddressBook
+from src.protocol import Protocol, MAX_PEERS
 from src.blockchain import GENESIS_BLOCK
 from src.chainbuilder import ChainBuilder
 from src.mining import Miner
-from src.persistence import Persistence
+from src.persistence import Persistence, PersistencePolicy, FSYNC_MODES, CHAIN_STATE_DEPTH, load_chain_state
 from src.rpc_server import rpc_server
+from src.sqlite_store import SqliteStore
+from src.snapshot import read_utxo_snapshot, write_utxo_snapshot, SnapshotValidator
 
 
 def parse_addr_port(val: str) -> Tuple[str, int]:
@@ -38,6 +44,41 @@ def parse_addr_port(val: str) -> Tuple[str, int]:
     return (url.hostname, url.port)
 
 
+def export_utxo_snapshot(chainbuilder: ChainBuilder, path: str, height: int,
+                         persist: Optional[Persistence] = None):
+    """
+    Waits until the primary block chain reaches `height`, then writes a snapshot of the unspent
+    coins at that height to `path` and prints the hash of the snapshot.
+
+    A chain loaded from a chain state or a snapshot has no undo data for the blocks below it, so the
+    coins at such a height are rebuilt from the block log of `persist` instead.
+    """
+    reached = Event()
+
+    def chain_changed():
+        if chainbuilder.primary_block_chain.head.height >= height:
+            reached.set()
+
+    chainbuilder.chain_change_handlers.append(chain_changed)
+    chain_changed()
+    reached.wait()
+
+    chain = chainbuilder.primary_block_chain
+    if chain.can_rewind(height):
+        chain = chain.rewind(height)
+    elif persist is not None and chain.blocks[height].hash in persist.block_log.hashes[height:height + 1]:
+        logging.info("rebuilding the unspent coins at height %d from the block log", height)
+        chain = persist.rebuild_chain(height)
+    else:
+        chain = None
+    if chain is None:
+        raise ValueError("the unspent coins at height {} cannot be computed, as the chain was loaded "
+                         "from a chain state or snapshot above it, or pruned; restart with "
+                         "--full-revalidation and without --prune to export it".format(height))
+    snapshot_hash = write_utxo_snapshot(chain, path)
+    print(hexlify(snapshot_hash).decode())
+
+
 def main():
     """
     Takes arguments:
@@ -45,8 +86,21 @@ def main():
     `listen-port`: The port where the P2P server should listen. Defaults a dynamically assigned port. Default is: `0`
     `mining-pubkey`: The public key where mining rewards should be sent to. No mining is performed if this is left unspecified.
     `bootstrap-peer`: Addresses of other P2P peers in the network. Default is: `[]`
+    `max-peers`: The maximum number of peers to connect to. Default is: `10`
+    `address-book`: The file where the addresses of known peers are stored.
     `rpc-port`: The port number where the wallet can find an RPC server. Default is: `40203`
-    `persist-path`: The file where data is persisted.
+    `persist-path`: The file where the block chain is persisted. Further files are created next to it.
+    `persist-interval`: The number of seconds a change of the block chain may wait before it is persisted. Default is: `5`
+    `persist-mempool-interval`: The number of seconds a change of the unconfirmed transactions may wait before it is persisted. Default is: `5`
+    `persist-max-blocks`: The number of new blocks after which the block chain is persisted without waiting. Default is: `10`
+    `persist-fsync`: When persisted data is synced to disk: `none`, `batch` or `always`. Default is: `batch`
+    `sqlite-path`: An SQLite database where blocks, transactions and coins are indexed for the RPC server.
+    `full-revalidation`: Validate all blocks in `persist-path` again instead of trusting the stored chain state.
+    `prune`: Only keep the transactions of this many recent blocks, in memory and in `persist-path`.
+    `utxo-snapshot`: A snapshot of the unspent coins to start from. Requires `utxo-snapshot-hash`.
+    `utxo-snapshot-hash`: The trusted hash of the snapshot in `utxo-snapshot`.
+    `export-utxo-snapshot`: Write a snapshot of the unspent coins to this file and exit.
+    `export-height`: The height of the block chain at which the snapshot should be exported.
     """
     parser = argparse.ArgumentParser(description="Blockchain Miner.")
     parser.add_argument("--listen-address", default="",
@@ -57,25 +111,77 @@ def main():
                         help="The public key where mining rewards should be sent to. No mining is performed if this is left unspecified.")
     parser.add_argument("--bootstrap-peer", action='append', type=parse_addr_port, default=[],
                         help="Addresses of other P2P peers in the network.")
+    parser.add_argument("--max-peers", type=int, default=MAX_PEERS,
+                        help="The maximum number of peers to connect to.")
+    parser.add_argument("--address-book",
+                        help="The file where the addresses of known peers are stored.")
     parser.add_argument("--rpc-port", type=int, default=40203,
                         help="The port number where the wallet can find an RPC server.")
     parser.add_argument("--persist-path",
-                        help="The file where data is persisted.")
+                        help="The file where the block chain is persisted. Further files are created next to it.")
+    parser.add_argument("--persist-interval", type=float, default=PersistencePolicy().chain_interval,
+                        help="The number of seconds a change of the block chain may wait before it is persisted.")
+    parser.add_argument("--persist-mempool-interval", type=float, default=PersistencePolicy().mempool_interval,
+                        help="The number of seconds a change of the unconfirmed transactions may wait before it is persisted.")
+    parser.add_argument("--persist-max-blocks", type=int, default=PersistencePolicy().max_blocks_at_risk,
+                        help="The number of new blocks after which the block chain is persisted without waiting.")
+    parser.add_argument("--persist-fsync", choices=FSYNC_MODES, default=PersistencePolicy().fsync,
+                        help="When persisted data is synced to disk: never, once per write or after every block.")
+    parser.add_argument("--sqlite-path",
+                        help="An SQLite database where blocks, transactions and coins are indexed for the RPC server.")
+    parser.add_argument("--full-revalidation", action='store_true',
+                        help="Validate all blocks in --persist-path again instead of trusting the stored chain state.")
+    parser.add_argument("--prune", type=int,
+                        help="Only keep the transactions of this many recent blocks, in memory and in --persist-path.")
+    parser.add_argument("--utxo-snapshot",
+                        help="A snapshot of the unspent coins to start from. The block chain history is validated in the background.")
+    parser.add_argument("--utxo-snapshot-hash", type=unhexlify,
+                        help="The trusted hash of the snapshot in --utxo-snapshot.")
+    parser.add_argument("--export-utxo-snapshot",
+                        help="Write a snapshot of the unspent coins to this file and exit.")
+    parser.add_argument("--export-height", type=int,
+                        help="The height of the block chain at which the snapshot should be exported.")
 
     args = parser.parse_args()
-
-    proto = Protocol(args.bootstrap_peer, GENESIS_BLOCK, args.listen_port, args.listen_address)
+    if args.utxo_snapshot is not None and args.utxo_snapshot_hash is None:
+        parser.error("--utxo-snapshot requires --utxo-snapshot-hash")
+    if args.export_utxo_snapshot is not None and args.export_height is None:
+        parser.error("--export-utxo-snapshot requires --export-height")
+    if args.prune is not None and args.prune < CHAIN_STATE_DEPTH:
+        parser.error("--prune must be at least {}".format(CHAIN_STATE_DEPTH))
+    if args.prune is not None and args.full_revalidation:
+        parser.error("--full-revalidation cannot be used with --prune")
+
+    base_chain = None
+    if args.utxo_snapshot is not None:
+        base_chain = read_utxo_snapshot(args.utxo_snapshot, args.utxo_snapshot_hash)
+    elif args.persist_path and not args.full_revalidation:
+        base_chain = load_chain_state(args.persist_path)
+
+    address_book = AddressBook(args.address_book)
+    if args.address_book is not None:
+        address_book.load()
+
+    proto = Protocol(args.bootstrap_peer, GENESIS_BLOCK, args.listen_port, args.listen_address,
+                     args.max_peers, address_book)
     if args.mining_pubkey is not None:
         pubkey = Key(args.mining_pubkey.read())
         args.mining_pubkey.close()
-        miner = Miner(proto, pubkey)
+        miner = Miner(proto, pubkey, base_chain, args.prune)
         miner.start_mining()
         chainbuilder = miner.chainbuilder
     else:
-        chainbuilder = ChainBuilder(proto)
+        chainbuilder = ChainBuilder(proto, base_chain, args.prune)
+
+    if args.utxo_snapshot is not None:
+        validator = SnapshotValidator(proto, base_chain)
+        validator.failure_handlers.append(_snapshot_validation_failed)
+        validator.start()
 
     if args.persist_path:
-        persist = Persistence(args.persist_path, chainbuilder)
+        policy = PersistencePolicy(args.persist_interval, args.persist_mempool_interval,
+                                   args.persist_max_blocks, args.persist_fsync)
+        persist = Persistence(args.persist_path, chainbuilder, policy)
         try:
             persist.load()
         except FileNotFoundError:
@@ -83,7 +189,23 @@ def main():
     else:
         persist = None
 
-    rpc_server(args.rpc_port, chainbuilder, persist)
+    if args.export_utxo_snapshot is not None:
+        export_utxo_snapshot(chainbuilder, args.export_utxo_snapshot, args.export_height, persist)
+        return
+
+    sqlite_store = None
+    if args.sqlite_path:
+        sqlite_store = SqliteStore(args.sqlite_path, chainbuilder,
+                                   None if persist is None else persist.block_by_hash)
+
+    rpc_server(args.rpc_port, chainbuilder, persist, sqlite_store)
+
+
+def _snapshot_validation_failed():
+    """ Stops the node, as the balances and the block chain it serves cannot be trusted. """
+    logging.critical("the UTXO snapshot is invalid; stopping. Restart without --utxo-snapshot "
+                     "and with --full-revalidation to rebuild the chain from its history.")
+    os._exit(1)
 
 
 def start_listener(rpc_port: int, bootstrap_peer: str, listen_port: int, listen_address: str):
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Runs a network of nodes on emulated network links in a single process, and reports how fast blocks
+and transactions propagate. Useful to measure the effect of changes to the P2P protocol.
+"""
+
+__all__ = []
+
+import argparse
+import json
+
+import logging
+
+logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)-8s %(message)s")
+
+from src.simulation import Simulation, LinkConfig
+
+
+def format_report(report: dict) -> str:
+    """ Formats the result of `Simulation.report` for humans. """
+
+    def ms(val):
+        return "-" if val is None else "{:.0f}ms".format(val * 1000)
+
+    def pct(val):
+        return "-" if val is None else "{:.1%}".format(val)
+
+    link = report['link']
+    lines = ["{} nodes, {} links ({} latency, {:.0f} KiB/s, {} loss), final height {}".format(
+        report['nodes'], report['links'], ms(link['latency']), link['bandwidth'] / 1024,
+        pct(link['loss']), report['height'])]
+    for name in ('blocks', 'transactions'):
+        stats = report[name]
+        lines.append("{:13} created {:6}  reached all nodes {:6}  coverage {:>6}  delay {}".format(
+            name, stats['created'], stats['reached_all'], pct(stats['coverage']),
+            " ".join("{} {}".format(p, ms(v)) for (p, v) in stats['delay'].items())))
+    lines.append("stale blocks {}, blocks received before their parent {}".format(
+        pct(report['stale_rate']), pct(report['orphan_arrivals'])))
+    lines.append("traffic: {} messages, {:.1f} KiB".format(report['traffic']['messages'],
+                                                          report['traffic']['bytes'] / 1024))
+    return "\n".join(lines)
+
+
+def main():
+    """
+    Takes arguments:
+    `nodes`: The number of nodes in the simulated network. Default is: `20`
+    `degree`: The number of other nodes each node connects to. Default is: `4`
+    `latency`: The one-way latency of the links in milliseconds. Default is: `50`
+    `bandwidth`: The bandwidth of the links in KiB per second and direction. Default is: `1024`
+    `loss`: The probability that a TCP segment is lost. Default is: `0`
+    `duration`: The number of seconds during which blocks and transactions are created. Default is: `30`
+    `block-interval`: The average number of seconds between two mined blocks. Default is: `2`
+    `tx-rate`: The average number of transactions created per second. Default is: `10`
+    `settle-time`: The number of seconds to wait for propagation at the end. Default is: `5`
+    `seed`: The seed for all random choices of the simulation. Default is: `0`
+    `json`: Print the report as JSON.
+    """
+    parser = argparse.ArgumentParser(description="Blockchain network simulator.")
+    parser.add_argument("--nodes", type=int, default=20,
+                        help="The number of nodes in the simulated network.")
+    parser.add_argument("--degree", type=int, default=4,
+                        help="The number of other nodes each node connects to.")
+    parser.add_argument("--latency", type=float, default=50,
+                        help="The one-way latency of the links in milliseconds.")
+    parser.add_argument("--bandwidth", type=float, default=1024,
+                        help="The bandwidth of the links in KiB per second and direction.")
+    parser.add_argument("--loss", type=float, default=0,
+                        help="The probability that a TCP segment is lost.")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="The number of seconds during which blocks and transactions are created.")
+    parser.add_argument("--block-interval", type=float, default=2,
+                        help="The average number of seconds between two mined blocks.")
+    parser.add_argument("--tx-rate", type=float, default=10,
+                        help="The average number of transactions created per second.")
+    parser.add_argument("--settle-time", type=float, default=5,
+                        help="The number of seconds to wait for propagation at the end.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="The seed for all random choices of the simulation.")
+    parser.add_argument("--json", action='store_true',
+                        help="Print the report as JSON.")
+
+    args = parser.parse_args()
+    link = LinkConfig(args.latency / 1000, args.bandwidth * 1024, args.loss)
+    simulation = Simulation(args.nodes, args.degree, link, args.seed)
+    report = simulation.run(args.duration, args.block_interval, args.tx_rate, args.settle_time)
+    simulation.shutdown()
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+An address book of the peers we know of, whether we are connected to them or not.
+
+For every address, the `AddressBook` records when we last saw the peer, how many of our attempts
+to connect to it succeeded, and the round-trip time and throughput we measured while we were
+connected. These are combined into a score (see `PeerAddress.score`), which the `Protocol` uses to
+pick the peers it connects to. The address book can be stored in a JSON file, so that a restarted
+node can reconnect to good peers right away.
+"""
+
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from threading import Lock
+from typing import List, Optional
+
+__all__ = ['AddressBook', 'PeerAddress']
+
+MAX_ADDRESSES = 1000
+""" The maximum number of addresses in the address book. The worst ones are forgotten first. """
+
+RETRY_INTERVAL = 30
+"""
+The number of seconds after a failed connection attempt before we try to connect to the same
+address again. The interval doubles with every further failure in a row.
+"""
+
+MAX_RETRY_INTERVAL = 3600
+""" The maximum number of seconds between two connection attempts to the same address. """
+
+
+class PeerAddress:
+    """
+    What we know about one peer address.
+
+    :ivar addr: The address where the peer accepts connections.
+    :vartype addr: tuple
+    :ivar last_seen: The time (seconds since the epoch) when we last heard of or from this peer.
+    :vartype last_seen: float
+    :ivar last_attempt: The time of our last attempt to connect to this peer.
+    :vartype last_attempt: float
+    :ivar attempts: The number of our attempts to connect to this peer.
+    :vartype attempts: int
+    :ivar successes: The number of successful attempts to connect to this peer.
+    :vartype successes: int
+    :ivar failures_in_a_row: The number of failed attempts since the last successful one.
+    :vartype failures_in_a_row: int
+    :ivar rtt: The last round-trip time to this peer in seconds, if we measured one.
+    :vartype rtt: Optional[float]
+    :ivar throughput: The number of bytes per second we received from this peer during our last
+                      connection, if any.
+    :vartype throughput: Optional[float]
+    """
+
+    def __init__(self, addr: tuple):
+        self.addr = addr
+        self.last_seen = time.time()
+        self.last_attempt = 0.0
+        self.attempts = 0
+        self.successes = 0
+        self.failures_in_a_row = 0
+        self.rtt = None
+        self.throughput = None
+
+    def score(self) -> float:
+        """
+        A measure of the quality of this peer; higher is better. It is the estimated probability of
+        a successful connection, weighted down by the round-trip time and up by the throughput.
+        """
+        success_rate = (self.successes + 1) / (self.attempts + 2)
+        latency_factor = 0.5 if self.rtt is None else 1 / (1 + self.rtt / 0.1)
+        throughput_factor = 1 + math.log10(1 + (self.throughput or 0) / 1000)
+        return success_rate * latency_factor * throughput_factor
+
+    def can_retry(self, now: float) -> bool:
+        """ Whether enough time has passed since the last failed connection attempt. """
+        if not self.failures_in_a_row:
+            return True
+        interval = min(RETRY_INTERVAL * 2 ** (self.failures_in_a_row - 1), MAX_RETRY_INTERVAL)
+        return self.last_attempt + interval <= now
+
+    def to_json_compatible(self):
+        """ Returns a JSON-serializable representation of this object. """
+        val = dict(self.__dict__)
+        val['addr'] = list(self.addr)
+        return val
+
+    @classmethod
+    def from_json_compatible(cls, val: dict):
+        """ Creates a new object of this class, from a JSON-serializable representation. """
+        peer = cls(tuple(val['addr']))
+        for key in ('last_seen', 'last_attempt', 'attempts', 'successes', 'failures_in_a_row', 'rtt',
+                    'throughput'):
+            setattr(peer, key, val[key])
+        return peer
+
+
+class AddressBook:
+    """
+    The addresses of the peers we know of. All methods are thread-safe.
+
+    :ivar path: The file where the address book is stored, if any.
+    :vartype path: Optional[str]
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._addresses = {}
+        self._lock = Lock()
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def __contains__(self, addr: tuple):
+        return tuple(addr) in self._addresses
+
+    def get(self, addr: tuple) -> 'Optional[PeerAddress]':
+        return self._addresses.get(tuple(addr))
+
+    def _record(self, addr: tuple) -> PeerAddress:
+        addr = tuple(addr)
+        peer = self._addresses.get(addr)
+        if peer is None:
+            if len(self._addresses) >= MAX_ADDRESSES:
+                worst = min(self._addresses.values(), key=PeerAddress.score)
+                del self._addresses[worst.addr]
+            peer = self._addresses[addr] = PeerAddress(addr)
+        self._dirty = True
+        return peer
+
+    def add(self, addr: tuple):
+        """ Records that we heard of a peer at `addr`. """
+        with self._lock:
+            self._record(addr).last_seen = time.time()
+
+    def remove(self, addr: tuple):
+        """ Forgets the address `addr`, e.g. because it is our own. """
+        with self._lock:
+            if self._addresses.pop(tuple(addr), None) is not None:
+                self._dirty = True
+
+    def connection_attempted(self, addr: tuple):
+        """ Records that we are trying to connect to `addr`. """
+        with self._lock:
+            peer = self._record(addr)
+            peer.attempts += 1
+            peer.last_attempt = time.time()
+
+    def connection_succeeded(self, addr: tuple):
+        """ Records that the handshake with the peer at `addr` was completed. """
+        with self._lock:
+            peer = self._record(addr)
+            peer.successes += 1
+            peer.failures_in_a_row = 0
+            peer.last_seen = time.time()
+
+    def connection_failed(self, addr: tuple):
+        """ Records that we could not connect to `addr`. """
+        with self._lock:
+            self._record(addr).failures_in_a_row += 1
+
+    def disconnected(self, addr: tuple, rtt: Optional[float], throughput: Optional[float]):
+        """ Records the quality of a connection that just ended. """
+        with self._lock:
+            peer = self._record(addr)
+            peer.last_seen = time.time()
+            if rtt is not None:
+                peer.rtt = rtt
+            if throughput is not None:
+                peer.throughput = throughput
+
+    def best(self, count: int, exclude: set) -> 'List[tuple]':
+        """
+        Returns up to `count` addresses to connect to, best first. Addresses in `exclude` and
+        addresses that recently failed are skipped.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [p for p in self._addresses.values()
+                          if p.addr not in exclude and p.can_retry(now)]
+        candidates.sort(key=PeerAddress.score, reverse=True)
+        return [p.addr for p in candidates[:count]]
+
+    def load(self):
+        """ Loads the address book from `path`, if it exists. """
+        try:
+            with open(self.path) as f:
+                obj = json.load(f)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            for val in obj:
+                peer = PeerAddress.from_json_compatible(val)
+                self._addresses[peer.addr] = peer
+        logging.info("loaded %d peer addresses", len(obj))
+
+    def save(self):
+        """ Stores the address book in `path`, if it changed. """
+        if self.path is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            obj = [p.to_json_compatible() for p in self._addresses.values()]
+            self._dirty = False
+
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path) or ".", delete=False) as f:
+            try:
+                json.dump(obj, f, indent=4)
+                f.close()
+                os.rename(f.name, self.path)
+            except Exception as e:
+                os.unlink(f.name)
+                raise e
@@ -39,8 +39,12 @@ class Block:
     :vartype received_time: datetime
     :ivar target: The target of this block.
     :vartype target: int
-    :ivar transactions: The list of transactions in this block.
+    :ivar transactions: The list of transactions in this block. To change them, assign a new list;
+                        the list must not be modified in place once the block was verified.
     :vartype transactions: List[Transaction]
+    :ivar is_header_only: Whether the transactions of this block are not known, e.g. because it was
+                          loaded from a snapshot. The `transactions` list is empty in that case.
+    :vartype is_header_only: bool
     """
 
     # TODO: Check if  "id" is really needed. Should be the same as "height".
@@ -56,12 +60,22 @@ class Block:
         self.received_time = received_time
         self.target = target
         self.transactions = transactions
+        self.is_header_only = False
         self._hash = self._get_hash()
 
     @property
     def hash(self):
         return self._hash
 
+    @property
+    def transactions(self):
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, value):
+        self._transactions = value
+        self._merkle_valid = None
+
     @hash.setter
     def hash(self, value):
         self._hash = value
@@ -109,6 +123,13 @@ class Block:
         return Block(prev_block.hash, ts, 0, prev_block.height + 1,
                      None, difficulty, transactions, tree.get_hash(), id)
 
+    def header_only(self) -> 'Block':
+        """ Returns a copy of this block without its transactions. """
+        block = Block(self.prev_block_hash, self.time, self.nonce, self.height, self.received_time,
+                      self.target, [], self.merkle_root_hash, self.id)
+        block.is_header_only = True
+        return block
+
     def __str__(self):
         return json.dumps(self.to_json_compatible(), indent=4)
 
@@ -140,8 +161,14 @@ class Block:
         return self.finish_hash(hasher)
 
     def verify_merkle(self):
-        """ Verify that the merkle root hash is correct for the transactions in this block. """
-        return merkle_tree(self.transactions).get_hash() == self.merkle_root_hash
+        """
+        Verify that the merkle root hash is correct for the transactions in this block. The result
+        is remembered until the transactions are changed, so that blocks that were checked before
+        they were handed to the main thread are not checked again.
+        """
+        if self._merkle_valid is None:
+            self._merkle_valid = merkle_tree(self.transactions).get_hash() == self.merkle_root_hash
+        return self._merkle_valid
 
     def verify_proof_of_work(self):
         """ Verify the proof of work on a block. """
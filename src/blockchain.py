@@ -1,6 +1,6 @@
 """ Definition of block chains. """
 
-__all__ = ['Blockchain', 'GENESIS_BLOCK']
+__all__ = ['Blockchain', 'BlockUndo', 'GENESIS_BLOCK']
 import logging
 
 from binascii import hexlify
@@ -25,6 +25,17 @@ GENESIS_BLOCK = Block("None; {} {}".format(DIFFICULTY_BLOCK_INTERVAL, DIFFICULTY
 GENESIS_BLOCK_HASH = GENESIS_BLOCK.hash
 
 
+class BlockUndo(namedtuple("BlockUndo", ["spent", "created"])):
+    """
+    The changes a block made to the unspent coins, so that they can be reverted.
+
+    :ivar spent: The coins spent by the block, with the transaction outputs that created them.
+    :vartype spent: List[Tuple[Tuple[bytes, int], TransactionTarget]]
+    :ivar created: The coins created by the block.
+    :vartype created: List[Tuple[bytes, int]]
+    """
+
+
 class Blockchain:
     """
     A block chain: a ordered, immutable list of valid blocks. The only way to create a blockchain
@@ -40,6 +51,9 @@ class Blockchain:
     :ivar unspent_coins: A dictionary mapping from (allowed/available) transaction inputs
                          to the transaction output that created this coin.
     :vartype unspent_coins: Dict[TransactionInput, TransactionTarget]
+    :ivar undo_data: For each block in `blocks`, the changes it made to `unspent_coins`, or `None`
+                     if these are not known (as for the genesis block).
+    :vartype undo_data: List[Optional[BlockUndo]]
     """
 
     def __init__(self):
@@ -47,6 +61,7 @@ class Blockchain:
         assert self.blocks[0].height == 0
         self.block_indices = {GENESIS_BLOCK_HASH: 0}
         self.unspent_coins = {}
+        self.undo_data = [None]
         self.total_difficulty = 0
 
     def try_append(self, block: 'Block') -> 'Optional[Blockchain]':
@@ -60,26 +75,99 @@ class Blockchain:
             return None
 
         unspent_coins = self.unspent_coins.copy()
+        undo = self.apply_block(unspent_coins, block)
+
+        chain = Blockchain()
+        chain.unspent_coins = unspent_coins
+        chain.blocks = self.blocks + [block]
+        chain.undo_data = self.undo_data + [undo]
+        chain.block_indices = self.block_indices.copy()
+        chain.block_indices[block.hash] = len(self.blocks)
+        chain.total_difficulty = self.total_difficulty + GENESIS_TARGET - block.target
 
+        return chain
+
+    @staticmethod
+    def apply_block(unspent_coins: dict, block: 'Block') -> 'BlockUndo':
+        """
+        Updates `unspent_coins` in place with the coins spent and created by the (already verified)
+        `block`, and returns the undo data to revert these changes.
+        """
+        undo = BlockUndo([], [])
         for t in block.transactions:
             for inp in t.inputs:
                 if inp.is_coinbase:
                     continue
 
                 # the checks for tx using the same inputs are already done in the block.verify method
-                unspent_coins.pop((inp.transaction_hash, inp.output_idx), None)
+                coin = (inp.transaction_hash, inp.output_idx)
+                target = unspent_coins.pop(coin, None)
+                if target is not None:
+                    undo.spent.append((coin, target))
 
             for i, target in enumerate(t.targets):
                 if target.is_pay_to_pubkey or target.is_pay_to_pubkey_lock:
                     unspent_coins[(t.get_hash(), i)] = target
+                    undo.created.append((t.get_hash(), i))
+        return undo
+
+    def can_rewind(self, height: int) -> bool:
+        """ Returns a bool indicating whether `rewind` can compute the chain ending at `height`. """
+        if not 0 <= height <= self.head.height:
+            return False
+        return all(undo is not None for undo in self.undo_data[height + 1:])
+
+    def rewind(self, height: int) -> 'Optional[Blockchain]':
+        """
+        Returns the prefix of this block chain that ends with the block at `height`, by reverting the
+        changes of all later blocks using their undo data. Returns `None` if that is not possible.
+        """
+        if height == self.head.height:
+            return self
+        if not self.can_rewind(height):
+            return None
+
+        unspent_coins = self.unspent_coins.copy()
+        for undo in reversed(self.undo_data[height + 1:]):
+            for coin in undo.created:
+                unspent_coins.pop(coin, None)
+            unspent_coins.update(undo.spent)
 
         chain = Blockchain()
         chain.unspent_coins = unspent_coins
-        chain.blocks = self.blocks + [block]
-        chain.block_indices = self.block_indices.copy()
-        chain.block_indices[block.hash] = len(self.blocks)
-        chain.total_difficulty = self.total_difficulty + GENESIS_TARGET - block.target
+        chain.blocks = self.blocks[:height + 1]
+        chain.undo_data = self.undo_data[:height + 1]
+        chain.block_indices = {b.hash: i for (i, b) in enumerate(chain.blocks)}
+        chain.total_difficulty = self.total_difficulty - sum(GENESIS_TARGET - b.target
+                                                             for b in self.blocks[height + 1:])
+        return chain
 
+    def prune(self, height: int, keep_undo_data: bool = False) -> 'Blockchain':
+        """
+        Returns this block chain with only the headers of the blocks up to `height` and without
+        their undo data, so that their transactions can be freed. The returned chain cannot be
+        rewound below `height`, unless `keep_undo_data` is set.
+        """
+        blocks = None
+        for h in range(min(height, self.head.height), 0, -1):
+            if self.blocks[h].is_header_only and (keep_undo_data or self.undo_data[h] is None):
+                # the blocks before were pruned as well
+                break
+            if blocks is None:
+                blocks = list(self.blocks)
+                undo_data = list(self.undo_data)
+            blocks[h] = blocks[h].header_only()
+            if not keep_undo_data:
+                undo_data[h] = None
+        if blocks is None:
+            return self
+
+        chain = Blockchain()
+        chain.unspent_coins = self.unspent_coins
+        chain.blocks = blocks
+        chain.undo_data = undo_data
+        chain.block_indices = self.block_indices
+        chain.total_difficulty = self.total_difficulty
         return chain
 
     def get_block_by_hash(self, hash_val: bytes) -> 'Optional[Block]':
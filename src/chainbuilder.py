@@ -3,11 +3,13 @@ The chain builder maintains the current longest confirmed (primary) block chain
 only partially downloaded longer chains that might become the new primary block chain once
 completed and verified. Also maintains a list of (unconfirmed) transactions that are valid
 but not yet part of the primary block chain, or valid once another unconfirmed transaction
-becomes valid.
+becomes valid. Transactions that spend outputs of transactions we have not received yet are kept
+in a bounded orphan pool until their parents arrive.
 
 Received blocks that cannot be shown to be invalid on *any* block chain are stored in a block
-cache (from which for the moment they are never evicted), so that they do not need to be requested
-from other peers over and over again.
+cache, so that they do not need to be requested from other peers over and over again. Blocks of
+the primary block chain are evicted from the cache when pruning or when they are released (see
+`release_blocks`).
 
 
 For the process of building new primary block chains, block requests are used. These are maintained
@@ -21,15 +23,26 @@ block cache. In that case they are immediately fulfilled until the block chains
 block is missing in the cache, which then will be requested from the peers.
 
 Partial chains are completed once their next block is the head of a so called `checkpoint`. These
-checkpoints are snapshots of the primary block chain at various points in its history. For a chain
+checkpoints are blocks of the primary block chain at various points in its history. For a chain
 of length `N`, the number of checkpoints is always kept between `2*log_2(N)` and `log_2(N)`, with
 most checkpoints being relatively recent. There also is always one checkpoint with only the genesis
-block.
+block. Checkpoints only store the height and hash of their block; the block chain ending there is
+computed on demand by rewinding the primary block chain with the undo data of the later blocks.
+
+A chain builder with a `prune_depth` only keeps the transactions and undo data of that many blocks
+below the head of the primary block chain; older blocks are reduced to their headers, and dropped
+from the block cache. Reorganizations deeper than `prune_depth` are then no longer possible.
+
+Without pruning, the transactions of old blocks can still be released from memory once the blocks
+are stored on disk, e.g. by the `Persistence`: they are reduced to their headers as well, but keep
+their undo data, and are read back with `block_source` when needed to build a block chain.
 """
 import threading
 import logging
 import math
-from typing import List, Optional
+from binascii import hexlify
+from collections import OrderedDict
+from typing import List, Optional, Set
 from datetime import datetime
 
 from .config import *
@@ -86,6 +99,77 @@ class BlockRequest:
                 self.send_request(protocol)
 
 
+class OrphanPool:
+    """
+    Stores transactions that spend outputs of transactions we do not know yet, until these parent
+    transactions arrive. The orphans are indexed by the hashes of their missing parents, so that
+    the children of a newly accepted transaction can be found without scanning the whole pool.
+
+    The pool holds at most `MAX_ORPHAN_TRANSACTIONS` orphans (evicting the oldest first), and
+    orphans are dropped once they waited longer than `ORPHAN_TRANSACTION_TIMEOUT`.
+
+    :ivar _orphans: The orphan transactions and the time they were added, oldest first.
+    :vartype _orphans: OrderedDict[bytes, Tuple[Transaction, datetime]]
+    :ivar _by_parent: A dict from the hashes of missing parent transactions to the hashes of the
+                      orphans waiting for them.
+    :vartype _by_parent: Dict[bytes, Set[bytes]]
+    """
+
+    def __init__(self):
+        self._orphans = OrderedDict()
+        self._by_parent = {}
+
+    def __len__(self):
+        return len(self._orphans)
+
+    def __contains__(self, hash_val: bytes):
+        return hash_val in self._orphans
+
+    def add(self, transaction: 'Transaction', missing_parents: 'Set[bytes]'):
+        """ Adds `transaction`, which waits for the transactions with the hashes `missing_parents`. """
+        hash_val = transaction.get_hash()
+        if hash_val in self._orphans:
+            return
+
+        self.expire()
+        while len(self._orphans) >= MAX_ORPHAN_TRANSACTIONS:
+            self.remove(next(iter(self._orphans)))
+
+        self._orphans[hash_val] = (transaction, datetime.utcnow())
+        for parent in missing_parents:
+            self._by_parent.setdefault(parent, set()).add(hash_val)
+
+    def remove(self, hash_val: bytes):
+        """ Removes the orphan with the hash `hash_val` from the pool, if it is present. """
+        entry = self._orphans.pop(hash_val, None)
+        if entry is None:
+            return
+        for inp in entry[0].inputs:
+            children = self._by_parent.get(inp.transaction_hash)
+            if children is not None:
+                children.discard(hash_val)
+                if not children:
+                    del self._by_parent[inp.transaction_hash]
+
+    def pop_children(self, parent_hash: bytes) -> 'List[Transaction]':
+        """ Removes and returns all orphans that spend an output of the transaction `parent_hash`. """
+        children = []
+        for hash_val in list(self._by_parent.get(parent_hash, ())):
+            children.append(self._orphans[hash_val][0])
+            self.remove(hash_val)
+        return children
+
+    def expire(self):
+        """ Drops all orphans that waited longer than `ORPHAN_TRANSACTION_TIMEOUT`. """
+        oldest_allowed = datetime.utcnow() - ORPHAN_TRANSACTION_TIMEOUT
+        while self._orphans:
+            hash_val, (_, added) = next(iter(self._orphans.items()))
+            if added >= oldest_allowed:
+                break
+            logging.debug("dropping orphan transaction %s", hexlify(hash_val))
+            self.remove(hash_val)
+
+
 class ChainBuilder:
     """
     The chain builder maintains the current longest confirmed (primary) block chain as well as
@@ -98,10 +182,14 @@ class ChainBuilder:
     :vartype primary_block_chain: Blockchain
     :ivar _block_requests: A dict from block hashes to lists of partial chains waiting for that block.
     :vartype _block_requests: Dict[bytes, BlockRequest]
+    :ivar _blockchain_checkpoints: A dict from the hashes of the checkpoint blocks to their heights.
+    :vartype _blockchain_checkpoints: Dict[bytes, int]
     :ivar block_cache: A cache of received blocks, not bound to any one specific block chain.
     :vartype block_cache: Dict[bytes, Block]
     :ivar unconfirmed_transactions: Known transactions that are not part of the primary block chain.
     :vartype unconfirmed_transactions: Dict[bytes, Transaction]
+    :ivar orphan_transactions: Received transactions that spend outputs of unknown transactions.
+    :vartype orphan_transactions: OrphanPool
     :ivar chain_change_handlers: Event handlers that get called when we find out about a new primary
                                  block chain.unconfirmed_transactions
     :vartype chain_change_handlers: List[Callable]
@@ -110,28 +198,51 @@ class ChainBuilder:
     :vartype transaction_change_handlers: List[Callable]
     :ivar protocol: The protocol instance used by this chain builder.
     :vartype protocol: Protocol
+    :ivar prune_depth: The number of recent blocks whose transactions are kept, or `None` to keep
+                       all of them.
+    :vartype prune_depth: Optional[int]
+    :ivar block_source: A function that returns a block of the primary block chain with its
+                        transactions, or `None`, for blocks that were released from memory.
+    :vartype block_source: Optional[Callable[[bytes], Optional[Block]]]
     """
 
-    def __init__(self, protocol: 'Protocol'):
-        self.primary_block_chain = Blockchain()
+    def __init__(self, protocol: 'Protocol', base_chain: 'Optional[Blockchain]' = None,
+                 prune_depth: 'Optional[int]' = None):
+        """
+        :param protocol: The protocol instance used by this chain builder.
+        :param base_chain: The initial primary block chain, e.g. loaded from a snapshot. Defaults to
+                           a chain containing only the genesis block.
+        :param prune_depth: The number of recent blocks whose transactions are kept. Defaults to all.
+        """
         self._block_requests = {}
-        self._blockchain_checkpoints = {GENESIS_BLOCK_HASH: self.primary_block_chain}
+        self.prune_depth = prune_depth
+        self.block_source = None
 
         self.block_cache = {GENESIS_BLOCK_HASH: GENESIS_BLOCK}
         self.unconfirmed_transactions = {}
+        self.orphan_transactions = OrphanPool()
+
+        if base_chain is None:
+            self.primary_block_chain = Blockchain()
+            self._blockchain_checkpoints = {GENESIS_BLOCK_HASH: 0}
 
-        # Adding the tx from Genesis block to unspent coins
-        for tx in GENESIS_BLOCK.transactions:
-            for i, target in enumerate(tx.targets):
-                if target.is_pay_to_pubkey or target.is_pay_to_pubkey_lock:
-                    self.primary_block_chain.unspent_coins[(tx.get_hash(), i)] = target
+            # Adding the tx from Genesis block to unspent coins
+            for tx in GENESIS_BLOCK.transactions:
+                for i, target in enumerate(tx.targets):
+                    if target.is_pay_to_pubkey or target.is_pay_to_pubkey_lock:
+                        self.primary_block_chain.unspent_coins[(tx.get_hash(), i)] = target
+        else:
+            self.primary_block_chain = base_chain
+            self._blockchain_checkpoints = {base_chain.head.hash: base_chain.head.height}
 
         self.chain_change_handlers = []
         self.transaction_change_handlers = []
 
         protocol.block_receive_handlers.append(self.new_block_received)
-        protocol.trans_receive_handlers.append(self.new_transaction_received)
+        protocol.trans_batch_receive_handlers.append(self.new_transactions_received)
         protocol.block_request_handlers.append(self.block_request_received)
+        protocol.transaction_request_handlers.append(self.transaction_request_received)
+        protocol.transaction_pool_handlers.append(self.transaction_pool_requested)
         self.protocol = protocol
 
         self._thread_id = None
@@ -144,29 +255,85 @@ class ChainBuilder:
     def block_request_received(self, block_hash: bytes) -> 'Optional[Block]':
         """ Our event handler for block requests in the protocol. """
         self._assert_thread_safety()
-        return self.block_cache.get(block_hash)
+        block = self.block_cache.get(block_hash)
+        if block is None:
+            block = self.primary_block_chain.get_block_by_hash(block_hash)
+        if block is None or block.is_header_only:
+            return None
+        return block
+
+    def transaction_request_received(self, trans_hash: bytes) -> 'Optional[Transaction]':
+        """ Our event handler for transaction requests in the protocol. """
+        self._assert_thread_safety()
+        return self.unconfirmed_transactions.get(trans_hash)
 
-    def new_transaction_received(self, transaction: 'Transaction'):
-        """ Event handler that is called by the network layer when a transaction is received. """
+    def transaction_pool_requested(self) -> 'List[Transaction]':
+        """ Our event handler that provides the unconfirmed transactions to the protocol. """
         self._assert_thread_safety()
-        hash_val = transaction.get_hash()
+        return list(self.unconfirmed_transactions.values())
 
-        def input_ok(inp):
-            return (inp.transaction_hash, inp.output_idx) in self.primary_block_chain.unspent_coins or \
-                   inp.transaction_hash in self.unconfirmed_transactions
+    def new_transaction_received(self, transaction: 'Transaction'):
+        """ Handles a single new transaction, like `new_transactions_received`. """
+        self.new_transactions_received([transaction])
 
-        if hash_val not in self.unconfirmed_transactions and \
-                all(input_ok(inp) for inp in transaction.inputs):
-            self.unconfirmed_transactions[hash_val] = transaction
-            self.protocol.broadcast_transaction(transaction)
+    def new_transactions_received(self, transactions: 'List[Transaction]'):
+        """
+        Event handler that is called by the network layer when transactions are received. The
+        `transaction_change_handlers` are called at most once for all of them.
+        """
+        self._assert_thread_safety()
+        self.orphan_transactions.expire()
+        # `_accept_transactions` handles the last transaction first
+        if self._accept_transactions(transactions[::-1]):
             for handler in self.transaction_change_handlers:
                 handler()
 
+    def _accept_transactions(self, transactions: 'List[Transaction]') -> bool:
+        """
+        Adds `transactions` to the unconfirmed transactions if all their inputs are known, or to the
+        orphan pool if some of the transactions they spend from are still missing. Orphans waiting
+        for an accepted transaction are retried as well.
+
+        Returns a bool indicating whether any transaction was accepted.
+        """
+        accepted = False
+        while transactions:
+            transaction = transactions.pop()
+            hash_val = transaction.get_hash()
+            if hash_val in self.unconfirmed_transactions or hash_val in self.orphan_transactions:
+                continue
+
+            missing_parents = set()
+            for inp in transaction.inputs:
+                if inp.is_coinbase:
+                    break
+                if (inp.transaction_hash, inp.output_idx) in self.primary_block_chain.unspent_coins:
+                    continue
+                parent = self.unconfirmed_transactions.get(inp.transaction_hash)
+                if parent is None:
+                    missing_parents.add(inp.transaction_hash)
+                elif not 0 <= inp.output_idx < len(parent.targets):
+                    logging.debug("transaction %s spends a nonexistent output", hexlify(hash_val))
+                    break
+            else:
+                if missing_parents:
+                    self.orphan_transactions.add(transaction, missing_parents)
+                    continue
+
+                self.unconfirmed_transactions[hash_val] = transaction
+                self.protocol.broadcast_transaction(transaction)
+                transactions.extend(self.orphan_transactions.pop_children(hash_val))
+                accepted = True
+        return accepted
+
     def _new_primary_block_chain(self, chain: 'Blockchain'):
         """ Does all the housekeeping that needs to be done when a new longest chain is found. """
         logging.info("new chain:  height %d -  target %10.2e", len(chain.blocks),
                      chain.total_difficulty)
         self._assert_thread_safety()
+        if self.prune_depth is not None:
+            chain = self._prune(chain)
+        old_chain = self.primary_block_chain
         self.primary_block_chain = chain
         todelete = set()
         for (hash_val, trans) in self.unconfirmed_transactions.items():
@@ -175,6 +342,15 @@ class ChainBuilder:
         for hash_val in todelete:
             del self.unconfirmed_transactions[hash_val]
 
+        # orphans may be waiting for transactions that were confirmed in the new blocks
+        children = []
+        for block in reversed(chain.blocks):
+            if block.hash in old_chain.block_indices:
+                break
+            for trans in block.transactions:
+                children.extend(self.orphan_transactions.pop_children(trans.get_hash()))
+        self._accept_transactions(children)
+
         for handler in self.chain_change_handlers:
             handler()
 
@@ -183,6 +359,47 @@ class ChainBuilder:
 
         self.protocol.broadcast_primary_block(chain.head)
 
+    def _prune(self, chain: 'Blockchain') -> 'Blockchain':
+        """ Drops the transactions of the blocks more than `prune_depth` blocks below the head. """
+        height = chain.head.height - self.prune_depth
+        if height <= 0:
+            return chain
+        for hash_val, block in list(self.block_cache.items()):
+            if 0 < block.height <= height:
+                del self.block_cache[hash_val]
+        return chain.prune(height)
+
+    def release_blocks(self, height: int):
+        """
+        Drops the transactions of the blocks of the primary block chain up to `height` from memory
+        and from the block cache. Their undo data is kept, so that reorganizations below `height`
+        remain possible; the transactions are then read with `block_source`, which must be set.
+        """
+        self._assert_thread_safety()
+        chain = self.primary_block_chain
+        height = min(height, chain.head.height)
+        if height <= 0 or chain.blocks[height].is_header_only:
+            return
+        for hash_val in [b.hash for b in self.block_cache.values()
+                         if 0 < chain.block_indices.get(b.hash, 0) <= height]:
+            del self.block_cache[hash_val]
+        self.primary_block_chain = chain.prune(height, keep_undo_data=True)
+
+    def _cached_block(self, block_hash: bytes) -> 'Optional[Block]':
+        """ Returns a block from the block cache, or a released block of the primary block chain. """
+        block = self.block_cache.get(block_hash)
+        if block is None and self.block_source is not None and \
+                block_hash in self.primary_block_chain.block_indices:
+            block = self.block_source(block_hash)
+        return block
+
+    def _checkpoint_chain(self, block_hash: bytes) -> 'Optional[Blockchain]':
+        """ Computes the block chain ending with the checkpoint block `block_hash`. """
+        height = self._blockchain_checkpoints[block_hash]
+        if self.primary_block_chain.block_indices.get(block_hash) != height:
+            return None
+        return self.primary_block_chain.rewind(height)
+
     def _build_blockchain(self, checkpoint: 'Blockchain', blocks: 'List[Block]'):
         def checkpoint_hashes(chain):
             chain_len = len(chain.blocks)
@@ -205,13 +422,13 @@ class ChainBuilder:
                 break
 
             chain = next_chain
-            checkpoints[chain.head.hash] = chain
+            checkpoints[chain.head.hash] = chain.head.height
 
         if chain.total_difficulty < self.primary_block_chain.total_difficulty:
             logging.warning("discarding shorter chain")
             return
 
-        for hash_val in checkpoints.keys() - set(checkpoint_hashes(next_chain)):
+        for hash_val in checkpoints.keys() - set(checkpoint_hashes(chain)):
             del checkpoints[hash_val]
         self._blockchain_checkpoints = checkpoints
         self._new_primary_block_chain(chain)
@@ -251,23 +468,26 @@ class ChainBuilder:
             return
         self.block_cache[bl_hash] = block
 
-        self._retry_expired_requests()
-
-        if bl_hash not in self._block_requests:
-            self._block_requests[bl_hash] = BlockRequest()
-        else:
+        if bl_hash in self.primary_block_chain.block_indices:
+            # e.g. the history of a chain loaded from a snapshot
             return
 
-        request = self._block_requests[bl_hash]
-        del self._block_requests[bl_hash]
+        self._retry_expired_requests()
+
+        # continue the partial chains that were waiting for this block, if any
+        request = self._block_requests.pop(bl_hash, None)
+        if request is None:
+            request = BlockRequest()
 
         while True:
             for partial_chain in request.partial_chains:
                 partial_chain.append(block)
-            if (block.prev_block_hash not in self.block_cache) or (
-                    block.prev_block_hash in self._blockchain_checkpoints):
+            if block.prev_block_hash in self._blockchain_checkpoints:
+                break
+            prev_block = self._cached_block(block.prev_block_hash)
+            if prev_block is None:
                 break
-            block = self.block_cache[block.prev_block_hash]
+            block = prev_block
 
         if block.prev_block_hash in self._block_requests:
             chains = request.partial_chains
@@ -279,7 +499,10 @@ class ChainBuilder:
 
         if block.prev_block_hash in self._blockchain_checkpoints:
             del self._block_requests[block.prev_block_hash]
-            checkpoint = self._blockchain_checkpoints[block.prev_block_hash]
+            checkpoint = self._checkpoint_chain(block.prev_block_hash)
+            if checkpoint is None:
+                logging.warning("cannot compute the block chain of a checkpoint")
+                return
             for partial_chain in request.partial_chains:
                 self._build_blockchain(checkpoint, partial_chain[::-1])
         request.checked_retry(self.protocol)
@@ -24,3 +24,8 @@ DIFFICULTY_BLOCK_INTERVAL = 10
 
 DIFFICULTY_TIMEDELTA = timedelta(seconds=6)
 """ The time span that it should approximately take to mine `DIFFICULTY_BLOCK_INTERVAL` blocks.  """
+
+MAX_ORPHAN_TRANSACTIONS = 100
+""" The maximum number of transactions with unknown inputs that are kept until their inputs arrive. """
+ORPHAN_TRANSACTION_TIMEOUT = timedelta(minutes=20)
+""" The time after which a transaction whose inputs did not arrive is dropped from the orphan pool. """
@@ -105,9 +105,9 @@ class Miner:
     :vartype reward_pubkey: Key
     """
 
-    def __init__(self, proto, reward_pubkey):
+    def __init__(self, proto, reward_pubkey, base_chain=None, prune_depth=None):
         self.proto = proto
-        self.chainbuilder = ChainBuilder(proto)
+        self.chainbuilder = ChainBuilder(proto, base_chain, prune_depth)
         self.chainbuilder.chain_change_handlers.append(self._chain_changed)
         self._cur_miner_pids = []
         self._cur_miner_pipes = None
@@ -1,97 +1,927 @@
-""" Functionality for storing and retrieving the miner state on disk. """
+"""
+Functionality for storing and retrieving the miner state on disk.
 
+The blocks of the primary block chain are stored in an append-only `BlockLog`, so that storing a
+new block only costs as much as writing that block. The unconfirmed transactions and connected
+peers are small in comparison; they are rewritten to a separate gzip-compressed file with one JSON
+record per line, either ``{"transaction": ...}`` or ``{"peer": ...}``.
+
+Loading decodes and replays one block or record at a time, so that the memory it needs does not
+depend on the size of the files.
+
+Block log format (all integers little-endian)::
+
+    record:      payload length (u32) | record type (u8) | CRC-32 of the payload (u32) | payload
+    index entry: segment (u32) | offset of the record of the block in the segment (u64) | block hash (32 bytes)
+
+Block and header records contain a block in the binary wire encoding (see `wire`); header records
+are used for blocks of which we only know the header, e.g. after starting from a snapshot. A rewind
+record (with the height as an i64 payload) marks that the primary block chain switched to a fork
+after the block at that height; the blocks of the fork follow it. The records are appended to
+segment files at `path` + ".000000", ".000001" and so on, each of which is continued until it has
+`SEGMENT_SIZE` bytes. Records are never overwritten; only pruning (see `BlockLog.prune`) replaces a
+segment whose blocks are all pruned, once, with one that only has their headers.
+
+The index file has one entry per block of the stored chain, by height. It can be rebuilt from the
+log, which is done when they do not match after a crash.
+
+When changes are written, and how far they are synced to disk, is set by a `PersistencePolicy`.
+
+To restart quickly, the `Persistence` also writes a chain state every `CHAIN_STATE_INTERVAL` blocks:
+a snapshot of the headers and unspent coins (in the format of `snapshot`) at `path` + ".utxo." +
+its height, and the hash, height and file name of that snapshot at `path` + ".state".
+`load_chain_state` loads the chain from these files and the block log without validating the blocks
+again. The ".state" file is replaced only once the new snapshot is on disk, and the previous
+snapshot is deleted (and the block log pruned) only once the new ".state" file is, so that a crash
+at any point leaves a usable chain state.
+"""
+
+import gzip
 import json
+import logging
+import mmap
 import os
 import os.path
 import tempfile
-import gzip
 import time
-from io import TextIOWrapper
-from threading import Condition, Thread
+import zlib
+from binascii import hexlify, unhexlify
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 from datetime import timedelta
+from io import TextIOWrapper
+from struct import Struct
+from threading import Condition, Lock, RLock, Thread
+from typing import List, Optional, Tuple
+
+from .blockchain import Blockchain
+from .config import GENESIS_TARGET
+from .snapshot import read_utxo_snapshot, write_utxo_snapshot
+from .wire import encode_binary, decode_binary
+
+__all__ = ['Persistence', 'PersistencePolicy', 'BlockLog', 'load_chain_state']
+
+FSYNC_NONE = 'none'
+FSYNC_BATCH = 'batch'
+FSYNC_ALWAYS = 'always'
+FSYNC_MODES = (FSYNC_NONE, FSYNC_BATCH, FSYNC_ALWAYS)
+"""
+When written data is synced to disk: never (the operating system writes it back eventually), once
+per write (e.g. once for all blocks that were added since the last write), or after every record.
+Data that was written but not synced survives a crash of the miner, but not of the machine.
+"""
+
+PersistencePolicy = namedtuple('PersistencePolicy',
+                               ['chain_interval', 'mempool_interval', 'max_blocks_at_risk', 'fsync'],
+                               defaults=(5.0, 5.0, 10, FSYNC_BATCH))
+PersistencePolicy.__doc__ = """
+When the `Persistence` writes changes to disk. Changes are written behind: a change waits until it
+is `chain_interval` or `mempool_interval` seconds old, and all changes in the meantime are written
+together. So at most that many seconds of changes are lost when the miner crashes.
+
+:ivar chain_interval: The number of seconds a change of the primary block chain may wait.
+:ivar mempool_interval: The number of seconds a change of the unconfirmed transactions or connected
+                        peers may wait.
+:ivar max_blocks_at_risk: The number of new blocks after which the block chain is written without
+                          waiting for `chain_interval`.
+:ivar fsync: One of `FSYNC_MODES`.
+"""
+
+LOAD_QUEUE_SIZE = 100
+"""
+The maximum number of received messages, including the loaded blocks, that may wait for the main
+thread while loading. Loading pauses until the main thread has caught up.
+"""
+
+LOAD_PROGRESS_INTERVAL = timedelta(seconds=10)
+""" The time between two progress reports while loading. """
+
+CHAIN_STATE_INTERVAL = 1000
+""" The number of blocks after which a new chain state for fast restarts is written. """
+
+CHAIN_STATE_DEPTH = 20
+"""
+The number of blocks below the head of the primary block chain at which the chain state is written.
+These blocks are validated again when restarting, so that reorganizations of up to this depth remain
+possible afterwards.
+"""
+
+SEGMENT_SIZE = 128 * 1024 * 1024
+"""
+The number of bytes after which the block log continues in a new segment file. Pruning only
+rewrites whole segments, so this is also about how many bytes of blocks are kept above the pruned
+height.
+"""
+
+BLOCK_RECORD = 1
+HEADER_RECORD = 2
+REWIND_RECORD = 3
+
+_RECORD_HEADER = Struct("<IBI")
+_INDEX_ENTRY = Struct("<IQ32s")
+_REWIND = Struct("<q")
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+class BlockLog:
+    """
+    An append-only log of the blocks of the primary block chain, with an index of the blocks by
+    height and hash. The log is split into segment files of about `SEGMENT_SIZE` bytes, which are
+    read through memory maps, so that any block can be decoded when it is needed without keeping
+    all blocks in memory.
+
+    Only one thread may write to the log (with `write_chain` and `prune`), but `block_at`,
+    `block_by_hash` and `stored_height` can be called from any thread.
+
+    :param fsync: When written records are synced to disk, one of `FSYNC_MODES`.
+
+    :ivar path: The path the log is stored at. The segments are stored next to it, at
+                `segment_path`, and the index at `index_path`.
+    :vartype path: str
+    :ivar index_path: The path of the index file.
+    :vartype index_path: str
+    :ivar hashes: The hashes of the blocks of the stored chain, by height.
+    :vartype hashes: List[bytes]
+    :ivar _segments: The segments of the records of the blocks of the stored chain, by height. The
+                     segments never decrease with the height.
+    :vartype _segments: List[int]
+    :ivar _offsets: The offsets of the records of the blocks of the stored chain in their segments.
+    :vartype _offsets: List[int]
+    :ivar _segment: The segment that is appended to.
+    :vartype _segment: int
+    :ivar _pruned_segments: The number of segments at the start of the log that are known to
+                            contain only headers.
+    :vartype _pruned_segments: int
+    """
+
+    def __init__(self, path: str, fsync: str = FSYNC_BATCH):
+        if fsync not in FSYNC_MODES:
+            raise ValueError("unknown fsync mode: {}".format(fsync))
+        self.path = path
+        self.index_path = path + ".index"
+        self.fsync = fsync
+        self.hashes = []
+        self._segments = []
+        self._offsets = []
+        self._heights = {}
+        self._segment = 0
+        self._pruned_segments = 0
+        self._log = None
+        self._index = None
+        self._maps = {}
+        self._lock = RLock()
+
+    def segment_path(self, segment: int) -> str:
+        """ The path of the segment file with the number `segment`. """
+        return "{}.{:06d}".format(self.path, segment)
+
+    @property
+    def _pruning_path(self) -> str:
+        """ The path of the file that exists while `prune` replaces a segment. """
+        return self.path + ".pruning"
+
+    def open(self):
+        """
+        Opens the log, creating it if it does not exist yet, and reads the index. If the index does
+        not match the log, it is rebuilt and a partially written record at the end of the log is
+        removed.
+        """
+        self._segment = 0
+        while os.path.exists(self.segment_path(self._segment + 1)):
+            self._segment += 1
+        self._log = open(self.segment_path(self._segment), "a+b")
+        self._index = open(self.index_path, "a+b")
+        self._index.seek(0)
+        data = self._index.read()
+        entries = [_INDEX_ENTRY.unpack_from(data, pos)
+                   for pos in range(0, len(data) - _INDEX_ENTRY.size + 1, _INDEX_ENTRY.size)]
+        self._segments = [segment for (segment, _, _) in entries]
+        self._offsets = [offset for (_, offset, _) in entries]
+        self.hashes = [block_hash for (_, _, block_hash) in entries]
+
+        log_size = self._log.seek(0, os.SEEK_END)
+        last_segment = self._segments[-1] if entries else 0
+        if len(data) % _INDEX_ENTRY.size or os.path.exists(self._pruning_path) or \
+                last_segment != self._segment or self._record_end(-1) != log_size:
+            logging.warning("rebuilding the index of the block log %s", self.path)
+            self._rebuild_index()
+        self._heights = {block_hash: height for (height, block_hash) in enumerate(self.hashes)}
+
+    def close(self):
+        self._maps = {}
+        self._log.close()
+        self._index.close()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _map_segment(self, segment: int):
+        """ Maps the current contents of a segment into memory. Must be called with `_lock`. """
+        try:
+            with open(self.segment_path(segment), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+        except FileNotFoundError:
+            data = b""
+        self._maps[segment] = data
+        return data
+
+    def _read(self, segment: int, offset: int, length: int) -> bytes:
+        """ Reads `length` bytes at `offset` from a segment, or less if the segment ends before. """
+        data = self._maps.get(segment)
+        if data is None or offset + length > len(data):
+            with self._lock:
+                data = self._map_segment(segment)
+        return data[offset:offset + length]
+
+    def _read_record(self, segment: int, offset: int):
+        """
+        Returns the type and the payload of the record at `offset` in a segment, or `None` if it is
+        damaged.
+        """
+        header = self._read(segment, offset, _RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            return None
+        length, record_type, crc = _RECORD_HEADER.unpack(header)
+        payload = self._read(segment, offset + _RECORD_HEADER.size, length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return None
+        return record_type, payload
+
+    def _record_end(self, height: int) -> int:
+        """
+        Returns the offset in its segment after the record of the block at `height`, or -1 if it is
+        damaged.
+        """
+        if not self._offsets:
+            return 0
+        offset = self._offsets[height]
+        record = self._read_record(self._segments[height], offset)
+        if record is None:
+            return -1
+        return offset + _RECORD_HEADER.size + len(record[1])
+
+    def _rebuild_index(self):
+        segments = []
+        offsets = []
+        hashes = []
+        segment = offset = 0
+        while True:
+            record = self._read_record(segment, offset)
+            if record is None:
+                if os.path.exists(self.segment_path(segment + 1)) and \
+                        offset == os.path.getsize(self.segment_path(segment)):
+                    segment, offset = segment + 1, 0
+                    continue
+                break
+            record_type, payload = record
+            if record_type == REWIND_RECORD:
+                height, = _REWIND.unpack(payload)
+                del segments[height + 1:], offsets[height + 1:], hashes[height + 1:]
+            else:
+                block = decode_binary(payload)
+                del segments[block.height:], offsets[block.height:], hashes[block.height:]
+                segments.append(segment)
+                offsets.append(offset)
+                hashes.append(block.hash)
+            offset += _RECORD_HEADER.size + len(payload)
+
+        # everything after the last complete record is dropped
+        self._maps = {}
+        self._log.close()
+        for later in range(segment + 1, self._segment + 1):
+            os.unlink(self.segment_path(later))
+        self._segment = segment
+        self._log = open(self.segment_path(segment), "a+b")
+        self._log.truncate(offset)
+        self._index.truncate(0)
+        self._index.write(b"".join(_INDEX_ENTRY.pack(*entry) for entry in zip(segments, offsets, hashes)))
+        self._sync(self._log)
+        self._sync(self._index)
+        self._segments = segments
+        self._offsets = offsets
+        self.hashes = hashes
+        self._pruned_segments = 0
+        if os.path.exists(self._pruning_path):
+            os.unlink(self._pruning_path)
+
+    @staticmethod
+    def _decode(height: int, record) -> 'Block':
+        if record is None:
+            raise ValueError("the record of the block at height {} is damaged".format(height))
+        record_type, payload = record
+        block = decode_binary(payload)
+        block.is_header_only = record_type == HEADER_RECORD
+        return block
+
+    def read_block(self, height: int) -> 'Block':
+        """ Reads the block at `height` of the stored chain. """
+        with self._lock:
+            record = self._read_record(self._segments[height], self._offsets[height])
+        return self._decode(height, record)
+
+    def block_at(self, height: int) -> 'Optional[Block]':
+        """ Reads the block at `height` of the stored chain, if there is one. """
+        with self._lock:
+            if not 0 <= height < len(self._offsets):
+                return None
+            record = self._read_record(self._segments[height], self._offsets[height])
+        return self._decode(height, record)
+
+    def block_by_hash(self, block_hash: bytes) -> 'Optional[Block]':
+        """ Reads the block with the hash `block_hash`, if it is part of the stored chain. """
+        with self._lock:
+            height = self._heights.get(block_hash)
+            if height is None:
+                return None
+            record = self._read_record(self._segments[height], self._offsets[height])
+        return self._decode(height, record)
+
+    def stored_height(self, blocks: 'List[Block]', height: int) -> int:
+        """
+        Returns the height of the last block of the chain `blocks`, up to `height`, that is part of
+        the stored chain.
+        """
+        with self._lock:
+            height = min(height, len(blocks) - 1, len(self.hashes) - 1)
+            while height > 0 and self.hashes[height] != blocks[height].hash:
+                height -= 1
+        return max(height, 0)
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync != FSYNC_NONE:
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _record(record_type: int, payload: bytes) -> bytes:
+        return _RECORD_HEADER.pack(len(payload), record_type, zlib.crc32(payload)) + payload
+
+    def _write_records(self, records: 'List[bytes]') -> 'List[Tuple[int, int]]':
+        """
+        Appends records to the log, starting a new segment whenever the current one has reached
+        `SEGMENT_SIZE`, and returns the segment and offset of each record.
+        """
+        segment, offset = self._segment, self._log.seek(0, os.SEEK_END)
+        positions = []
+        batches = []
+        for record in records:
+            if offset >= SEGMENT_SIZE:
+                segment, offset = segment + 1, 0
+            if not batches or batches[-1][0] != segment:
+                batches.append((segment, []))
+            batches[-1][1].append(record)
+            positions.append((segment, offset))
+            offset += len(record)
+
+        for segment, batch in batches:
+            if segment != self._segment:
+                self._log.close()
+                self._log = open(self.segment_path(segment), "a+b")
+                self._segment = segment
+            if self.fsync == FSYNC_ALWAYS:
+                for record in batch:
+                    self._log.write(record)
+                    self._sync(self._log)
+            else:
+                self._log.write(b"".join(batch))
+                self._sync(self._log)
+        return positions
+
+    def write_chain(self, blocks: 'List[Block]') -> int:
+        """
+        Updates the log to store the chain consisting of `blocks`, and returns the number of bytes
+        written. Only the blocks after the last block this chain has in common with the stored one
+        are written. Nothing is written if `blocks` is a prefix of the stored chain, e.g. while the
+        stored chain is being loaded.
+        """
+        fork = min(len(self.hashes), len(blocks)) - 1
+        while fork >= 0 and self.hashes[fork] != blocks[fork].hash:
+            fork -= 1
+        if fork == len(blocks) - 1:
+            return 0
+
+        records = []
+        rewind = fork < len(self.hashes) - 1
+        if rewind:
+            records.append(self._record(REWIND_RECORD, _REWIND.pack(fork)))
+        for block in blocks[fork + 1:]:
+            records.append(self._record(HEADER_RECORD if block.is_header_only else BLOCK_RECORD,
+                                        encode_binary(block)))
+        positions = self._write_records(records)[1 if rewind else 0:]
+        segments = [segment for (segment, _) in positions]
+        offsets = [offset for (_, offset) in positions]
+        hashes = [block.hash for block in blocks[fork + 1:]]
+
+        # the index is only updated once the records are on disk, so that it never points past them
+        with self._lock:
+            for block_hash in self.hashes[fork + 1:]:
+                del self._heights[block_hash]
+            del self._segments[fork + 1:], self._offsets[fork + 1:], self.hashes[fork + 1:]
+            self._segments += segments
+            self._offsets += offsets
+            self.hashes += hashes
+            for height, block_hash in enumerate(hashes, fork + 1):
+                self._heights[block_hash] = height
+        self._index.truncate((fork + 1) * _INDEX_ENTRY.size)
+        entries = b"".join(_INDEX_ENTRY.pack(*entry) for entry in zip(segments, offsets, hashes))
+        self._index.write(entries)
+        self._sync(self._index)
+        return sum(len(record) for record in records) + len(entries)
+
+    def prune(self, height: int) -> int:
+        """
+        Replaces the segments of the log whose blocks are all at or below `height` by segments with
+        only the headers of these blocks, and returns the number of bytes written. The records of
+        blocks that are no longer part of the stored chain are dropped from them as well. Segments
+        with later blocks, including the one that is appended to, keep all transactions, so up to
+        `SEGMENT_SIZE` bytes of blocks up to `height` may stay in the log. Each segment is only
+        rewritten once. Must be called from the thread that writes the log.
+        """
+        written = 0
+        while self._pruned_segments < self._segment:
+            segment = self._pruned_segments
+            start = bisect_left(self._segments, segment)
+            end = bisect_right(self._segments, segment)
+            if end - 1 > height:
+                break
+            records = []
+            for h in range(start, end):
+                record = self._read_record(segment, self._offsets[h])
+                if record is None:
+                    raise ValueError("the record of the block at height {} is damaged".format(h))
+                records.append(record)
+            size = sum(_RECORD_HEADER.size + len(payload) for (_, payload) in records)
+            if size != os.path.getsize(self.segment_path(segment)) or \
+                    any(record_type == BLOCK_RECORD for (record_type, _) in records):
+                written += self._replace_segment(segment, start, records)
+            self._pruned_segments += 1
+        return written
+
+    def _replace_segment(self, segment: int, start: int, records: list) -> int:
+        """
+        Replaces a segment by the headers of its blocks in the stored chain, which start at height
+        `start` and have the records `records`. Returns the number of bytes written.
+        """
+        offsets = []
+        tmp_path = self.segment_path(segment) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for record_type, payload in records:
+                if record_type == BLOCK_RECORD:
+                    record_type = HEADER_RECORD
+                    payload = encode_binary(decode_binary(payload).header_only())
+                offsets.append(f.tell())
+                f.write(self._record(record_type, payload))
+            self._sync(f)
+            size = f.tell()
+        entries = b"".join(_INDEX_ENTRY.pack(segment, o, h)
+                           for (o, h) in zip(offsets, self.hashes[start:start + len(records)]))
+
+        # if we crash before the index is updated, it is rebuilt
+        with open(self._pruning_path, "wb") as f:
+            self._sync(f)
+        with self._lock:
+            self._maps.pop(segment, None)
+            os.rename(tmp_path, self.segment_path(segment))
+            self._offsets[start:start + len(offsets)] = offsets
+        with open(self.index_path, "r+b") as f:
+            f.seek(start * _INDEX_ENTRY.size)
+            f.write(entries)
+            self._sync(f)
+        os.unlink(self._pruning_path)
+        return size + len(entries)
+
+
+def _read_chain_state_info(path: str) -> 'Optional[dict]':
+    try:
+        with open(path + ".state") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_chain_state(path: str) -> 'Optional[Blockchain]':
+    """
+    Loads the primary block chain from the last chain state that `Persistence` wrote at `path`. The
+    snapshot of the unspent coins is checked against its stored hash, and its headers against the
+    block log, but the blocks are not validated again. Returns `None` if there is no usable chain
+    state. The blocks after the chain state are loaded by `Persistence.load` as usual.
+
+    The blocks of the returned chain only contain their headers; the `Persistence` reads their
+    transactions from the block log when they are requested.
+    """
+    info = _read_chain_state_info(path)
+    if info is None:
+        return None
+    try:
+        snapshot_path = os.path.join(os.path.dirname(path), info['snapshot'])
+        chain = read_utxo_snapshot(snapshot_path, unhexlify(info['hash']))
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("cannot load the chain state: %s", e)
+        return None
+
+    block_log = BlockLog(path)
+    block_log.open()
+    try:
+        if block_log.hashes[:len(chain.blocks)] != [b.hash for b in chain.blocks]:
+            logging.warning("the chain state does not match the block log")
+            return None
+    finally:
+        block_log.close()
+    logging.info("loaded the chain state at height %d", chain.head.height)
+    return chain
 
-PERSISTENCE_MIN_INTERVAL = timedelta(seconds=5)
 
 class Persistence:
     """
     Functionality for storing and retrieving the miner state on disk.
 
-    Right now, this class stores the connected peers, the blocks in the primary block chain and the
-    unconfirmed transactions in a gzip-compressed file in JSON format. These are dumped whenever
-    the primary block chain changes or a new unconfirmed transaction is received, but at most every
-    `PERSISTENCE_MIN_INTERVAL` time steps.
+    The blocks of the primary block chain are appended to a `BlockLog` at `path` whenever the
+    primary block chain changes. The unconfirmed transactions and the connected peers are stored in
+    a gzip-compressed file at `path` + ".mempool" when they change. All changes are written by
+    a background thread, as set by `policy`; `stats` returns how long the writes took.
+
+    Every `CHAIN_STATE_INTERVAL` blocks, the chain state at `CHAIN_STATE_DEPTH` blocks below the head
+    is written as well; see `load_chain_state`. Requests for blocks of which only the header is kept
+    in memory are answered from the block log.
+
+    Blocks that are stored in the block log and more than `CHAIN_STATE_DEPTH` blocks below the head
+    are released from the memory of the chainbuilder (see `ChainBuilder.release_blocks`), so that
+    only their headers and undo data are kept there.
+
+    If the chainbuilder prunes old blocks (see its `prune_depth`), the block log is pruned as well,
+    up to the chain state and at most to the height the chainbuilder pruned. Such a log can only be
+    loaded starting from its chain state. Since the chain state is at most `CHAIN_STATE_DEPTH` +
+    `CHAIN_STATE_INTERVAL` blocks below the head, the log keeps the transactions of the last
+    max(`prune_depth`, `CHAIN_STATE_DEPTH` + `CHAIN_STATE_INTERVAL`) blocks, and of the blocks in
+    the same segment as the first of them or in the segment that is appended to (see
+    `BlockLog.prune`).
+
+    A file in the format of older versions, a single gzip-compressed JSON file with all blocks, is
+    moved to `path` + ".old" and loaded from there.
 
     :param path: The path to the storage location.
     :param chainbuilder: The chainbuilder to persist.
+    :param policy: When changes are written to disk.
     """
-    def __init__(self, path: str, chainbuilder: 'ChainBuilder'):
+    def __init__(self, path: str, chainbuilder: 'ChainBuilder', policy: PersistencePolicy = PersistencePolicy()):
         self.chainbuilder = chainbuilder
         self.proto = chainbuilder.protocol
         self.path = path
+        self.mempool_path = path + ".mempool"
+        self.policy = policy
+        self.block_log = BlockLog(path, policy.fsync)
         self._store_cond = Condition()
-        self._store_data = None
+        self._chain_data = None
+        self._chain_since = None
+        self._mempool_data = None
+        self._mempool_since = None
+        self._stats_lock = Lock()
+        self._write_stats = {kind: {'writes': 0, 'bytes': 0, 'total_latency': 0.0,
+                                    'max_latency': 0.0, 'last_latency': 0.0}
+                             for kind in ('chain', 'mempool', 'chain_state', 'prune')}
 
         chainbuilder.chain_change_handlers.append(self.store)
         chainbuilder.transaction_change_handlers.append(self.store)
+        self.proto.block_request_handlers.append(self.block_by_hash)
+        chainbuilder.block_source = self.block_by_hash
         self._loading = False
 
+        info = _read_chain_state_info(path)
+        self._chain_state_height = 0 if info is None else info['height']
+        self._pruned_height = 0
+
+        self._old_format_path = self._move_old_format()
+        self.block_log.open()
+        self._stored_head = self.block_log.hashes[-1] if len(self.block_log) else None
+        # the genesis block is never at risk
+        self._stored_height = max(len(self.block_log) - 1, 0)
         Thread(target=self._store_thread, daemon=True).start()
 
+    def _move_old_format(self) -> 'Optional[str]':
+        """
+        Moves a file in the format of older versions out of the way of the block log, and returns
+        its new path, if there is one.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(_GZIP_MAGIC)) != _GZIP_MAGIC:
+                    return None
+        except FileNotFoundError:
+            return None
+        os.rename(self.path, self.path + ".old")
+        return self.path + ".old"
+
+    def _load_old_format(self, path: str):
+        """
+        Loads the blocks, transactions and peers in the gzip-compressed JSON file `path`, in the
+        format of older versions. This format cannot be read incrementally.
+        """
+        with gzip.open(path, "r") as f:
+            obj = json.load(TextIOWrapper(f))
+        for block in reversed(obj.get('blocks', [])):
+            self._wait_for_main_thread()
+            self.proto.received("block", block, None, 2)
+        for trans in obj['transactions']:
+            self.proto.received("transaction", trans, None, 2)
+        for peer in obj["peers"]:
+            self.proto.received("peer", peer, None, 2)
+
+    def _wait_for_main_thread(self):
+        """ Waits until fewer than `LOAD_QUEUE_SIZE` messages wait for the main thread. """
+        while self.proto.pending_events() >= LOAD_QUEUE_SIZE:
+            time.sleep(0.01)
+
+    def _load_blocks(self, start: int):
+        """ Loads the blocks of the block log from `start` on, one at a time. """
+        total = len(self.block_log) - start
+        if total <= 0:
+            return
+        logging.info("loading %d blocks from %s", total, self.path)
+        started = last_report = time.monotonic()
+        header_only = 0
+        for count, height in enumerate(range(start, len(self.block_log)), 1):
+            self._wait_for_main_thread()
+            block = self.block_log.read_block(height)
+            if block.is_header_only:
+                header_only += 1
+            else:
+                self.proto.received("block", block, None, 2)
+            now = time.monotonic()
+            if now - last_report >= LOAD_PROGRESS_INTERVAL.total_seconds():
+                logging.info("loaded %d of %d blocks (%.0f blocks/s)", count, total, count / (now - started))
+                last_report = now
+        if header_only:
+            logging.warning("%d blocks in %s only have their headers, e.g. because they were pruned; "
+                            "they can only be loaded from a chain state", header_only, self.path)
+        duration = time.monotonic() - started
+        logging.info("loaded %d blocks in %.1f s (%.0f blocks/s)", total, duration, total / max(duration, 1e-9))
+
+    def _load_mempool(self):
+        """ Loads the transactions and peers stored by `_store_mempool`, one record at a time. """
+        with gzip.open(self.mempool_path, "rt") as f:
+            try:
+                for line in f:
+                    (msg_type, param), = json.loads(line).items()
+                    if msg_type in ("transaction", "peer"):
+                        self.proto.received(msg_type, param, None, 2)
+            except (ValueError, OSError, EOFError) as e:
+                logging.warning("cannot read the rest of %s: %s", self.mempool_path, e)
+
     def load(self):
-        """ Loads data from disk. """
+        """
+        Loads data from disk. Blocks that are already part of the primary block chain, e.g. because
+        it was loaded with `load_chain_state`, are skipped.
+
+        The blocks are handed to the main thread one at a time, at most `LOAD_QUEUE_SIZE` ahead of
+        it, so this returns only once most of them were handled. It must not be called from the
+        main thread.
+        """
         self._loading = True
         try:
-            with gzip.open(self.path, "r") as f:
-                obj = json.load(TextIOWrapper(f))
-            for block in obj['blocks']:
-                self.proto.received("block", block, None, 2)
-            for trans in obj['transactions']:
-                self.proto.received("transaction", trans, None, 2)
-            for peer in obj["peers"]:
-                self.proto.received("peer", peer, None, 2)
+            chain = self.chainbuilder.primary_block_chain
+            start = 1
+            while start < min(len(chain.blocks), len(self.block_log)) and \
+                    chain.blocks[start].hash == self.block_log.hashes[start]:
+                start += 1
+            self._load_blocks(start)
+            if self._old_format_path is not None:
+                logging.info("loading %s in the format of older versions", self._old_format_path)
+                self._load_old_format(self._old_format_path)
+                self._old_format_path = None
+            self._load_mempool()
         finally:
             self._loading = False
 
+    def block_by_hash(self, block_hash: bytes) -> 'Optional[Block]':
+        """
+        Reads the block with the hash `block_hash` from the block log, if it is part of the primary
+        block chain and its transactions are known.
+        """
+        block = self.block_log.block_by_hash(block_hash)
+        if block is None or block.is_header_only:
+            return None
+        return block
+
+    def rebuild_chain(self, height: int) -> 'Optional[Blockchain]':
+        """
+        Rebuilds the primary block chain up to `height` with its undo data, by applying the blocks of
+        the block log again; they were validated before they were stored. Unlike a chain loaded with
+        `load_chain_state`, the result can be rewound to any height. Returns `None` if the block log
+        does not contain the transactions of all these blocks, e.g. because it was pruned.
+        """
+        chain = Blockchain()
+        for h in range(1, height + 1):
+            block = self.block_log.block_at(h)
+            if block is None or block.is_header_only:
+                return None
+            chain.undo_data.append(Blockchain.apply_block(chain.unspent_coins, block))
+            chain.blocks.append(block)
+            chain.block_indices[block.hash] = h
+            chain.total_difficulty += GENESIS_TARGET - block.target
+        return chain
+
     def store(self):
         """
         Asynchronously stores current data to disk.
 
         Used as an event handler in the chainbuilder.
         """
+        chain = self.chainbuilder.primary_block_chain
+        if self.chainbuilder.prune_depth is None:
+            # Only the blocks written so far are released; those of this change are released after a
+            # later one. This is safe while the store thread writes an earlier chain: the block log
+            # only lists a block once its record is on disk, and `Blockchain.prune` returns a new
+            # chain with header-only copies, so the chains given to the store thread keep their
+            # transactions.
+            self.chainbuilder.release_blocks(
+                self.block_log.stored_height(chain.blocks, chain.head.height - CHAIN_STATE_DEPTH))
         if self._loading:
             return
 
-        chain = self.chainbuilder.primary_block_chain
         trans = self.chainbuilder.unconfirmed_transactions.copy()
         peers = [list(peer.peer_addr) for peer in self.proto.peers if peer.is_connected and peer.peer_addr is not None]
 
+        now = time.monotonic()
         with self._store_cond:
-            self._store_data = chain, trans, peers
+            if chain.head.hash != self._stored_head:
+                self._chain_data = chain
+                if self._chain_since is None:
+                    self._chain_since = now
+            else:
+                self._chain_data = self._chain_since = None
+            self._mempool_data = trans, peers
+            if self._mempool_since is None:
+                self._mempool_since = now
             self._store_cond.notify()
 
+    def _next_writes(self):
+        """
+        Waits until a change is due to be written according to the policy, and returns the chain
+        and mempool data to write, either of which may be `None`. Must be called with `_store_cond`.
+        """
+        while True:
+            now = time.monotonic()
+            chain = mempool = None
+            timeout = None
+            if self._chain_data is not None:
+                due = self._chain_since + self.policy.chain_interval
+                if due <= now or \
+                        self._chain_data.head.height - self._stored_height >= self.policy.max_blocks_at_risk:
+                    chain = self._chain_data
+                    self._chain_data = self._chain_since = None
+                else:
+                    timeout = due - now
+            if self._mempool_data is not None:
+                due = self._mempool_since + self.policy.mempool_interval
+                if due <= now:
+                    mempool = self._mempool_data
+                    self._mempool_data = self._mempool_since = None
+                else:
+                    timeout = due - now if timeout is None else min(timeout, due - now)
+            if chain is not None or mempool is not None:
+                return chain, mempool
+            self._store_cond.wait(timeout)
+
     def _store_thread(self):
+        last_mempool = None
         while True:
             with self._store_cond:
-                while self._store_data is None:
-                    self._store_cond.wait()
-                chain, trans, peers = self._store_data
-                self._store_data = None
-
-            obj = {
-                "blocks": [b.to_json_compatible() for b in chain.blocks[::-1]],
-                "transactions": [t.to_json_compatible() for t in trans.values()],
-                "peers": peers,
-            }
-
-            with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path), mode="wb", delete=False) as tmpf:
-                try:
-                    with TextIOWrapper(gzip.open(tmpf, mode="w")) as f:
-                        json.dump(obj, f, indent=4)
-                    tmpf.close()
-                    os.rename(tmpf.name, self.path)
-                except Exception as e:
-                    os.unlink(tmpf.name)
-                    raise e
-            time.sleep(PERSISTENCE_MIN_INTERVAL.total_seconds())
+                chain, mempool = self._next_writes()
+
+            if chain is not None:
+                self._store_chain(chain)
+            if mempool is not None:
+                trans, peers = mempool
+                if (set(trans), peers) != last_mempool:
+                    self._store_mempool(trans, peers)
+                    last_mempool = (set(trans), peers)
+
+    def _record_write(self, kind: str, size: int, started: float):
+        """ Adds a write of `size` bytes that began at the `time.monotonic` value `started` to the stats. """
+        latency = time.monotonic() - started
+        with self._stats_lock:
+            stats = self._write_stats[kind]
+            stats['writes'] += 1
+            stats['bytes'] += size
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['last_latency'] = latency
+        logging.debug("wrote %d bytes of %s data in %.3f s", size, kind, latency)
+
+    def stats(self) -> dict:
+        """
+        Returns the policy, the number of writes, the bytes written and the latencies (in seconds)
+        of the writes of the block chain, mempool and chain state and of pruning, and how many blocks and seconds
+        of changes are not written yet, in a JSON-serializable representation.
+        """
+        now = time.monotonic()
+        with self._store_cond:
+            chain, chain_since = self._chain_data, self._chain_since
+            mempool_since = self._mempool_since
+            stored_height = self._stored_height
+        with self._stats_lock:
+            val = {kind: dict(stats) for (kind, stats) in self._write_stats.items()}
+        val['policy'] = self.policy._asdict()
+        val['unwritten_blocks'] = 0 if chain is None else max(0, chain.head.height - stored_height)
+        val['unwritten_chain_seconds'] = 0.0 if chain_since is None else now - chain_since
+        val['unwritten_mempool_seconds'] = 0.0 if mempool_since is None else now - mempool_since
+        return val
+
+    def _store_chain(self, chain: 'Blockchain'):
+        started = time.monotonic()
+        written = self.block_log.write_chain(chain.blocks)
+        if written:
+            self._record_write('chain', written, started)
+        with self._store_cond:
+            self._stored_head = chain.head.hash
+            self._stored_height = chain.head.height
+
+        height = chain.head.height - CHAIN_STATE_DEPTH
+        if height >= self._chain_state_height + CHAIN_STATE_INTERVAL and chain.can_rewind(height):
+            self._store_chain_state(chain.rewind(height))
+
+        prune_depth = self.chainbuilder.prune_depth
+        if prune_depth is not None:
+            height = min(self._chain_state_height, chain.head.height - prune_depth)
+            if height > self._pruned_height:
+                started = time.monotonic()
+                self._record_write('prune', self.block_log.prune(height), started)
+                self._pruned_height = height
+                logging.info("pruned the blocks up to height %d from %s", height, self.path)
+
+    def _store_chain_state(self, chain: 'Blockchain'):
+        """
+        Writes the chain state for `load_chain_state`. Its blocks must be in the block log. The
+        previous chain state stays usable until the new one is completely on disk.
+        """
+        started = time.monotonic()
+        snapshot_path = "{}.utxo.{}".format(self.path, chain.head.height)
+        snapshot_hash = write_utxo_snapshot(chain, snapshot_path)
+        self._sync_directory()
+        info = {"hash": hexlify(snapshot_hash).decode(), "height": chain.head.height,
+                "snapshot": os.path.basename(snapshot_path)}
+        size = self._write_chain_state_info(info)
+        self._sync_directory()
+
+        self._chain_state_height = chain.head.height
+        self._remove_old_snapshots(info['snapshot'])
+        self._record_write('chain_state', os.path.getsize(snapshot_path) + size, started)
+        logging.info("stored the chain state at height %d", chain.head.height)
+
+    def _write_chain_state_info(self, info: dict) -> int:
+        """ Replaces the ".state" file with `info`, and returns its size. """
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path) or ".", delete=False) as f:
+            try:
+                json.dump(info, f)
+                f.flush()
+                if self.policy.fsync != FSYNC_NONE:
+                    os.fsync(f.fileno())
+                size = f.tell()
+                f.close()
+                os.rename(f.name, self.path + ".state")
+            except Exception as e:
+                os.unlink(f.name)
+                raise e
+        return size
+
+    def _sync_directory(self):
+        """ Syncs the renames of files next to `path` to disk, unless the policy never syncs. """
+        if self.policy.fsync == FSYNC_NONE:
+            return
+        fd = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _remove_old_snapshots(self, current: str):
+        """ Deletes the snapshots of earlier chain states, including those left by a crash. """
+        dirname = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + ".utxo."
+        for name in os.listdir(dirname):
+            if name.startswith(prefix) and name[len(prefix):].isdigit() and name != current:
+                os.unlink(os.path.join(dirname, name))
+
+    def _store_mempool(self, trans: dict, peers: list):
+        started = time.monotonic()
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path), mode="wb", delete=False) as tmpf:
+            try:
+                with TextIOWrapper(gzip.open(tmpf, mode="w")) as f:
+                    for t in trans.values():
+                        f.write(json.dumps({"transaction": t.to_json_compatible()}) + "\n")
+                    for peer in peers:
+                        f.write(json.dumps({"peer": peer}) + "\n")
+                tmpf.flush()
+                if self.policy.fsync != FSYNC_NONE:
+                    os.fsync(tmpf.fileno())
+                size = tmpf.tell()
+                tmpf.close()
+                os.rename(tmpf.name, self.mempool_path)
+            except Exception as e:
+                os.unlink(tmpf.name)
+                raise e
+        self._record_write('mempool', size, started)
 
 from .chainbuilder import ChainBuilder
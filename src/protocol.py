@@ -1,38 +1,105 @@
 """
 Implementation of the P2P protocol.
 
-The protocol is text-based and works over TCP. Once a TCP connection is established, there is no
-difference between server and client. Both sides start by sending a fixed `HELLO_MSG` to make sure
-they speak the same protocol. After that, they can send any number of messages.
-
-Messages start with a length (ending with a new-line), followed by the JSON-encoded contents of
-the message of that length. On the top level, the sent JSON values are always dicts, with a
-'msg_type' key indicating the kind of message and a 'msg_param' key containing a type-specific
-payload.
+The protocol works over TCP. Once a TCP connection is established, there is no difference between
+server and client. Both sides start by sending a fixed `HELLO_MSG` to make sure they speak the same
+protocol, followed by an 'id' message in JSON with an additional 'features' key: a dict of the
+features they support. The 'encodings' feature lists the message encodings of the `wire` module a
+peer understands; both sides then use the most preferred encoding they have in common, or JSON if
+there is none. Likewise, the 'compression' feature lists the supported compression methods; if both
+sides support any, every message is compressed as described in the `wire` module. After that, they
+can send any number of messages.
+
+Peers of earlier versions send the same `HELLO_MSG`, ignore the 'features' key of the 'id' message
+and send a message without it. They are kept as legacy peers (see `PeerConnection.legacy`): we
+only use JSON and none of the features with them, push new blocks and transactions to them instead
+of announcing them, and do not ping them, as they only understand the 'id', 'peer', 'myport',
+'getblock', 'block' and 'transaction' messages.
+
+Messages start with a length (ending with a new-line), followed by the encoded contents of the
+message of that length. On the top level, the sent values are always dicts, with a 'msg_type' key
+indicating the kind of message and a 'msg_param' key containing a type-specific payload. The
+payloads of 'block' and 'transaction' messages are decoded into `Block` and `Transaction` objects
+before they are handed to the protocol's main thread.
 
 To make sure that the peer acting as a TCP server in a connection knows how to reach the TCP client,
 there is a 'myport' message containing the TCP port where a peer listens for incoming connections.
 
+New blocks and transactions are not pushed to peers directly. Instead, their hashes are announced
+in 'inv' messages, and peers that do not have them yet ask for them with a 'getdata' message. Both
+messages map the message types 'block' and 'transaction' to lists of hex-encoded hashes. Each
+`PeerConnection` remembers which objects its peer is known to have, so that nothing is announced
+to a peer twice.
+
+Transactions are announced in batches: each connection collects the hashes of new transactions and
+sends them in one 'inv' message after a random delay of `TRICKLE_INTERVAL` seconds on average, or as
+soon as `MAX_INV_SIZE` hashes are waiting. Peers that announce the 'tx_batches' feature answer a
+'getdata' message for several transactions with 'transactions' messages containing lists of up to
+`MAX_TRANSACTION_BATCH` of them, which the receiver handles in one pass (see `Protocol.trans_batch_receive_handlers`).
+
+Peers that announce the 'compact_blocks' feature get new primary blocks pushed directly as a
+'cmpctblock' message instead: the block with only its coinbase transaction, and short ids for all
+other transactions. The receiver rebuilds the block from the transactions it already knows, and
+asks for the missing ones with a 'getblocktxn' message, which is answered by a 'blocktxn' message.
+The rebuilt block is pre-validated and checked for duplicates in the decoder pool, like a block
+received in full.
+
+Peers that announce the 'notfound' feature answer 'getblock' and 'getdata' requests for blocks and
+transactions they do not have, e.g. because they pruned old blocks, with a 'notfound' message in
+the format of an 'inv' message, so that the requester can ask other peers right away.
+
+Every `PING_INTERVAL`, we send a 'ping' message with a random nonce to each peer, which answers with
+a 'pong' message containing the same nonce. Pings and pongs are handled by the decoder threads,
+and pongs are timed by when they arrived in the event loop, so that the round-trip time does not
+include the time messages wait for the main thread. The round-trip time and other per-peer
+statistics are collected in `PeerStats` and logged every `STATS_LOG_INTERVAL`.
+
+Messages to a peer are queued by priority: control messages first, then blocks, then transactions
+and transaction announcements, then peer addresses. The queued data is bounded by `MAX_QUEUE_BYTES`; see there
+for what happens to peers that exceed it.
+
+All peer addresses we learn of are recorded in an `AddressBook`, together with the quality of our
+past connections to them. Every `RECONNECT_INTERVAL`, we connect to the best known peers until we
+have `OUTGOING_PEERS` outgoing connections (or `max_peers` connections in total).
+
 For other message types, you can look at the `received_*` methods of `Protocol`.
+
+All connections of a `Protocol` are handled by one asyncio event loop running in a background
+thread. Received messages are decoded by a pool of worker threads, which also run the checks of
+blocks and transactions that do not depend on the block chain (see `Protocol._prevalidate`). Only
+messages that pass these checks are passed to the protocol's main thread, where all handlers are
+called. Messages from the same peer are decoded in order. Blocks and transactions that we received
+recently are recorded in `SeenObjects`, so that copies of them from other peers are dropped before
+they are decoded or validated again.
 """
 
+import asyncio
+import hashlib
 import json
 import socket
-import socketserver
 import logging
-from collections import namedtuple
-from threading import Thread, Lock
-from queue import Queue, PriorityQueue
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, deque, namedtuple, OrderedDict
+from datetime import datetime, timedelta
+from threading import Thread, Lock, current_thread
+from queue import PriorityQueue
 from binascii import unhexlify, hexlify
 from uuid import uuid4
-from typing import Callable, List, Optional
+from typing import Callable, List, Optional, Tuple, Union
 
+from .addressbook import AddressBook
 from .blockchain import GENESIS_BLOCK_HASH
+from .crypto import get_hasher
+from .wire import ENCODINGS, JSON_ENCODING, COMPRESSIONS, compress_message, decompress_message, \
+    frame_message, MessageFramer
 
-__all__ = ['Protocol', 'PeerConnection', 'MAX_PEERS', 'HELLO_MSG']
+__all__ = ['Protocol', 'PeerConnection', 'PeerStats', 'SharedMessage', 'SeenObjects', 'MAX_PEERS',
+           'HELLO_MSG']
 
 MAX_PEERS = 10
-""" The maximum number of peers that we connect to."""
+""" The default maximum number of peers that we connect to."""
 
 HELLO_MSG = b"bl0ckch41n" + hexlify(GENESIS_BLOCK_HASH)[:30] + b"\n"
 """
@@ -42,177 +109,925 @@ succeed.
 """
 
 SOCKET_TIMEOUT = 30
-""" The socket timeout for P2P connections. """
+"""
+The timeout for establishing P2P connections, and for receiving the rest of a handshake or message
+once a peer started sending it.
+"""
+
+MAX_KNOWN_INVENTORY = 5000
+""" The number of hashes we remember for each peer as objects the peer already has. """
+
+MAX_SEEN_OBJECTS = 20000
+""" The number of recently received blocks and transactions whose duplicates we recognize. """
+
+MAX_RELAY_CACHE = 500
+""" The number of recently announced blocks and transactions we keep to answer 'getdata' requests. """
+
+MAX_INV_SIZE = 1000
+""" The maximum number of hashes in one 'inv' or 'getdata' message. """
+
+INVENTORY_REQUEST_TIMEOUT = timedelta(seconds=10)
+""" The time after which we ask another peer for an announced object we did not receive. """
+
+SHORT_ID_LENGTH = 6
+""" The number of bytes of the short transaction ids in compact blocks. """
+
+MAX_PENDING_COMPACT_BLOCKS = 20
+""" The number of compact blocks we keep while waiting for their missing transactions. """
+
+OUTGOING_PEERS = 8
+""" The number of outgoing connections we try to maintain, if `max_peers` allows it. """
+
+RECONNECT_INTERVAL = 10
+""" The number of seconds between two attempts to connect to more peers from the address book. """
+
+DECODER_THREADS = 2
+""" The number of worker threads that decode and pre-validate received messages. """
+
+PING_INTERVAL = 60
+""" The number of seconds between two pings we send to each peer. """
+
+STATS_LOG_INTERVAL = 300
+""" The number of seconds between two log lines with the statistics of each peer. """
+
+MAX_FEATURES_LENGTH = 4096
+""" The maximum length of the 'id' message with the features a peer sends after the `HELLO_MSG`. """
+
+MAX_QUEUE_BYTES = 8 * 1024 * 1024
+"""
+The maximum number of bytes waiting to be sent to one peer, including the write buffer of the
+connection. When a peer exceeds it, the queued transaction announcements and peer addresses are
+dropped. A peer that stays over the limit for `QUEUE_LIMIT_TIMEOUT` seconds, or that exceeds twice
+the limit, is disconnected.
+"""
+
+QUEUE_LIMIT_TIMEOUT = 10
+""" The number of seconds a peer may stay over `MAX_QUEUE_BYTES` before it is disconnected. """
+
+MAX_PENDING_ANNOUNCEMENTS = 5000
+"""
+The number of transaction hashes waiting to be announced to a peer. When a peer cannot keep up, the
+oldest ones are dropped first.
+"""
+
+MAX_TRANSACTION_BATCH = 100
+"""
+The maximum number of transactions in one 'transactions' message. Larger batches would be compressed
+with the slower bulk compression and delay the first transactions of a batch.
+"""
+
+TRICKLE_INTERVAL = 0.1
+"""
+The average number of seconds that new transactions wait before they are announced to a peer, so
+that they can be announced together. The actual delays are exponentially distributed and chosen
+independently for each peer, which makes it harder to tell which peer a transaction came from.
+"""
+
+# the priority classes of outgoing messages, highest priority first
+_PRIORITY_CONTROL, _PRIORITY_BLOCK, _PRIORITY_TRANSACTION, _PRIORITY_GOSSIP = range(4)
+_MESSAGE_PRIORITIES = {
+    'block': _PRIORITY_BLOCK,
+    'getblock': _PRIORITY_BLOCK,
+    'cmpctblock': _PRIORITY_BLOCK,
+    'getblocktxn': _PRIORITY_BLOCK,
+    'blocktxn': _PRIORITY_BLOCK,
+    'transaction': _PRIORITY_TRANSACTION,
+    'transactions': _PRIORITY_TRANSACTION,
+    'peer': _PRIORITY_GOSSIP,
+}
+
+
+def _message_priority(msg_type: str, msg_param) -> int:
+    """ Returns the priority class of an outgoing message. """
+    if msg_type in ("inv", "getdata", "notfound"):
+        return _PRIORITY_BLOCK if "block" in msg_param else _PRIORITY_TRANSACTION
+    return _MESSAGE_PRIORITIES.get(msg_type, _PRIORITY_CONTROL)
+
+
+class KnownInventory:
+    """
+    A bounded set of the hashes of objects a peer is known to have. When it is full, the hashes
+    that were added first are forgotten first.
+    """
+
+    def __init__(self, max_size: int = MAX_KNOWN_INVENTORY):
+        self._hashes = OrderedDict()
+        self._max_size = max_size
+        self._lock = Lock()
+
+    def __contains__(self, obj_hash: bytes):
+        return obj_hash in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, obj_hash: bytes) -> bool:
+        """ Adds a hash to the set. Returns whether it was not in the set before. """
+        with self._lock:
+            if obj_hash in self._hashes:
+                return False
+            self._hashes[obj_hash] = None
+            if len(self._hashes) > self._max_size:
+                self._hashes.popitem(last=False)
+            return True
+
+
+class SeenObjects:
+    """
+    A bounded record of the blocks and transactions we received recently, shared by all peer
+    connections. Duplicates are recognized by the digest of the raw message, before it is
+    decompressed and decoded, or by the hash of the decoded object, before it is validated. The
+    least recently seen entries are forgotten first.
+
+    Only objects that passed `Protocol._prevalidate` are recorded by their hash, since an invalid
+    block can have the same hash as a valid one. Invalid messages are recorded by their digest only.
+    Objects we explicitly request again are forgotten, so that the answer is not dropped.
+    """
+
+    def __init__(self, max_size: int = MAX_SEEN_OBJECTS):
+        self._frames = OrderedDict()
+        self._objects = OrderedDict()
+        self._max_size = max_size
+        self._lock = Lock()
+
+    def __contains__(self, obj_hash: bytes):
+        return obj_hash in self._objects
+
+    def __len__(self):
+        return len(self._objects)
+
+    @staticmethod
+    def digest(frame: bytes) -> bytes:
+        """ The digest of a raw message, as used by `frame_seen` and `add`. """
+        return hashlib.sha256(frame).digest()
+
+    def frame_seen(self, digest: bytes) -> 'Optional[Tuple[str, Optional[bytes]]]':
+        """
+        Returns the message type and object hash of a message we received before, or `None`. The
+        object hash is `None` if the message was invalid.
+        """
+        with self._lock:
+            seen = self._frames.get(digest)
+            if seen is None or (seen[1] is not None and seen[1] not in self._objects):
+                return None
+            self._frames.move_to_end(digest)
+            return seen
+
+    def add(self, msg_type: str, obj_hash: 'Optional[bytes]', digest: 'Optional[bytes]'):
+        """
+        Records a received message and, if it is valid, the hash of the object it contained. The
+        digest is `None` for objects that were received as part of a batch.
+        """
+        with self._lock:
+            if digest is not None:
+                self._frames[digest] = (msg_type, obj_hash)
+                self._frames.move_to_end(digest)
+                if len(self._frames) > self._max_size:
+                    self._frames.popitem(last=False)
+            if obj_hash is not None:
+                self._objects[obj_hash] = None
+                self._objects.move_to_end(obj_hash)
+                if len(self._objects) > self._max_size:
+                    self._objects.popitem(last=False)
+
+    def forget(self, obj_hash: bytes):
+        """ Makes sure that the next copy of an object we receive is not dropped as a duplicate. """
+        with self._lock:
+            self._objects.pop(obj_hash, None)
+
+
+class PeerStats:
+    """
+    Traffic and latency statistics of one peer connection.
+
+    :ivar sent_messages: The number of messages sent, by message type.
+    :vartype sent_messages: Counter
+    :ivar sent_bytes: The number of encoded bytes sent, by message type, without framing.
+    :vartype sent_bytes: Counter
+    :ivar received_messages: The number of messages received, by message type.
+    :vartype received_messages: Counter
+    :ivar received_bytes: The number of encoded bytes received, by message type, without framing.
+    :vartype received_bytes: Counter
+    :ivar encode_time: The total number of seconds spent encoding messages for this peer.
+    :vartype encode_time: float
+    :ivar decode_time: The total number of seconds spent decoding messages from this peer.
+    :vartype decode_time: float
+    :ivar ping_rtt: The round-trip time of the last answered ping in seconds, if any.
+    :vartype ping_rtt: Optional[float]
+    :ivar last_received: The `time.monotonic` time when we last received a message.
+    :vartype last_received: Optional[float]
+    :ivar connected_at: The `time.monotonic` time when the handshake was completed, if it was.
+    :vartype connected_at: Optional[float]
+    :ivar dropped: The number of queued messages that were dropped because the peer did not keep
+                   up, by message type. For 'inv', this counts announced hashes.
+    :vartype dropped: Counter
+    :ivar max_queued_bytes: The largest number of bytes that were waiting to be sent at once.
+    :vartype max_queued_bytes: int
+    :ivar write_pauses: How often the write buffer of the connection filled up.
+    :vartype write_pauses: int
+    :ivar paused_time: The total number of seconds the write buffer of the connection was full.
+    :vartype paused_time: float
+    :ivar duplicates: The number of received blocks and transactions that we had seen before, by
+                      message type. Their messages are also counted in `received_messages`.
+    :vartype duplicates: Counter
+    """
+
+    def __init__(self):
+        self.sent_messages = Counter()
+        self.sent_bytes = Counter()
+        self.received_messages = Counter()
+        self.received_bytes = Counter()
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.ping_rtt = None
+        self.last_received = None
+        self.connected_at = None
+        self.dropped = Counter()
+        self.max_queued_bytes = 0
+        self.write_pauses = 0
+        self.paused_time = 0.0
+        self.duplicates = Counter()
+        self._ping_nonce = None
+        self._ping_sent = None
+        self._paused_at = None
+
+    def message_sent(self, msg_type: str, size: int, encode_time: float):
+        self.sent_messages[msg_type] += 1
+        self.sent_bytes[msg_type] += size
+        self.encode_time += encode_time
+
+    def message_received(self, msg_type: str, size: int, decode_time: float):
+        self.received_messages[msg_type] += 1
+        self.received_bytes[msg_type] += size
+        self.decode_time += decode_time
+        self.last_received = time.monotonic()
+
+    def messages_dropped(self, msg_type: str, count: int):
+        self.dropped[msg_type] += count
+
+    def queue_size(self, queued_bytes: int):
+        self.max_queued_bytes = max(self.max_queued_bytes, queued_bytes)
+
+    def write_paused(self):
+        self.write_pauses += 1
+        self._paused_at = time.monotonic()
+
+    def write_resumed(self):
+        if self._paused_at is not None:
+            self.paused_time += time.monotonic() - self._paused_at
+            self._paused_at = None
+
+    def ping_sent(self) -> int:
+        """ Returns the nonce for a new ping. """
+        self._ping_nonce = random.getrandbits(63)
+        self._ping_sent = time.monotonic()
+        return self._ping_nonce
+
+    def pong_received(self, nonce: int, received_at: 'Optional[float]' = None):
+        """ Records the round-trip time of our last ping, if `nonce` answers it. """
+        if nonce == self._ping_nonce:
+            self.ping_rtt = (received_at or time.monotonic()) - self._ping_sent
+            self._ping_nonce = None
+
+    def throughput(self) -> 'Optional[float]':
+        """ The average number of bytes per second we received since the handshake. """
+        if self.connected_at is None:
+            return None
+        return sum(self.received_bytes.values()) / max(time.monotonic() - self.connected_at, 1)
+
+    def to_json_compatible(self):
+        """ Returns a JSON-serializable representation of this object. """
+        val = {}
+        val['sent'] = {t: {'messages': n, 'bytes': self.sent_bytes[t]}
+                       for (t, n) in list(self.sent_messages.items())}
+        val['received'] = {t: {'messages': n, 'bytes': self.received_bytes[t]}
+                           for (t, n) in list(self.received_messages.items())}
+        val['encode_time'] = self.encode_time
+        val['decode_time'] = self.decode_time
+        val['ping_rtt'] = self.ping_rtt
+        val['seconds_since_last_message'] = None if self.last_received is None else \
+            time.monotonic() - self.last_received
+        val['dropped'] = dict(self.dropped)
+        val['max_queued_bytes'] = self.max_queued_bytes
+        val['write_pauses'] = self.write_pauses
+        val['paused_time'] = self.paused_time
+        val['duplicates'] = dict(self.duplicates)
+        if self._paused_at is not None:
+            val['paused_time'] += time.monotonic() - self._paused_at
+        return val
+
+
+class SharedMessage:
+    """
+    A message that is sent to several peers. It is encoded only once for each combination of
+    encoding and compression methods among the connections it is sent on, and all of these
+    connections write the same immutable frame.
+
+    Frames are only created in the event loop, so no locking is necessary.
+    """
+
+    def __init__(self, msg_type: str, msg_param):
+        self.msg_type = msg_type
+        self.msg_param = msg_param
+        self._frames = {}
 
+    def frame(self, encoding: str, compressions: 'List[str]') -> 'Tuple[bytes, int]':
+        """ Returns the framed message and its encoded size, as returned by `_encode_frame`. """
+        key = (encoding, tuple(compressions))
+        frame = self._frames.get(key)
+        if frame is None:
+            msg = {'msg_type': self.msg_type, 'msg_param': self.msg_param}
+            frame = self._frames[key] = _encode_frame(msg, encoding, compressions)
+        return frame
 
-class PeerConnection:
+
+def _encode_frame(msg: dict, encoding: str, compressions: 'List[str]') -> 'Tuple[bytes, int]':
+    """ Encodes, compresses and frames a message. Returns the frame and the encoded size. """
+    data = ENCODINGS[encoding][0](msg)
+    if compressions:
+        flag, data = compress_message(data, compressions)
+        return b"%d\n%s%s" % (len(data) + 1, flag, data), len(data) + 1
+    return frame_message(data), len(data)
+
+
+class PeerConnection(asyncio.BufferedProtocol):
     """
-    Handles the low-level socket connection to one other peer.
+    Handles the low-level connection to one other peer.
+
+    All network I/O happens in the event loop of the protocol; the methods that may be called from
+    other threads are `send_msg`, `send_shared`, `announce`, `send_peers` and `close`. Messages
+    sent from other threads are handed to the event loop in `outgoing_msgs`, which encodes them
+    into one send queue per priority class and writes them while the write buffer of the
+    connection has room.
 
     :ivar peer_addr: The self-reported address one can use to connect to this peer.
-    :ivar param: The self-reported address one can use to connect to this peer.
     :ivar _sock_addr: The address our socket is or will be connected to.
-    :ivar socket: The socket object we use to communicate with our peer.
-    :param sock: A socket object we should use to communicate with our peer.
+    :ivar _dial_addr: The address we connected to, or `None` for incoming connections.
     :ivar proto: The Protocol instance this peer connection belongs to.
     :ivar is_connected: A boolean indicating the current connection status.
-    :ivar outgoing_msgs: A queue of messages we want to send to this peer.
+    :ivar outgoing_msgs: Messages we want to send to this peer, waiting for the event loop.
+    :vartype outgoing_msgs: Deque[Union[dict, SharedMessage]]
+    :ivar _send_queues: The encoded messages waiting to be written, one queue per priority class.
+                        The entries are tuples of frame, message type, encoded size and encoding
+                        time.
+    :ivar _pending_announcements: Transaction hashes to announce in the next 'inv' message. Guarded
+                                  by `_announce_lock`.
+    :ivar _announcements_due: Whether the pending announcements are written with the next messages,
+                              because their delay expired or they fill an 'inv' message.
+    :ivar encoding: The name of the message encoding used on this connection.
+    :ivar compressions: The compression methods both sides of this connection support.
+    :vartype compressions: List[str]
+    :ivar known_inventory: The hashes of blocks and transactions this peer is known to have.
+    :vartype known_inventory: KnownInventory
+    :ivar compact_blocks: Whether this peer wants new blocks to be sent as compact blocks.
+    :vartype compact_blocks: bool
+    :ivar tx_batches: Whether this peer understands 'transactions' messages.
+    :vartype tx_batches: bool
+    :ivar notfound: Whether this peer understands 'notfound' messages.
+    :vartype notfound: bool
+    :ivar legacy: Whether this peer runs an earlier version of the protocol without features.
+    :vartype legacy: bool
+    :ivar stats: The traffic and latency statistics of this connection.
+    :vartype stats: PeerStats
     """
 
-    def __init__(self, peer_addr: tuple, proto: 'Protocol', sock: socket.socket = None):
+    def __init__(self, peer_addr: tuple, proto: 'Protocol', incoming: bool = False):
+        """
+        :param peer_addr: The address to connect to, or the address of an incoming connection.
+        :param proto: The Protocol instance this peer connection belongs to.
+        :param incoming: Whether the peer connected to us. Otherwise, we connect to `peer_addr`.
+        """
         self.peer_addr = None
         self._sock_addr = peer_addr
-        self.socket = sock
+        self._dial_addr = None if incoming else tuple(peer_addr)
         self.proto = proto
         self.is_connected = False
         self._sent_uuid = str(uuid4())
-        self.outgoing_msgs = Queue()
+        self.outgoing_msgs = deque()
+        self.encoding = JSON_ENCODING
+        self.compressions = []
+        self.known_inventory = KnownInventory()
+        self.compact_blocks = False
+        self.tx_batches = False
+        self.notfound = False
+        self.legacy = False
+        self.stats = PeerStats()
+        self._transport = None
+        self._framer = MessageFramer()
+        self._got_hello = False
+        self._decode = None
+        self._closed = False
         self._close_lock = Lock()
+        self._flush_scheduled = False
+        self._last_read = 0
+        self._timeout_handle = None
+        self._received_frames = deque()
+        self._decoding = False
+        self._decode_lock = Lock()
+        self._send_queues = [deque() for _ in range(_PRIORITY_GOSSIP + 1)]
+        self._pending_announcements = OrderedDict()
+        self._announce_lock = Lock()
+        self._trickle_handle = None
+        self._announcements_due = False
+        self._queued_bytes = 0
+        self._write_paused = False
+        self._over_limit_handle = None
+
+        if not incoming:
+            proto.address_book.connection_attempted(self._dial_addr)
+            asyncio.run_coroutine_threadsafe(self._connect(), proto._loop)
+
+    async def _connect(self):
+        """ Creates an outgoing connection to the peer. """
+        logging.info("connecting to peer %s", repr(self._sock_addr))
+        try:
+            await asyncio.wait_for(self.proto._loop.create_connection(lambda: self, *self._sock_addr),
+                                   SOCKET_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.info("could not connect to peer %s: %s", repr(self._sock_addr), e)
+            self.close()
 
-        Thread(target=self.run, daemon=True).start()
+    def connection_made(self, transport: asyncio.Transport):
+        """ Starts the handshake once the TCP connection is established. """
+        self._transport = transport
+        self._sock_addr = transport.get_extra_info('peername')
+        if self._closed:
+            transport.close()
+            return
 
-    def send_peers(self):
-        """ Sends all known peers to this peer. """
-        logging.debug("%s > peer *", self.peer_addr)
-        for peer in self.proto.peers:
-            if peer.peer_addr is not None:
-                self.send_msg("peer", list(peer.peer_addr))
+        features = {'encodings': list(ENCODINGS), 'compression': COMPRESSIONS, 'compact_blocks': True,
+                    'tx_batches': True, 'notfound': True}
+        msg = {'msg_type': "id", 'msg_param': self._sent_uuid, 'features': features}
+        transport.write(HELLO_MSG + _encode_frame(msg, JSON_ENCODING, [])[0])
+        self._last_read = self.proto._loop.time()
+        self._timeout_handle = self.proto._loop.call_later(SOCKET_TIMEOUT, self._check_timeout)
 
-    def run(self):
+    def _handshake(self) -> bool:
+        """
+        Checks the `HELLO_MSG` of our peer and picks the encoding to use from the features it sent
+        with its first message, which is then passed to the protocol. Returns whether the handshake
+        is complete.
         """
-        Creates a connection, handles the handshake, then hands off to the reader and writer threads.
+        if not self._got_hello:
+            hello = self._framer.read_line(len(HELLO_MSG))
+            if hello is None:
+                return False
+            if hello != HELLO_MSG:
+                raise ValueError("peer talks a different protocol")
+            self._got_hello = True
+
+        frame = self._framer.read_message(MAX_FEATURES_LENGTH)
+        if frame is None:
+            return False
+        first_msg = json.loads(frame.decode())
+        msg_type, msg_param = first_msg['msg_type'], first_msg['msg_param']
+        features = first_msg.get('features')
+        if features is None:
+            # an earlier version of the protocol; this is a regular message
+            self.legacy = True
+            features = {}
+        elif not isinstance(features, dict):
+            raise ValueError("invalid features")
+        if msg_type in _OBJECT_MESSAGES:
+            msg_param = _to_object(_OBJECT_MESSAGES[msg_type], msg_param)
+            if not self.proto._prevalidate(msg_type, msg_param):
+                raise ValueError("invalid {} message".format(msg_type))
+
+        self.compact_blocks = features.get('compact_blocks') is True
+        self.tx_batches = features.get('tx_batches') is True
+        self.notfound = features.get('notfound') is True
+        self.compressions = [c for c in COMPRESSIONS if c in features.get('compression', [])]
+        peer_encodings = features.get('encodings', [])
+        self.encoding = next((e for e in ENCODINGS if e in peer_encodings), JSON_ENCODING)
+        self._decode = ENCODINGS[self.encoding][1]
+        logging.debug("using encoding %s and compression %s with %speer %s", self.encoding,
+                      self.compressions, "legacy " if self.legacy else "", repr(self._sock_addr))
 
-        Does not return until the writer thread does.
+        self.is_connected = True
+        self.stats.connected_at = time.monotonic()
+        if self._dial_addr is not None:
+            self.proto.address_book.connection_succeeded(self._dial_addr)
+        self.proto.received(msg_type, msg_param, self)
+        self.send_msg("myport", self.proto.server_address[1])
+        if self.legacy:
+            self.known_inventory.add(self.proto._primary_block.hash)
+            self.send_msg("block", self.proto._primary_block)
+        else:
+            self.announce("block", self.proto._primary_block.hash)
+        self.send_peers()
+        return True
+
+    def _check_timeout(self):
+        """
+        Closes the connection if the handshake or a message has not been completed within
+        `SOCKET_TIMEOUT` of the last data we received.
         """
+        self._timeout_handle = None
+        if self._closed or (self.is_connected and not self._framer.has_partial_message):
+            return
+        remaining = self._last_read + SOCKET_TIMEOUT - self.proto._loop.time()
+        if remaining <= 0:
+            logging.warning("peer %s timed out", repr(self._sock_addr))
+            self.close()
+        else:
+            self._timeout_handle = self.proto._loop.call_later(remaining, self._check_timeout)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        """ Passes all complete messages we received to the protocol to handle. """
+        self._framer.buffer_updated(nbytes)
+        self._last_read = self.proto._loop.time()
         try:
-            if self.socket is None:
-                logging.info("connecting to peer %s", repr(self._sock_addr))
-                self.socket = socket.create_connection(self._sock_addr, SOCKET_TIMEOUT)
-            else:
-                self.socket.settimeout(SOCKET_TIMEOUT)
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self.socket.sendall(HELLO_MSG)
-            if self.socket.recv(len(HELLO_MSG)) != HELLO_MSG:
-                raise OSError("peer talks a different protocol")
-        except OSError as e:
-            self.proto.received("disconnected", None, self)
-            if self.socket is not None:
-                self.socket.close()
-            raise e
-        self.is_connected = True
+            if not self.is_connected and not self._handshake():
+                return
 
-        self.send_msg("myport", self.proto.server.server_address[1])
-        self.send_msg("block", self.proto._primary_block)
-        self.send_msg("id", self._sent_uuid)
-        self.send_peers()
+            frames = self._framer.take_messages()
+        except Exception:
+            logging.exception("invalid data from peer %s", repr(self._sock_addr))
+            self.close()
+            return
 
-        Thread(target=self.reader_thread, daemon=True).start()
-        self.writer_thread()
+        if frames:
+            received_at = time.monotonic()
+            with self._decode_lock:
+                self._received_frames.extend((frame, received_at) for frame in frames)
+                start_decoder = not self._decoding
+                self._decoding = True
+            if start_decoder:
+                self.proto._decoder_pool.submit(self._decoder_job)
 
-    def close_on_error(fn: Callable):
-        """ A decorator that closes both threads if one dies. """
+        if self._framer.has_partial_message and self._timeout_handle is None:
+            self._timeout_handle = self.proto._loop.call_later(SOCKET_TIMEOUT, self._check_timeout)
+
+    def _decoder_job(self):
+        """
+        Decodes and pre-validates the messages we received, in the order we received them, and
+        passes them to the protocol. Runs in the decoder pool of the protocol.
+
+        Blocks and transactions we have seen before are dropped, but remembered as known to the peer.
+        """
+        seen_objects = self.proto._seen_objects
+        while True:
+            with self._decode_lock:
+                if not self._received_frames or self._closed:
+                    self._received_frames.clear()
+                    self._decoding = False
+                    return
+                buf, received_at = self._received_frames.popleft()
 
-        def wrapper(self, *args, **kwargs):
             try:
-                fn(self, *args, **kwargs)
+                start = time.perf_counter()
+                digest = seen_objects.digest(buf)
+                seen = seen_objects.frame_seen(digest)
+                if seen is not None:
+                    msg_type, obj_hash = seen
+                    self.stats.message_received(msg_type, len(buf), time.perf_counter() - start)
+                    if obj_hash is not None:
+                        self.stats.duplicates[msg_type] += 1
+                        self.known_inventory.add(obj_hash)
+                    continue
+
+                obj = self._decode(decompress_message(buf) if self.compressions else buf)
+                msg_type, msg_param = obj['msg_type'], obj['msg_param']
+                obj_hash = None
+                duplicate = False
+                if msg_type == "transactions":
+                    msg_param = self._new_transactions(msg_param)
+                    valid = True
+                else:
+                    if msg_type in _OBJECT_MESSAGES:
+                        msg_param = _to_object(_OBJECT_MESSAGES[msg_type], msg_param)
+                        obj_hash = msg_param.hash if msg_type == "block" else msg_param.get_hash()
+                    duplicate = obj_hash is not None and obj_hash in seen_objects
+                    valid = duplicate or self.proto._prevalidate(msg_type, msg_param)
+                self.stats.message_received(msg_type, len(buf), time.perf_counter() - start)
             except Exception:
-                logging.exception("exception in reader/writer thread")
+                logging.exception("invalid data from peer %s", repr(self._sock_addr))
+                self.close()
+                continue
+
+            if msg_type == "transactions":
+                if msg_param:
+                    self.proto.received(msg_type, msg_param, self)
+                continue
+            if msg_type == "ping":
+                # answered here, so that the round-trip time does not include the main thread's backlog
+                self.send_msg("pong", msg_param)
+                continue
+            if msg_type == "pong":
+                self.stats.pong_received(msg_param, received_at)
+                logging.debug("%s < pong, rtt %s", self.peer_addr, self.stats.ping_rtt)
+                continue
+
+            if obj_hash is not None:
+                seen_objects.add(msg_type, obj_hash if valid else None, digest)
+            if duplicate:
+                self.stats.duplicates[msg_type] += 1
+                self.known_inventory.add(obj_hash)
+            elif valid:
+                self.proto.received(msg_type, msg_param, self)
+            else:
+                logging.warning("%s < invalid %s", self.peer_addr, msg_type)
 
-            self.close()
+    def _new_transactions(self, transactions: list) -> 'List[Transaction]':
+        """
+        Decodes and pre-validates the transactions of a 'transactions' message. Returns those we
+        have not seen before; invalid ones are skipped.
+        """
+        if len(transactions) > MAX_TRANSACTION_BATCH:
+            raise ValueError("too many transactions in one message")
+        seen_objects = self.proto._seen_objects
+        new = []
+        for trans in transactions:
+            trans = _to_object(Transaction, trans)
+            trans_hash = trans.get_hash()
+            if trans_hash in seen_objects:
+                self.stats.duplicates["transaction"] += 1
+                self.known_inventory.add(trans_hash)
+            elif self.proto._prevalidate("transaction", trans):
+                seen_objects.add("transaction", trans_hash, None)
+                new.append(trans)
+            else:
+                logging.warning("%s < invalid transaction", self.peer_addr)
+        return new
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if exc is not None:
+            logging.info("lost connection to peer %s: %s", repr(self._sock_addr), exc)
+        self.close()
+
+    def send_ping(self):
+        """ Sends a ping to this peer, to measure the round-trip time. """
+        if self.is_connected and not self.legacy:
+            self.send_msg("ping", self.stats.ping_sent())
+
+    def stats_to_json_compatible(self):
+        """ Returns the statistics of this connection in a JSON-serializable representation. """
+        val = self.stats.to_json_compatible()
+        val['address'] = list(self.peer_addr or self._sock_addr or [])[:2]
+        val['encoding'] = self.encoding
+        val['queued_messages'] = len(self.outgoing_msgs) + sum(len(q) for q in self._send_queues)
+        val['pending_announcements'] = len(self._pending_announcements)
+        transport = self._transport
+        val['write_buffer_bytes'] = transport.get_write_buffer_size() if transport is not None else 0
+        val['queued_bytes'] = self._queued_bytes + val['write_buffer_bytes']
+        return val
+
+    @property
+    def queued_bytes(self) -> int:
+        """ The number of bytes waiting to be sent to this peer, including the write buffer. """
+        transport = self._transport
+        return self._queued_bytes + (transport.get_write_buffer_size() if transport is not None else 0)
 
-        return wrapper
+    def send_peers(self):
+        """ Sends all known peers to this peer. """
+        logging.debug("%s > peer *", self.peer_addr)
+        for peer in self.proto.peers:
+            if peer.peer_addr is not None:
+                self.send_msg("peer", list(peer.peer_addr))
+
+    def announce(self, msg_type: str, obj_hash: bytes, inv: 'Optional[SharedMessage]' = None):
+        """
+        Announces a block or transaction to this peer, unless it is known to have it already.
+        Blocks are announced right away, transactions in batches (see `TRICKLE_INTERVAL`). Legacy
+        peers get the block or transaction itself, if we relay it.
+
+        :param inv: The 'inv' message for a block, if it is shared with other peers.
+        """
+        if not self.is_connected or not self.known_inventory.add(obj_hash):
+            return
+        if self.legacy:
+            obj = self.proto._find_relayed(obj_hash)
+            if isinstance(obj, SharedMessage):
+                self.send_shared(obj)
+            elif obj is not None:
+                self.send_msg(msg_type, obj)
+            return
+        if msg_type == "transaction":
+            self._add_announcements([hexlify(obj_hash).decode()])
+            return
+        if inv is None:
+            inv = SharedMessage("inv", {msg_type: [hexlify(obj_hash).decode()]})
+        self.send_shared(inv)
+
+    def _add_announcements(self, tx_hashes: 'List[str]'):
+        """ Adds hex-encoded transaction hashes to the next 'inv' message for this peer. """
+        with self._announce_lock:
+            pending = self._pending_announcements
+            was_empty = not pending
+            for tx_hash in tx_hashes:
+                pending[tx_hash] = None
+            excess = len(pending) - MAX_PENDING_ANNOUNCEMENTS
+            for _ in range(excess):
+                pending.popitem(last=False)
+            became_full = len(pending) >= MAX_INV_SIZE > len(pending) - len(tx_hashes)
+        if excess > 0:
+            self.stats.messages_dropped("inv", excess)
+        if was_empty or became_full:
+            self.proto._loop.call_soon_threadsafe(self._schedule_announcements)
+
+    def _schedule_announcements(self):
+        """ Sends the pending announcements when they fill an 'inv' message, or after a delay. """
+        if len(self._pending_announcements) >= MAX_INV_SIZE:
+            self._send_announcements()
+        elif self._trickle_handle is None and self._pending_announcements:
+            self._trickle_handle = self.proto._loop.call_later(
+                random.expovariate(1 / TRICKLE_INTERVAL), self._send_announcements)
+
+    def _send_announcements(self):
+        if self._trickle_handle is not None:
+            self._trickle_handle.cancel()
+            self._trickle_handle = None
+        self._announcements_due = True
+        if self.is_connected:
+            self._write_queued()
+            self._check_queue_limit()
 
     def close(self):
         """ Closes the connection to this peer. """
 
         with self._close_lock:
-            if not self.is_connected:
+            if self._closed:
                 return
+            self._closed = True
 
+        if self.is_connected:
             logging.info("closing connection to peer %s", self._sock_addr)
-
-            while not self.outgoing_msgs.empty():
-                self.outgoing_msgs.get_nowait()
-            self.outgoing_msgs.put(None)
-            self.is_connected = False
-            self.proto.received("disconnected", None, self, 3)
-
-            self.socket.close()
+        self.is_connected = False
+        self.outgoing_msgs.clear()
+        self.proto.received("disconnected", None, self, 3)
+        if not self.proto._loop.is_closed():
+            self.proto._loop.call_soon_threadsafe(self._close_transport)
+
+    def _close_transport(self):
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+        if self._over_limit_handle is not None:
+            self._over_limit_handle.cancel()
+            self._over_limit_handle = None
+        if self._trickle_handle is not None:
+            self._trickle_handle.cancel()
+            self._trickle_handle = None
+        for queue in self._send_queues:
+            queue.clear()
+        with self._announce_lock:
+            self._pending_announcements.clear()
+        self._announcements_due = False
+        self._queued_bytes = 0
+        if self._transport is not None:
+            self._transport.close()
 
     def send_msg(self, msg_type: str, msg_param):
         """
         Sends a message to this peer.
 
         :msg_type: The type of message.
-        :msg_param: the JSON-compatible parameter of this message
+        :msg_param: the parameter of this message
         """
 
         if not self.is_connected:
             return
-        self.outgoing_msgs.put({'msg_type': msg_type, 'msg_param': msg_param})
-
-    @close_on_error
-    def writer_thread(self):
-        """ The writer thread takes messages from our message queue and sends them to the peer. """
-        while True:
-            item = self.outgoing_msgs.get()
-            if item is None:
-                break
-            data = json.dumps(item, indent=4).encode() + b"\n"
-            self.socket.sendall(str(len(data)).encode() + b"\n" + data)
-            self.outgoing_msgs.task_done()
-
-    @close_on_error
-    def reader_thread(self):
-        """
-        The reader thread reads messages from the socket and passes them to the protocol to handle.
-        """
-        while True:
-            buf = b""
-            while not buf or buf[-1] != ord('\n'):
-                try:
-                    tmp = self.socket.recv(1)
-                except socket.timeout as e:
-                    if buf:
-                        raise e
-                    continue
-
-                if not tmp:
-                    return
-                buf += tmp
-            length = int(buf)
-            buf = bytearray(length)
-            read = 0
-            while length > read:
-                tmp = self.socket.recv_into(memoryview(buf)[read:])
-                if not tmp:
-                    return
-                read += tmp
-
-            obj = json.loads(buf.decode())
-            msg_type = obj['msg_type']
-            msg_param = obj['msg_param']
-
-            self.proto.received(msg_type, msg_param, self)
+        self._queue({'msg_type': msg_type, 'msg_param': msg_param})
 
+    def send_shared(self, message: SharedMessage):
+        """ Sends a message to this peer that is also sent to other peers. """
+        if not self.is_connected:
+            return
+        self._queue(message)
 
-class SocketServer(socketserver.TCPServer):
-    """ A TCP socketserver that does not close connections when the handler returns. """
+    def _queue(self, item: 'Union[dict, SharedMessage]'):
+        self.outgoing_msgs.append(item)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.proto._loop.call_soon_threadsafe(self._flush)
 
-    allow_reuse_address = True
-    """ Make sure the server can be restarted without delays. """
+    def _flush(self):
+        """ Moves all messages from `outgoing_msgs` to the send queues and writes what fits. """
+        self._flush_scheduled = False
+        if not self.is_connected:
+            return
+        while self.outgoing_msgs:
+            self._enqueue(self.outgoing_msgs.popleft())
+        self._write_queued()
+        self._check_queue_limit()
+
+    def _enqueue(self, item: 'Union[dict, SharedMessage]'):
+        """ Encodes a message into the send queue of its priority class. """
+        if isinstance(item, SharedMessage):
+            msg_type, msg_param = item.msg_type, item.msg_param
+        else:
+            msg_type, msg_param = item['msg_type'], item['msg_param']
+
+        if msg_type == "inv" and list(msg_param) == ["transaction"]:
+            self._add_announcements(msg_param["transaction"])
+            return
 
-    def serve_forever_bg(self):
-        """ Runs the server forever in a background thread. """
+        start = time.perf_counter()
+        if isinstance(item, SharedMessage):
+            frame, size = item.frame(self.encoding, self.compressions)
+        else:
+            frame, size = _encode_frame(item, self.encoding, self.compressions)
+        entry = (frame, msg_type, size, time.perf_counter() - start)
+        self._send_queues[_message_priority(msg_type, msg_param)].append(entry)
+        self._queued_bytes += len(frame)
 
-        logging.info("listening on %s", self.server_address)
-        Thread(target=self.serve_forever, daemon=True).start()
+    def _next_queued(self) -> 'Optional[Tuple[bytes, str, int, float]]':
+        """
+        Removes and returns the send queue entry with the highest priority. Pending transaction
+        announcements are only written once they are due (see `_send_announcements`).
+        """
+        for priority, queue in enumerate(self._send_queues):
+            if priority == _PRIORITY_GOSSIP and self._announcements_due:
+                hashes = []
+                with self._announce_lock:
+                    while self._pending_announcements and len(hashes) < MAX_INV_SIZE:
+                        hashes.append(self._pending_announcements.popitem(last=False)[0])
+                    if not self._pending_announcements:
+                        self._announcements_due = False
+                if hashes:
+                    start = time.perf_counter()
+                    msg = {'msg_type': "inv", 'msg_param': {"transaction": hashes}}
+                    frame, size = _encode_frame(msg, self.encoding, self.compressions)
+                    return frame, "inv", size, time.perf_counter() - start
+            if queue:
+                entry = queue.popleft()
+                self._queued_bytes -= len(entry[0])
+                return entry
+        return None
+
+    def _write_queued(self):
+        """ Writes queued messages by priority, until the write buffer of the connection is full. """
+        high_water = self._transport.get_write_buffer_limits()[1]
+        while self.is_connected and not self._write_paused:
+            room = high_water - self._transport.get_write_buffer_size()
+            batch = []
+            while room > 0 or not batch:
+                entry = self._next_queued()
+                if entry is None:
+                    break
+                frame, msg_type, size, encode_time = entry
+                self.stats.message_sent(msg_type, size, encode_time)
+                batch.append(frame)
+                room -= len(frame)
+            if not batch:
+                return
+            self._transport.writelines(batch)
+
+    def _check_queue_limit(self):
+        """ Enforces `MAX_QUEUE_BYTES` after messages were queued or written. """
+        queued = self.queued_bytes
+        self.stats.queue_size(queued)
+        if queued > MAX_QUEUE_BYTES:
+            self._drop_queued()
+            queued = self.queued_bytes
+        if queued > 2 * MAX_QUEUE_BYTES:
+            logging.warning("peer %s does not keep up with %d queued bytes: disconnecting",
+                            repr(self._sock_addr), queued)
+            self.close()
+        elif queued > MAX_QUEUE_BYTES:
+            if self._over_limit_handle is None:
+                self._over_limit_handle = self.proto._loop.call_later(QUEUE_LIMIT_TIMEOUT,
+                                                                      self._queue_limit_expired)
+        elif self._over_limit_handle is not None:
+            self._over_limit_handle.cancel()
+            self._over_limit_handle = None
+
+    def _drop_queued(self):
+        """ Drops the queued transaction announcements and peer addresses. """
+        with self._announce_lock:
+            dropped = len(self._pending_announcements)
+            self._pending_announcements.clear()
+        if dropped:
+            self.stats.messages_dropped("inv", dropped)
+        for priority, droppable in ((_PRIORITY_TRANSACTION, "inv"), (_PRIORITY_GOSSIP, "peer")):
+            queue = self._send_queues[priority]
+            kept = deque(entry for entry in queue if entry[1] != droppable)
+            if len(kept) < len(queue):
+                self.stats.messages_dropped(droppable, len(queue) - len(kept))
+                self._queued_bytes -= sum(len(e[0]) for e in queue if e[1] == droppable)
+                self._send_queues[priority] = kept
+
+    def _queue_limit_expired(self):
+        self._over_limit_handle = None
+        if self.is_connected and self.queued_bytes > MAX_QUEUE_BYTES:
+            logging.warning("peer %s stayed over the queue limit: disconnecting", repr(self._sock_addr))
+            self.close()
 
-    def close_request(self, request):
-        pass
+    def pause_writing(self):
+        """ Called by the event loop when the write buffer of the connection is full. """
+        self._write_paused = True
+        self.stats.write_paused()
 
-    def shutdown_request(self, request):
-        pass
+    def resume_writing(self):
+        """ Called by the event loop when the write buffer of the connection has room again. """
+        self._write_paused = False
+        self.stats.write_resumed()
+        if self.is_connected:
+            self._write_queued()
+            self._check_queue_limit()
 
 
 class Protocol:
@@ -224,10 +1039,26 @@ class Protocol:
     :vartype block_receive_handlers: List[Callable]
     :ivar trans_receive_handlers: Event handlers that get called when a new transaction is received.
     :vartype trans_receive_handlers: List[Callable]
+    :ivar trans_batch_receive_handlers: Event handlers that get called with a list of transactions
+                                        that were received together. They get all transactions,
+                                        including those passed to `trans_receive_handlers`.
+    :vartype trans_batch_receive_handlers: List[Callable]
     :ivar block_request_handlers: Event handlers that get called when a block request is received.
     :vartype block_request_handlers: List[Callable]
+    :ivar transaction_request_handlers: Event handlers that get called when a transaction request is
+                                        received.
+    :vartype transaction_request_handlers: List[Callable]
+    :ivar transaction_pool_handlers: Event handlers that return the unconfirmed transactions we
+                                     know of, to rebuild compact blocks.
+    :vartype transaction_pool_handlers: List[Callable]
     :ivar peers: The peers we are connected to.
     :vartype peers: List[PeerConnection]
+    :ivar max_peers: The maximum number of peers that we connect to.
+    :vartype max_peers: int
+    :ivar server_address: The address where we listen for incoming connections.
+    :vartype server_address: tuple
+    :ivar address_book: The addresses of all peers we know of.
+    :vartype address_book: AddressBook
     """
 
     _dummy_peer = namedtuple("DummyPeerConnection", ["peer_addr"])("self")
@@ -236,75 +1067,233 @@ class Protocol:
     """
 
     def __init__(self, bootstrap_peers: 'List[tuple]',
-                 primary_block: 'Block', listen_port: int = 0, listen_addr: str = ""):
+                 primary_block: 'Block', listen_port: int = 0, listen_addr: str = "",
+                 max_peers: int = MAX_PEERS, address_book: 'Optional[AddressBook]' = None):
         """
         :param bootstrap_peers: network addresses of peers where we bootstrap the P2P network from
         :param primary_block: the head of the primary block chain
         :param listen_port: the port where other peers should be able to reach us
         :param listen_addr: the address where other peers should be able to reach us
+        :param max_peers: the maximum number of peers that we connect to
+        :param address_book: the known peer addresses; an empty address book is used by default
         """
 
         self.block_receive_handlers = []
         self.trans_receive_handlers = []
+        self.trans_batch_receive_handlers = []
         self.opening_receive_handlers = []
         self.block_request_handlers = []
-        self._primary_block = primary_block.to_json_compatible()
+        self.transaction_request_handlers = []
+        self.transaction_pool_handlers = []
+        self._primary_block = primary_block
+        self._relay_cache = OrderedDict()
+        self._relay_lock = Lock()
+        self._inventory_requests = {}
+        self._seen_objects = SeenObjects()
+        self._pending_compact_blocks = OrderedDict()
         self.peers = []
+        self.max_peers = max_peers
+        self.address_book = address_book if address_book is not None else AddressBook()
+        self._own_addresses = set()
         self._callback_queue = PriorityQueue()
         self._callback_counter = 0
         self._callback_counter_lock = Lock()
-
-        class IncomingHandler(socketserver.BaseRequestHandler):
-            """ Handler for incoming P2P connections. """
-            proto = self
-
-            def handle(self):
-                logging.info("connection from peer %s", repr(self.client_address))
-                if len(self.proto.peers) > MAX_PEERS:
-                    logging.warning("too many connections: rejecting peer %s",
-                                    repr(self.client_address))
-                    self.request.close()
-                    # TODO: separate limits for incoming and outgoing connections
-                    return
-
-                conn = PeerConnection(self.client_address, self.proto, self.request)
-                self.proto.peers.append(conn)
-
-        self.server = SocketServer((listen_addr, listen_port), IncomingHandler)
-        self.server.serve_forever_bg()
+        self._shut_down = False
+
+        self._decoder_pool = ThreadPoolExecutor(DECODER_THREADS)
+        self._loop = asyncio.new_event_loop()
+        server_sock = socket.socket()
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_sock.bind((listen_addr, listen_port))
+        self.server_address = server_sock.getsockname()
+        self._server = self._loop.run_until_complete(self._loop.create_server(self._incoming_connection,
+                                                                              sock=server_sock, backlog=128))
+        logging.info("listening on %s", self.server_address)
+        self._loop.call_later(PING_INTERVAL, self._send_pings)
+        self._loop.call_later(STATS_LOG_INTERVAL, self._log_stats)
+        self._loop.call_later(RECONNECT_INTERVAL, self._reconnect)
+        self._loop_thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
 
         # we want to do this only after we opened our listening socket
+        for peer in bootstrap_peers:
+            self.address_book.add(peer)
         self.peers.extend([PeerConnection(peer, self) for peer in bootstrap_peers])
 
-        Thread(target=self._main_thread, daemon=True).start()
+        self._main_thread_handle = Thread(target=self._main_thread, daemon=True)
+        self._main_thread_handle.start()
+
+    def shutdown(self):
+        """
+        Closes all connections and the listening socket, and stops the event loop, the decoder
+        threads and the main thread. Events that are still waiting for the main thread are dropped.
+        """
+        if self._shut_down:
+            return
+        self._shut_down = True
+        asyncio.run_coroutine_threadsafe(self._close_connections(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._decoder_pool.shutdown()
+        self._callback_queue.put((-1, 0, None, None, None))
+        if current_thread() is not self._main_thread_handle:
+            self._main_thread_handle.join()
+        logging.info("stopped listening on %s", self.server_address)
+
+    async def _close_connections(self):
+        """ Closes the listening socket and all connections. Runs in the event loop. """
+        self._server.close()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+        for peer in list(self.peers):
+            peer.close()
+        # let the transports close their sockets
+        while any(peer._transport is not None and not peer._transport.is_closing() for peer in self.peers):
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    def network_stats(self) -> list:
+        """ Returns the statistics of all connected peers in a JSON-serializable representation. """
+        return [peer.stats_to_json_compatible() for peer in list(self.peers) if peer.is_connected]
+
+    def _send_pings(self):
+        """ Pings all peers. Called periodically by the event loop. """
+        for peer in list(self.peers):
+            peer.send_ping()
+        self._loop.call_later(PING_INTERVAL, self._send_pings)
+
+    def _reconnect(self):
+        """ Lets the main thread connect to more peers. Called periodically by the event loop. """
+        self.received("connect_peers", None, None, 3)
+        self._loop.call_later(RECONNECT_INTERVAL, self._reconnect)
+
+    def _log_stats(self):
+        """ Logs the statistics of all peers. Called periodically by the event loop. """
+        for stats in self.network_stats():
+            rtt = stats['ping_rtt']
+            logging.info("peer %s: sent %d messages (%d bytes), received %d messages (%d bytes), "
+                         "rtt %s, %d queued messages (%d bytes), %d dropped, encode %.3fs, "
+                         "decode %.3fs",
+                         stats['address'],
+                         sum(s['messages'] for s in stats['sent'].values()),
+                         sum(s['bytes'] for s in stats['sent'].values()),
+                         sum(s['messages'] for s in stats['received'].values()),
+                         sum(s['bytes'] for s in stats['received'].values()),
+                         "n/a" if rtt is None else "{:.1f}ms".format(rtt * 1000),
+                         stats['queued_messages'], stats['queued_bytes'],
+                         sum(stats['dropped'].values()), stats['encode_time'], stats['decode_time'])
+        self._loop.call_later(STATS_LOG_INTERVAL, self._log_stats)
+
+    def _incoming_connection(self) -> 'asyncio.Protocol':
+        """ Creates the handler for an incoming P2P connection. Called by the event loop. """
+        if len(self.peers) >= self.max_peers:
+            logging.warning("too many connections: rejecting peer")
+            # TODO: separate limits for incoming and outgoing connections
+            return _RejectedConnection()
+
+        conn = PeerConnection(None, self, incoming=True)
+        self.peers.append(conn)
+        return conn
 
     def broadcast_primary_block(self, block: 'Block'):
         """ Notifies all peers and local listeners of a new primary block. """
-        obj = block.to_json_compatible()
-
-        if self._primary_block == obj:
+        if self._primary_block.hash == block.hash:
             logging.debug("not broadcasting block again")
             return
 
-        logging.debug("* > block %s", hexlify(block.hash))
-        self._primary_block = obj
+        logging.debug("* > inv block %s", hexlify(block.hash))
+        self._primary_block = block
 
+        self._relay(block.hash, SharedMessage("block", block))
+        compact_block = None
+        inv = SharedMessage("inv", {"block": [hexlify(block.hash).decode()]})
         for peer in self.peers:
-            peer.send_msg("block", obj)
-        self.received('block', obj, None, 0)
+            if peer.compact_blocks and peer.is_connected and peer.known_inventory.add(block.hash):
+                if compact_block is None:
+                    compact_block = SharedMessage("cmpctblock", {
+                        'block': _header_block(block, block.transactions[:1]),
+                        'short_ids': [hexlify(_short_id(block.hash, t.get_hash())).decode()
+                                      for t in block.transactions[1:]],
+                    })
+                peer.send_shared(compact_block)
+            else:
+                peer.announce("block", block.hash, inv)
+        self.received('block', block, None, 0)
 
     def broadcast_transaction(self, trans: 'Transaction'):
-        """ Notifies all peers and local listeners of a new transaction. """
-        logging.debug("* > transaction %s", hexlify(trans.get_hash()))
+        """ Notifies all peers of a new transaction. """
+        trans_hash = trans.get_hash()
+        logging.debug("* > inv transaction %s", hexlify(trans_hash))
+        self._relay(trans_hash, trans)
         for peer in self.peers:
-            peer.send_msg("transaction", trans.to_json_compatible())
+            peer.announce("transaction", trans_hash)
+
+    def _relay(self, obj_hash: bytes, obj: 'Union[Transaction, SharedMessage]'):
+        """
+        Keeps an object we announce to our peers, so that we can send it when they ask for it.
+        Blocks are kept as a 'block' `SharedMessage`, so that each of them is encoded only once for
+        all peers that ask for it.
+        """
+        with self._relay_lock:
+            self._relay_cache[obj_hash] = obj
+            if len(self._relay_cache) > MAX_RELAY_CACHE:
+                self._relay_cache.popitem(last=False)
+
+    def _find_relayed(self, obj_hash: bytes) -> 'Optional[Union[Transaction, SharedMessage]]':
+        """ Returns the transaction or the 'block' message of an object we announced, or `None`. """
+        with self._relay_lock:
+            return self._relay_cache.get(obj_hash)
+
+    def _find_relayed_block(self, block_hash: bytes) -> 'Optional[SharedMessage]':
+        """ Returns the 'block' message of a block we announced, or `None`. """
+        obj = self._find_relayed(block_hash)
+        return obj if isinstance(obj, SharedMessage) else None
+
+    def _find_inventory(self, msg_type: str, obj_hash: bytes):
+        """ Returns the block or transaction with the given hash, or `None` if we do not have it. """
+        with self._relay_lock:
+            obj = self._relay_cache.get(obj_hash)
+        if obj is not None:
+            return obj.msg_param if isinstance(obj, SharedMessage) else obj
+        handlers = self.block_request_handlers if msg_type == "block" else self.transaction_request_handlers
+        for handler in handlers:
+            obj = handler(obj_hash)
+            if obj is not None:
+                return obj
+        return None
+
+    @staticmethod
+    def _parse_inventory(inv: dict):
+        """ Yields the message types and hashes in the parameter of an 'inv' or 'getdata' message. """
+        if sum(len(hashes) for hashes in inv.values()) > MAX_INV_SIZE:
+            raise ValueError("too many hashes in inventory message")
+        for msg_type, hashes in inv.items():
+            if msg_type not in _OBJECT_MESSAGES:
+                raise ValueError("unknown inventory type {}".format(msg_type))
+            for obj_hash in hashes:
+                yield msg_type, unhexlify(obj_hash)
+
+    def call_in_main_thread(self, function: Callable[[], None]):
+        """
+        Lets the main thread call `function` after the events that are already waiting for it, so
+        that other threads can change the state that only the main thread may change.
+        """
+        self.received("call", function, None, 2)
+
+    def pending_events(self) -> int:
+        """ Returns the number of received messages that the main thread has not handled yet. """
+        return self._callback_queue.qsize()
 
     def received(self, msg_type: str, msg_param, peer: Optional[PeerConnection], prio: int = 1):
         """
         Called by a PeerConnection when a new message was received.
 
         :param msg_type: The message type identifier.
-        :param msg_param: The JSON-compatible object that was received.
+        :param msg_param: The object that was received. The parameters of 'block' and
+                          'transaction' messages may also be given in their JSON-compatible
+                          representation.
         :param peer: The peer who sent us the message.
         :param prio: The priority of the message. (Should be lower for locally generated events
                      than for remote events, to make sure self-mined blocks get handled first.)
@@ -313,15 +1302,35 @@ class Protocol:
         if peer is None:
             peer = self._dummy_peer
 
+        if isinstance(msg_param, dict) and msg_type in _OBJECT_MESSAGES:
+            msg_param = _OBJECT_MESSAGES[msg_type].from_json_compatible(msg_param)
+
         with self._callback_counter_lock:
             counter = self._callback_counter + 1
             self._callback_counter = counter
         self._callback_queue.put((prio, counter, msg_type, msg_param, peer))
 
+    @staticmethod
+    def _prevalidate(msg_type: str, msg_param) -> bool:
+        """
+        Checks the parts of a received block or transaction that do not depend on the block chain,
+        and computes the hashes the main thread will need. Called by the decoder threads.
+        """
+        if msg_type == "block":
+            return msg_param.verify_difficulty() and \
+                   all(t.verify_syntax() for t in msg_param.transactions) and msg_param.verify_merkle()
+        if msg_type == "transaction":
+            msg_param.get_hash()
+            return msg_param.verify_syntax()
+        return True
+
     def _main_thread(self):
         """ The main loop of the one thread where all incoming events are handled. """
         while True:
             _, _, msg_type, msg_param, peer = self._callback_queue.get()
+            if msg_type is None:
+                # see `shutdown`
+                return
             try:
                 getattr(self, 'received_' + msg_type)(msg_param, peer)
             except:
@@ -332,6 +1341,12 @@ class Protocol:
                 except OSError:
                     pass
 
+    def received_call(self, function: Callable[[], None], sender: PeerConnection):
+        """ A function was passed in with `call_in_main_thread`. Peers cannot send this message. """
+        if sender is not self._dummy_peer:
+            raise ValueError("peer sent a local message")
+        function()
+
     def received_id(self, uuid: str, sender: PeerConnection):
         """
         A unique connection id was received. We use this to detect and close connections to
@@ -342,6 +1357,9 @@ class Protocol:
         logging.debug("%s < id %s", sender.peer_addr, uuid)
         for peer in self.peers:
             if peer._sent_uuid == uuid:
+                if peer._dial_addr is not None:
+                    self._own_addresses.add(peer._dial_addr)
+                    self.address_book.remove(peer._dial_addr)
                 peer.close()
                 sender.close()
                 break
@@ -351,12 +1369,14 @@ class Protocol:
 
         peer_addr = tuple(peer_addr)
         logging.debug("%s < peer %s", sender.peer_addr, peer_addr)
-        if len(self.peers) >= MAX_PEERS:
-            # TODO: maintain list of known, not connected peers
+        if peer_addr in self._own_addresses:
+            return
+        self.address_book.add(peer_addr)
+        if len(self.peers) >= self.max_peers:
             return
 
         for peer in self.peers:
-            if peer.peer_addr == peer_addr:
+            if peer.peer_addr == peer_addr or peer._dial_addr == peer_addr:
                 return
 
         # TODO: if the other peer also just learned of us, we can end up with two connections (one from each direction)
@@ -364,8 +1384,10 @@ class Protocol:
 
     def received_myport(self, port: int, sender: PeerConnection):
         logging.debug("%s < myport %s", sender.peer_addr, port)
-        addr = sender.socket.getpeername()
+        addr = sender._sock_addr
         sender.peer_addr = (addr[0],) + (int(port),) + addr[2:]
+        if sender._dial_addr is None and sender.peer_addr not in self._own_addresses:
+            self.address_book.add(sender.peer_addr)
 
         for peer in self.peers:
             if peer.is_connected and peer is not sender:
@@ -375,45 +1397,298 @@ class Protocol:
                     logging.debug("%s > peer %s", peer.peer_addr, sender.peer_addr)
                     peer.send_msg("peer", list(sender.peer_addr))
 
+    def received_ping(self, nonce: int, sender: PeerConnection):
+        """
+        A peer wants to know our round-trip time. Only the first message of a connection gets here;
+        later pings are answered by the decoder threads.
+        """
+        sender.send_msg("pong", nonce)
+
+    def received_pong(self, nonce: int, sender: PeerConnection):
+        """
+        A peer answered our ping. Only the first message of a connection gets here; later pongs are
+        handled by the decoder threads.
+        """
+        sender.stats.pong_received(nonce)
+        logging.debug("%s < pong, rtt %s", sender.peer_addr, sender.stats.ping_rtt)
+
     def received_getblock(self, block_hash: str, peer: PeerConnection):
         """ We received a request for a new block from a certain peer. """
         logging.debug("%s < getblock %s", peer.peer_addr, block_hash)
         for handler in self.block_request_handlers:
             block = handler(unhexlify(block_hash))
             if block is not None:
-                peer.send_msg("block", block.to_json_compatible())
+                peer.send_msg("block", block)
                 break
+        else:
+            if peer.notfound:
+                peer.send_msg("notfound", {"block": [block_hash]})
+
+    def received_inv(self, inv: dict, sender: PeerConnection):
+        """ A peer announced blocks or transactions. We ask for those we do not have yet. """
+        logging.debug("%s < inv %s", sender.peer_addr, inv)
+        now = datetime.utcnow()
+        for obj_hash, requested in list(self._inventory_requests.items()):
+            if requested + INVENTORY_REQUEST_TIMEOUT < now:
+                del self._inventory_requests[obj_hash]
+
+        getdata = {}
+        for msg_type, obj_hash in self._parse_inventory(inv):
+            sender.known_inventory.add(obj_hash)
+            if obj_hash in self._inventory_requests or self._find_inventory(msg_type, obj_hash) is not None:
+                continue
+            self._inventory_requests[obj_hash] = now
+            self._seen_objects.forget(obj_hash)
+            getdata.setdefault(msg_type, []).append(hexlify(obj_hash).decode())
+
+        if getdata:
+            logging.debug("%s > getdata %s", sender.peer_addr, getdata)
+            sender.send_msg("getdata", getdata)
+
+    def received_getdata(self, inv: dict, sender: PeerConnection):
+        """ A peer asked for blocks or transactions we announced. """
+        logging.debug("%s < getdata %s", sender.peer_addr, inv)
+        transactions = []
+        notfound = {}
+        for msg_type, obj_hash in self._parse_inventory(inv):
+            relayed = self._find_relayed_block(obj_hash) if msg_type == "block" else None
+            if relayed is not None:
+                sender.known_inventory.add(obj_hash)
+                sender.send_shared(relayed)
+                continue
+            obj = self._find_inventory(msg_type, obj_hash)
+            if obj is not None:
+                sender.known_inventory.add(obj_hash)
+                if msg_type == "transaction" and sender.tx_batches:
+                    transactions.append(obj)
+                else:
+                    sender.send_msg(msg_type, obj)
+            else:
+                notfound.setdefault(msg_type, []).append(hexlify(obj_hash).decode())
+        if notfound and sender.notfound:
+            sender.send_msg("notfound", notfound)
+        if len(transactions) == 1:
+            sender.send_msg("transaction", transactions[0])
+            return
+        for i in range(0, len(transactions), MAX_TRANSACTION_BATCH):
+            sender.send_msg("transactions", transactions[i:i + MAX_TRANSACTION_BATCH])
+
+    def received_notfound(self, inv: dict, sender: PeerConnection):
+        """
+        A peer does not have blocks or transactions we asked for. We forget that we asked, so that
+        we ask the next peer that announces them.
+        """
+        logging.debug("%s < notfound %s", sender.peer_addr, inv)
+        for _, obj_hash in self._parse_inventory(inv):
+            self._inventory_requests.pop(obj_hash, None)
+
+    def received_cmpctblock(self, compact_block: dict, sender: PeerConnection):
+        """
+        A peer sent us a new block in compact form. We rebuild it from the transactions we know and
+        ask the peer for the missing ones.
+        """
+        header = _to_object(Block, compact_block['block'])
+        logging.debug("%s < cmpctblock %s", sender.peer_addr, hexlify(header.hash))
+        sender.known_inventory.add(header.hash)
+        if len(header.transactions) != 1 or not header.verify_difficulty():
+            raise ValueError("invalid compact block")
+        if header.hash in self._pending_compact_blocks or header.hash in self._seen_objects or \
+                self._find_inventory("block", header.hash) is not None:
+            return
+
+        pool = {}
+        for trans in self._transaction_pool():
+            pool[_short_id(header.hash, trans.get_hash())] = trans
+        transactions = header.transactions + [pool.get(unhexlify(short_id))
+                                              for short_id in compact_block['short_ids']]
+        missing = [i for (i, trans) in enumerate(transactions) if trans is None]
+        if not missing:
+            self._finish_compact_block(header, transactions, sender)
+            return
+
+        self._pending_compact_blocks[header.hash] = (header, transactions, sender)
+        if len(self._pending_compact_blocks) > MAX_PENDING_COMPACT_BLOCKS:
+            self._pending_compact_blocks.popitem(last=False)
+        logging.debug("%s > getblocktxn %s (%d of %d)", sender.peer_addr, hexlify(header.hash),
+                      len(missing), len(transactions))
+        sender.send_msg("getblocktxn", {'hash': hexlify(header.hash).decode(), 'indexes': missing})
+
+    def received_getblocktxn(self, request: dict, sender: PeerConnection):
+        """ A peer asks for the transactions of a compact block that it could not find itself. """
+        logging.debug("%s < getblocktxn %s", sender.peer_addr, request['hash'])
+        block = self._find_inventory("block", unhexlify(request['hash']))
+        if block is None:
+            return
+        indexes = request['indexes']
+        if not all(isinstance(i, int) and 0 <= i < len(block.transactions) for i in indexes):
+            raise ValueError("invalid transaction index")
+        sender.send_msg("blocktxn", {'hash': request['hash'],
+                                     'transactions': [block.transactions[i] for i in indexes]})
+
+    def received_blocktxn(self, response: dict, sender: PeerConnection):
+        """ A peer sent us the missing transactions of a compact block. """
+        logging.debug("%s < blocktxn %s", sender.peer_addr, response['hash'])
+        block_hash = unhexlify(response['hash'])
+        pending = self._pending_compact_blocks.get(block_hash)
+        if pending is None or pending[2] is not sender:
+            return
+        del self._pending_compact_blocks[block_hash]
+
+        header, transactions, _ = pending
+        received = [_to_object(Transaction, t) for t in response['transactions']]
+        missing = [i for (i, trans) in enumerate(transactions) if trans is None]
+        if len(received) != len(missing):
+            raise ValueError("wrong number of transactions for compact block")
+        for i, trans in zip(missing, received):
+            transactions[i] = trans
+        self._finish_compact_block(header, transactions, sender)
+
+    def _finish_compact_block(self, header: 'Block', transactions: 'List[Transaction]',
+                              sender: PeerConnection):
+        """
+        Passes a rebuilt compact block to the decoder pool, to be pre-validated and checked for
+        duplicates like a full block we received.
+        """
+        self._decoder_pool.submit(self._prevalidate_compact_block,
+                                  _header_block(header, transactions), sender)
 
-    def received_block(self, block: dict, sender: PeerConnection):
+    def _prevalidate_compact_block(self, block: 'Block', sender: PeerConnection):
+        """
+        Pre-validates a rebuilt compact block and passes it to the main thread, unless we have
+        already received it. Runs in the decoder pool.
+        """
+        seen_objects = self._seen_objects
+        if block.hash in seen_objects:
+            sender.stats.duplicates['block'] += 1
+            return
+        if not block.verify_merkle():
+            logging.info("could not rebuild compact block %s, requesting full block",
+                         hexlify(block.hash))
+            sender.send_msg("getdata", {'block': [hexlify(block.hash).decode()]})
+            return
+        if not self._prevalidate("block", block):
+            logging.warning("%s < invalid compact block", sender.peer_addr)
+            return
+        seen_objects.add("block", block.hash, None)
+        self.received("block", block, sender)
+
+    def _transaction_pool(self):
+        """ Yields the unconfirmed transactions we know of. """
+        with self._relay_lock:
+            relayed = [obj for obj in self._relay_cache.values() if isinstance(obj, Transaction)]
+        yield from relayed
+        for handler in self.transaction_pool_handlers:
+            yield from handler()
+
+    def received_block(self, block: 'Block', sender: PeerConnection):
         """ Someone sent us a block. """
-        block = Block.from_json_compatible(block)
         logging.debug("%s < block %s", sender.peer_addr, hexlify(block.hash))
+        if sender is not self._dummy_peer:
+            sender.known_inventory.add(block.hash)
+            self._inventory_requests.pop(block.hash, None)
         for handler in self.block_receive_handlers:
             handler(block)
 
-    def received_transaction(self, transaction: dict, sender: PeerConnection):
+    def received_transaction(self, transaction: 'Transaction', sender: PeerConnection):
         """ Someone sent us a transaction. """
-        tx = Transaction.from_json_compatible(transaction)
-        logging.debug("%s < transaction %s", sender.peer_addr, hexlify(tx.get_hash()))
+        logging.debug("%s < transaction %s", sender.peer_addr, hexlify(transaction.get_hash()))
+        if sender is not self._dummy_peer:
+            sender.known_inventory.add(transaction.get_hash())
+            self._inventory_requests.pop(transaction.get_hash(), None)
         for handler in self.trans_receive_handlers:
-            handler(tx)
+            handler(transaction)
+        for handler in self.trans_batch_receive_handlers:
+            handler([transaction])
+
+    def received_transactions(self, transactions: 'List[Transaction]', sender: PeerConnection):
+        """ Someone sent us a batch of transactions. """
+        logging.debug("%s < transactions (%d)", sender.peer_addr, len(transactions))
+        if sender is not self._dummy_peer:
+            for transaction in transactions:
+                sender.known_inventory.add(transaction.get_hash())
+                self._inventory_requests.pop(transaction.get_hash(), None)
+        for handler in self.trans_receive_handlers:
+            for transaction in transactions:
+                handler(transaction)
+        for handler in self.trans_batch_receive_handlers:
+            handler(transactions)
 
     def received_disconnected(self, _, peer: PeerConnection):
         """
         Removes a disconnected peer from our list of connected peers.
 
-        (Not actually a message received from the peer, but a message sent by the reader or writer
-        thread to the main thread.)
+        (Not actually a message received from the peer, but a message sent by the event loop to the
+        main thread.)
         """
-        if not peer.is_connected:
+        if not peer.is_connected and peer in self.peers:
             self.peers.remove(peer)
 
+            addr = peer._dial_addr or peer.peer_addr
+            if addr is None or addr in self._own_addresses:
+                return
+            if peer.stats.connected_at is None:
+                if peer._dial_addr is not None:
+                    self.address_book.connection_failed(addr)
+            else:
+                self.address_book.disconnected(addr, peer.stats.ping_rtt, peer.stats.throughput())
+
+    def received_connect_peers(self, _, sender):
+        """
+        Connects to the best known peers we are not connected to yet, and stores the address book.
+
+        (Not actually a message received from a peer, but sent periodically by the event loop.)
+        """
+        outgoing = sum(1 for peer in self.peers if peer._dial_addr is not None)
+        count = min(OUTGOING_PEERS - outgoing, self.max_peers - len(self.peers))
+        if count > 0:
+            connected = {peer._dial_addr for peer in self.peers} | {peer.peer_addr for peer in self.peers}
+            for addr in self.address_book.best(count, connected | self._own_addresses):
+                self.peers.append(PeerConnection(addr, self))
+
+        try:
+            self.address_book.save()
+        except OSError:
+            logging.exception("could not store the address book")
+
     def send_block_request(self, block_hash: bytes):
         """ Sends a request for a block to all our peers. """
         logging.debug("* > getblock %s", hexlify(block_hash))
+        self._seen_objects.forget(block_hash)
+        request = SharedMessage("getblock", hexlify(block_hash).decode())
         for peer in self.peers:
-            peer.send_msg("getblock", hexlify(block_hash).decode())
+            peer.send_shared(request)
+
+
+class _RejectedConnection(asyncio.Protocol):
+    """ Closes an incoming connection we do not have room for. """
+
+    def connection_made(self, transport: asyncio.Transport):
+        transport.close()
 
 
 from .block import Block
 from .transaction import Transaction
+
+_OBJECT_MESSAGES = {'block': Block, 'transaction': Transaction}
+""" The message types whose parameters are decoded into objects, and the classes of these objects. """
+
+
+def _to_object(cls, val):
+    """ Converts a block or transaction nested in a message parameter into an object, if necessary. """
+    if isinstance(val, cls):
+        return val
+    return cls.from_json_compatible(val)
+
+
+def _header_block(block: 'Block', transactions: 'List[Transaction]') -> 'Block':
+    """ Returns a copy of the header of `block` with different transactions. """
+    return Block(block.prev_block_hash, block.time, block.nonce, block.height, datetime.utcnow(),
+                 block.target, transactions, block.merkle_root_hash, block.id)
+
+
+def _short_id(block_hash: bytes, trans_hash: bytes) -> bytes:
+    """ Computes the short id of a transaction in a compact block. """
+    hasher = get_hasher()
+    hasher.update(block_hash)
+    hasher.update(trans_hash)
+    return hasher.digest()[:SHORT_ID_LENGTH]
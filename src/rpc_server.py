@@ -1,12 +1,23 @@
 """ The RPC functionality the miner provides for the wallet and the blockchain explorer.
-All REST-API calls are defined here. """
+All REST-API calls are defined here.
+
+The list endpoints of the explorer (`/explorer/blocks`, `/explorer/transactions` and
+`/explorer/addresses`) return a JSON list of all entries, unless the `limit` or `cursor` query
+parameters are given. Then they return one page of at most `limit` entries (by default
+`DEFAULT_PAGE_SIZE`) as ``{"items": [...], "next_cursor": ...}``. If there are more entries,
+`next_cursor` (which is also sent in the `NEXT_CURSOR_HEADER` header) can be passed as the `cursor`
+query parameter to get the next page; otherwise it is `null`. Cursors consist of heights and
+positions in the block chain, so they stay valid while new blocks are added. """
 
 import binascii
 import json
 import time
 from binascii import hexlify
+from bisect import bisect_left
 from datetime import datetime
 from sys import maxsize
+from threading import Lock
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import flask
 from flask_api import status
@@ -14,6 +25,7 @@ from flask_api import status
 from .chainbuilder import ChainBuilder
 from .crypto import Key
 from .persistence import Persistence
+from .sqlite_store import SqliteStore
 from .config import DIFFICULTY_BLOCK_INTERVAL
 from .transaction import TransactionInput
 
@@ -21,8 +33,18 @@ time_format = "%d.%m.%Y %H:%M:%S"  # Defines the format string of timestamps in
 app = flask.Flask(__name__)
 cb = None
 pers = None
+store = None
 QUERY_PARAMETER_LIMIT = maxsize
 
+DEFAULT_PAGE_SIZE = 100
+""" The number of entries a page of the explorer endpoints has if only a `cursor` is given. """
+
+MAX_PAGE_SIZE = 1000
+""" The largest `limit` the paginated explorer endpoints accept. """
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+""" The response header with the cursor of the next page of a paginated explorer endpoint. """
+
 
 def datetime_from_utc_to_local(utc_datetime):
     """ Converts UTC timestamp to local timezone. """
@@ -31,12 +53,133 @@ def datetime_from_utc_to_local(utc_datetime):
     return utc_datetime + offset
 
 
-def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence):
-    """ Runs the RPC server (forever). """
+def _full_block(block: 'Block') -> 'Block':
+    """
+    Returns `block` with its transactions. These are read from disk if only the header of the block
+    is kept in memory (see `load_chain_state`).
+    """
+    if block.is_header_only and pers is not None:
+        return pers.block_by_hash(block.hash) or block
+    return block
+
+
+def _full_blocks(blocks: 'Iterable[Block]') -> 'Iterator[Block]':
+    """ Applies `_full_block` to each of `blocks`, lazily. """
+    for block in blocks:
+        yield _full_block(block)
+
+
+def _page_request(cursor_length: int) -> 'Tuple[Optional[int], Optional[List[int]]]':
+    """
+    Returns the `limit` and the `cursor` query parameters of a paginated request. The cursor is
+    `cursor_length` non-negative integers separated by colons, or `None` for the first page. The
+    limit is `None` if neither is given, i.e. if all entries are requested. Raises a `ValueError`
+    if one of them is invalid.
+    """
+    args = flask.request.args
+    if 'limit' not in args and 'cursor' not in args:
+        return None, None
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError("limit out of range")
+    cursor = flask.request.args.get('cursor')
+    if cursor is None:
+        return limit, None
+    cursor = [int(part) for part in cursor.split(":")]
+    if len(cursor) != cursor_length or any(part < 0 for part in cursor):
+        raise ValueError("invalid cursor")
+    return limit, cursor
+
+
+def _page_response(items: list, next_cursor: 'Optional[Iterable[int]]', limit: 'Optional[int]'):
+    """
+    Returns a page of `items` and the cursor of the next page, or just `items` if all entries were
+    requested (`limit` is `None`).
+    """
+    if limit is None:
+        return json.dumps(items)
+    headers = {}
+    if next_cursor is not None:
+        next_cursor = headers[NEXT_CURSOR_HEADER] = ":".join(str(part) for part in next_cursor)
+    return json.dumps({'items': items, 'next_cursor': next_cursor}), status.HTTP_200_OK, headers
+
+
+def _invalid_page_request():
+    return json.dumps("Invalid cursor or limit."), status.HTTP_400_BAD_REQUEST
+
+
+def _transactions_from(chain: 'Blockchain', height: int, position: 'Optional[int]'):
+    """
+    Yields the height, the position, the transaction and the block of the transactions of `chain`,
+    newest first, starting with the one at `height` and `position` (or the last one of that block).
+    """
+    if height > chain.head.height:
+        height, position = chain.head.height, None
+    for block in _full_blocks(chain.blocks[h] for h in range(height, -1, -1)):
+        start = len(block.transactions) - 1
+        if block.height == height and position is not None:
+            start = min(start, position)
+        for pos in range(start, -1, -1):
+            yield block.height, pos, block.transactions[pos], block
+
+
+class _FirstPayments:
+    """
+    The addresses paid to in the primary block chain, with the height and position of the first
+    transaction paying to them, in the order of `SqliteStore.first_payments`. Only the blocks that
+    changed since the last lookup are read, so that the pages of `/explorer/addresses` do not
+    scan the whole block chain when there is no `SqliteStore`.
+    """
+
+    def __init__(self):
+        self._hashes = []
+        self._entries = []
+        self._addresses = set()
+        self._lock = Lock()
+
+    def _update(self, chain: 'Blockchain'):
+        fork = min(len(self._hashes), len(chain.blocks)) - 1
+        while fork >= 0 and self._hashes[fork] != chain.blocks[fork].hash:
+            fork -= 1
+        if fork < len(self._hashes) - 1:
+            removed = bisect_left(self._entries, (fork + 1,))
+            self._addresses.difference_update(address for (_, _, address) in self._entries[removed:])
+            del self._entries[removed:], self._hashes[fork + 1:]
+        for block in _full_blocks(chain.blocks[fork + 1:]):
+            for pos, t in enumerate(block.transactions):
+                new_addresses = {target.get_pubkey.as_bytes() for target in t.targets} - self._addresses
+                self._addresses |= new_addresses
+                self._entries += [(block.height, pos, address) for address in sorted(new_addresses)]
+            self._hashes.append(block.hash)
+
+    def first_payments(self, chain: 'Blockchain', height: int, position: int,
+                       limit: 'Optional[int]') -> 'List[Tuple[bytes, int, int]]':
+        """
+        Returns up to `limit` (or all) addresses paid to in `chain`, like
+        `SqliteStore.first_payments`.
+        """
+        with self._lock:
+            self._update(chain)
+            start = bisect_left(self._entries, (height, position))
+            end = len(self._entries) if limit is None else start + limit
+            return [(address, h, p) for (h, p, address) in self._entries[start:end]]
+
+
+_first_payments = _FirstPayments()
+
+
+def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence,
+               sqlite_store: 'Optional[SqliteStore]' = None):
+    """
+    Runs the RPC server (forever). Lookups of blocks, transactions and balances are answered from
+    `sqlite_store` if it is given.
+    """
     global cb
     cb = chainbuilder
     global pers
     pers = persist
+    global store
+    store = sqlite_store
 
     app.run(port=port)
 
@@ -50,6 +193,26 @@ def get_network_info():
     return json.dumps([list(peer.peer_addr)[:2] for peer in cb.protocol.peers if peer.is_connected])
 
 
+@app.route("/network-stats", methods=['GET'])
+def get_network_stats():
+    """ Returns the traffic and latency statistics of the connected peers.
+    Route: `\"/network-stats\"`.
+    HTTP Method: `'GET'`
+    """
+    return json.dumps(cb.protocol.network_stats())
+
+
+@app.route("/persistence-stats", methods=['GET'])
+def get_persistence_stats():
+    """ Returns the write statistics and the policy of the persistence, or 404 if it is disabled.
+    Route: `\"/persistence-stats\"`.
+    HTTP Method: `'GET'`
+    """
+    if pers is None:
+        return json.dumps("Resource not found."), status.HTTP_404_NOT_FOUND
+    return json.dumps(pers.stats())
+
+
 @app.route("/new-transaction", methods=['PUT'])
 def send_transaction():
     """
@@ -70,6 +233,10 @@ def show_balance():
     """
     pubkeys = {Key.from_json_compatible(pk): i for (i, pk) in enumerate(flask.request.json)}
     amounts = [0 for _ in pubkeys.values()]
+    if store is not None:
+        for key, i in pubkeys.items():
+            amounts[i] = store.balance(key)
+        return json.dumps(amounts)
     for output in cb.primary_block_chain.unspent_coins.values():
         if output.get_pubkey in pubkeys:
             amounts[pubkeys[output.get_pubkey]] += output.amount
@@ -93,9 +260,14 @@ def build_transaction():
 
     # TODO maybe give preference to the coins that are already unlocked  when creating a transaction!
 
+    if store is not None:
+        coins = [coin for key in sender_pks for coin in store.unspent_coins(key)]
+    else:
+        coins = cb.primary_block_chain.unspent_coins.items()
+
     inputs = []
     used_keys = []
-    for (inp, output) in cb.primary_block_chain.unspent_coins.items():
+    for (inp, output) in coins:
         if (output.get_pubkey in sender_pks) and (
         not output.is_locked):  # here we check is the amount is not locked before creating a Tx
             amount -= output.amount
@@ -123,8 +295,11 @@ def get_transaction_for_hash():
     HTTP Method: `'POST'`
     """
     tx_hash = flask.request.data
+    if store is not None:
+        found = store.transaction(tx_hash)
+        return json.dumps("" if found is None else found[0].to_json_compatible())
     chain = cb.primary_block_chain
-    for b in chain.blocks:
+    for b in _full_blocks(chain.blocks):
         for t in b.transactions:
             if t.get_hash() == tx_hash:
                 return json.dumps(t.to_json_compatible())
@@ -138,17 +313,20 @@ def get_transactions_for_key():
     HTTP Method: `'POST'`
     """
     key = Key(flask.request.data)
+    if store is not None:
+        transactions = {t.get_hash(): t for (t, _, _) in store.address_history(key)}
+        return json.dumps([t.to_json_compatible() for t in transactions.values()])
     transactions = set()
     outputs = set()
     chain = cb.primary_block_chain
-    for b in chain.blocks:
+    for b in _full_blocks(chain.blocks):
         for t in b.transactions:
             for i, target in enumerate(t.targets):
                 if target.get_pubkey == key:
                     transactions.add(t)
                     outputs.add((t.get_hash(), i))
 
-    for b in chain.blocks:
+    for b in _full_blocks(chain.blocks):
         for t in b.transactions:
             for inp in t.inputs:
                 if (inp.transaction_hash, inp.output_idx) in outputs:
@@ -169,20 +347,24 @@ def get_sorted_transactions_for_key(key):
     received_transactions = []
     sent_transactions = []
 
-    outputs = set()
-    chain = cb.primary_block_chain
-    for b in chain.blocks:
-        for t in b.transactions:
-            for i, target in enumerate(t.targets):
-                if target.get_pubkey == key:
-                    received_transactions.append(t.to_json_compatible())
-                    outputs.add((t.get_hash(), i))
-
-    for b in chain.blocks:
-        for t in b.transactions:
-            for inp in t.inputs:
-                if (inp.transaction_hash, inp.output_idx) in outputs:
-                    sent_transactions.append(t.to_json_compatible())
+    if store is not None:
+        for t, _, sent in store.address_history(key):
+            (sent_transactions if sent else received_transactions).append(t.to_json_compatible())
+    else:
+        outputs = set()
+        chain = cb.primary_block_chain
+        for b in _full_blocks(chain.blocks):
+            for t in b.transactions:
+                for i, target in enumerate(t.targets):
+                    if target.get_pubkey == key:
+                        received_transactions.append(t.to_json_compatible())
+                        outputs.add((t.get_hash(), i))
+
+        for b in _full_blocks(chain.blocks):
+            for t in b.transactions:
+                for inp in t.inputs:
+                    if (inp.transaction_hash, inp.output_idx) in outputs:
+                        sent_transactions.append(t.to_json_compatible())
 
     for t in sent_transactions:
         t['timestamp'] = datetime_from_utc_to_local(datetime.strptime(t['timestamp'],
@@ -203,19 +385,40 @@ def get_sorted_transactions_for_key(key):
 @app.route("/explorer/addresses", methods=['GET'])
 def get_addresses():
     """
-    Returns all addresses in the blockchain.
+    Returns the addresses in the blockchain, in the order they were first paid to. Paginated if
+    `limit` or `cursor` is given (see above); the cursor is the height and position of a
+    transaction and the number of its addresses to skip.
     Route: `\"/explorer/addresses\"`.
     HTTP Method: `'GET'`
     """
-    addresses = set()
-    chain = cb.primary_block_chain
-    for b in chain.blocks:
-        for t in b.transactions:
-            for i, target in enumerate(t.targets):
-                addresses.add(hexlify(target.get_pubkey.as_bytes()).decode())
-    if len(addresses) != 0:
-        return json.dumps([a for a in addresses])
+    try:
+        limit, cursor = _page_request(3)
+    except ValueError:
+        return _invalid_page_request()
+    height, position, skip = cursor or (0, 0, 0)
+    count = None if limit is None else skip + limit + 1
+    if store is not None:
+        entries = store.first_payments(height, position, count)
+    else:
+        entries = _first_payments.first_payments(cb.primary_block_chain, height, position, count)
+
+    addresses = []
+    next_cursor = None
+    current, count = None, 0
+    for address, h, p in entries:
+        if (h, p) != current:
+            current, count = (h, p), 0
+        if (h, p) == (height, position) and count < skip:
+            count += 1
+            continue
+        if len(addresses) == limit:
+            next_cursor = (h, p, count)
+            break
+        addresses.append(hexlify(address).decode())
+        count += 1
 
+    if addresses or cursor is not None:
+        return _page_response(addresses, next_cursor, limit)
     return json.dumps("Resource not found."), status.HTTP_404_NOT_FOUND
 
 
@@ -228,9 +431,12 @@ def show_single_balance():
     """
     key = Key(flask.request.data)
     amount = 0
-    for output in cb.primary_block_chain.unspent_coins.values():
-        if output.get_pubkey == key:
-            amount += output.amount
+    if store is not None:
+        amount = store.balance(key)
+    else:
+        for output in cb.primary_block_chain.unspent_coins.values():
+            if output.get_pubkey == key:
+                amount += output.amount
     result = {"credit": amount}
 
     return json.dumps(result)
@@ -264,7 +470,7 @@ def get_last_transactions(amount):
 
     last_confirmed_transactions = []
     chain = cb.primary_block_chain
-    for b in reversed(chain.blocks):
+    for b in _full_blocks(reversed(chain.blocks)):
         if not counter < amount:
             break
         for t in reversed(b.transactions):
@@ -290,25 +496,33 @@ def get_last_transactions(amount):
 @app.route("/explorer/transactions", methods=['GET'])
 def get_transactions():
     """
-    Returns all transactions.
+    Returns the confirmed transactions, newest first. Paginated if `limit` or `cursor` is given
+    (see above); the cursor is the height and position of a transaction.
     Route: `\"/explorer/transactions\"`
     HTTP Method: `'GET'`
     """
-    transactions = []
+    try:
+        limit, cursor = _page_request(2)
+    except ValueError:
+        return _invalid_page_request()
     chain = cb.primary_block_chain
-    for b in reversed(chain.blocks):
-        for t in reversed(b.transactions):
-            trans = t.to_json_compatible()
-            block = b.to_json_compatible()
-            trans['block_id'] = block['id']
-            trans['block_hash'] = block['hash']
-            trans['number_confirmations'] = chain.head.id - int(block['id'])
-            transactions.append(trans)
-    for t in transactions:
-        t['timestamp'] = datetime_from_utc_to_local(datetime.strptime(t['timestamp'],
-                                                                      "%Y-%m-%dT%H:%M:%S.%f UTC")).strftime(
+    height, position = cursor or (chain.head.height, None)
+
+    transactions = []
+    next_cursor = None
+    for h, p, t, b in _transactions_from(chain, height, position):
+        if len(transactions) == limit:
+            next_cursor = (h, p)
+            break
+        trans = t.to_json_compatible()
+        trans['block_id'] = b.id
+        trans['block_hash'] = hexlify(b.hash).decode()
+        trans['number_confirmations'] = chain.head.id - int(b.id)
+        trans['timestamp'] = datetime_from_utc_to_local(datetime.strptime(trans['timestamp'],
+                                                                          "%Y-%m-%dT%H:%M:%S.%f UTC")).strftime(
             time_format)
-    return json.dumps(transactions)
+        transactions.append(trans)
+    return _page_response(transactions, next_cursor, limit)
 
 
 @app.route("/explorer/transaction/<string:hash>", methods=['GET'])
@@ -319,7 +533,11 @@ def get_transaction_from_hash(hash):
     HTTP Method: `'GET'`
     """
     chain = cb.primary_block_chain
-    for b in chain.blocks:
+    blocks = _full_blocks(chain.blocks)
+    if store is not None:
+        found = store.transaction(binascii.unhexlify(hash))
+        blocks = [] if found is None else [found[1]]
+    for b in blocks:
         for t in b.transactions:
             if hexlify(t.get_hash()).decode() == hash:
                 trans = t.to_json_compatible()
@@ -351,19 +569,27 @@ def get_transaction_from_hash(hash):
 @app.route("/explorer/blocks", methods=['GET'])
 def get_blocks():
     """
-    Returns all blocks in the blockchain.
+    Returns the blocks in the blockchain, newest first. Paginated if `limit` or `cursor` is given
+    (see above); the cursor is the height of a block.
     Route: `\"/explorer/blocks\"`
     HTTP Method: `'GET'`
     """
+    try:
+        limit, cursor = _page_request(1)
+    except ValueError:
+        return _invalid_page_request()
     chain = cb.primary_block_chain
+    height = chain.head.height if cursor is None else min(cursor[0], chain.head.height)
+    count = height + 1 if limit is None else limit
+
     result = []
-    for o in reversed(chain.blocks):
+    for o in _full_blocks(chain.blocks[h] for h in range(height, max(height - count, -1), -1)):
         block = o.to_json_compatible()
         block['time'] = datetime_from_utc_to_local(datetime.strptime(block['time'],
                                                                      "%Y-%m-%dT%H:%M:%S.%f UTC")).strftime(
             time_format)
         result.append(block)
-    return json.dumps(result)
+    return _page_response(result, (height - count,) if height - count >= 0 else None, limit)
 
 
 @app.route("/explorer/lastblocks/<int:amount>", methods=['GET'])
@@ -376,7 +602,7 @@ def get_blocks_amount(amount):
     result = []
     chain = cb.primary_block_chain
     counter = 0
-    for b in reversed(chain.blocks):
+    for b in _full_blocks(reversed(chain.blocks)):
         block = b.to_json_compatible()
         block['time'] = datetime_from_utc_to_local(datetime.strptime(block['time'],
                                                                      "%Y-%m-%dT%H:%M:%S.%f UTC")).strftime(
@@ -395,8 +621,14 @@ def get_block_at(at):
     Route: `\"/explorer/blockat/<int:at>\"`
     HTTP Method: `'GET'`
     """
-    chain = cb.primary_block_chain
-    result = chain.blocks[at].to_json_compatible()
+    if store is not None:
+        block = store.block_at(at)
+        if block is None:
+            return json.dumps("Resource not found."), status.HTTP_404_NOT_FOUND
+        result = block.to_json_compatible()
+    else:
+        chain = cb.primary_block_chain
+        result = _full_block(chain.blocks[at]).to_json_compatible()
 
     result['time'] = datetime_from_utc_to_local(datetime.strptime(result['time'],
                                                                   "%Y-%m-%dT%H:%M:%S.%f UTC")).strftime(
@@ -412,16 +644,22 @@ def get_blocks_hash(hash):
     Route: `\"/explorer/block/<string:hash>\"`
     HTTP Method: `'GET'`
     """
-    chain = cb.primary_block_chain
-    for b in chain.blocks:
-        if hexlify(b.hash).decode() == hash:
-            block = b.to_json_compatible()
-            block['time'] = datetime_from_utc_to_local(datetime.strptime(block['time'],
-                                                                         "%Y-%m-%dT%H:%M:%S.%f UTC")).strftime(
-                time_format)
-            return json.dumps(block)
+    try:
+        block_hash = binascii.unhexlify(hash)
+    except binascii.Error:
+        return json.dumps("Resource not found."), status.HTTP_404_NOT_FOUND
+    if store is not None:
+        b = store.block_by_hash(block_hash)
+    else:
+        b = cb.primary_block_chain.get_block_by_hash(block_hash)
+    if b is None:
+        return json.dumps("Resource not found."), status.HTTP_404_NOT_FOUND
 
-    return json.dumps("Resource not found."), status.HTTP_404_NOT_FOUND
+    block = _full_block(b).to_json_compatible()
+    block['time'] = datetime_from_utc_to_local(datetime.strptime(block['time'],
+                                                                 "%Y-%m-%dT%H:%M:%S.%f UTC")).strftime(
+        time_format)
+    return json.dumps(block)
 
 
 @app.route("/explorer/statistics/hashrate", methods=['GET'])
@@ -504,7 +742,7 @@ def get_tps():
 
     transactions = 0
     for i in range(user_input_length):
-        transactions += len(chain.blocks[-1 - i].transactions)
+        transactions += len(_full_block(chain.blocks[-1 - i]).transactions)
 
     time_difference = abs((first_time - second_time).seconds)
     if time_difference == 0:
@@ -0,0 +1,408 @@
+"""
+An in-process simulation of a P2P network, to benchmark how fast blocks and transactions propagate.
+
+A `Simulation` starts a number of nodes, each with its own `Protocol` and `ChainBuilder`, in the
+current process, and connects them in a random topology. Every connection runs over a proxy on the
+loopback interface that emulates a network link with the latency, bandwidth and packet loss of a
+`LinkConfig`. Since a TCP stream cannot lose data, a lost packet is emulated like TCP would handle
+it: the data is delivered one retransmission timeout late, and all data after it waits as well.
+
+The nodes do not look for other peers; they only use the links the simulation creates. Blocks are
+"mined" at random nodes at exponentially distributed intervals, and transactions are created at
+random nodes in the same way. Mined blocks still need a valid proof of work, so the block interval
+should not be shorter than the `DIFFICULTY_TIMEDELTA` per `DIFFICULTY_BLOCK_INTERVAL` blocks the
+difficulty adjusts to; otherwise mining gets slower and slower.
+
+All random choices (topology, schedule and packet loss) are made with random generators seeded with
+the `seed` of the simulation, so that runs with the same parameters are comparable. The timing of
+the threads of the nodes still differs slightly between runs.
+
+The `simulator.py` executable runs a simulation from the command line.
+"""
+
+import asyncio
+import random
+import time
+from collections import namedtuple
+from datetime import datetime
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from .blockchain import GENESIS_BLOCK
+from .chainbuilder import ChainBuilder
+from .crypto import Key
+from .mining_strategy import create_block
+from .proof_of_work import ProofOfWork
+from .protocol import Protocol, PeerConnection
+from .transaction import Transaction, TransactionInput, TransactionTarget
+
+__all__ = ['Simulation', 'LinkConfig', 'percentiles']
+
+SEGMENT_SIZE = 1460
+""" The number of bytes per emulated TCP segment; `LinkConfig.loss` is the loss rate per segment. """
+
+MIN_RETRANSMISSION_TIMEOUT = 0.2
+""" The minimum delay in seconds of data after a lost segment, as in the Linux TCP stack. """
+
+SPLIT_OUTPUTS = 10
+""" The number of coins each transaction of the simulation creates, to have enough coins to spend. """
+
+CONNECT_TIMEOUT = 30
+""" The number of seconds to wait until all links of the simulated network are connected. """
+
+LinkConfig = namedtuple('LinkConfig', ['latency', 'bandwidth', 'loss'])
+LinkConfig.__doc__ = """
+The properties of an emulated network link, in both directions.
+
+:ivar latency: The one-way delay of the link in seconds.
+:ivar bandwidth: The number of bytes per second the link can transfer in each direction.
+:ivar loss: The probability that a TCP segment is lost and has to be retransmitted.
+"""
+
+
+def percentiles(values: List[float], points=(50, 90, 99, 100)) -> 'Dict[str, Optional[float]]':
+    """ Returns the given percentiles of `values` (nearest rank), as a dict like `{'p50': 0.1}`. """
+    values = sorted(values)
+    result = {}
+    for point in points:
+        if not values:
+            result['p{}'.format(point)] = None
+        else:
+            idx = max(0, -(-len(values) * point // 100) - 1)
+            result['p{}'.format(point)] = values[idx]
+    return result
+
+
+class _ShapedStream:
+    """
+    One direction of an emulated link. Data is delivered to `transport` when it would arrive over
+    a link with the given `LinkConfig`, in the order it was sent.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, link: LinkConfig, rng: random.Random):
+        self._loop = loop
+        self._link = link
+        self._rng = rng
+        self._free_at = 0.0
+        self._last_delivery = 0.0
+        self._transport = None
+        self._waiting = []
+        self._closed = False
+
+    def attach(self, transport: asyncio.Transport):
+        """ Sets the transport the data is delivered to, and writes what has already arrived. """
+        self._transport = transport
+        for data in self._waiting:
+            transport.write(data)
+        self._waiting = []
+        if self._closed:
+            transport.close()
+
+    def send(self, data: bytes):
+        now = self._loop.time()
+        start = max(now, self._free_at)
+        self._free_at = start + len(data) / self._link.bandwidth
+        delivery = self._free_at + self._link.latency
+        segments = -(-len(data) // SEGMENT_SIZE)
+        if self._link.loss and self._rng.random() < 1 - (1 - self._link.loss) ** segments:
+            delivery += max(MIN_RETRANSMISSION_TIMEOUT, 2 * self._link.latency)
+        self._last_delivery = delivery = max(delivery, self._last_delivery)
+        self._loop.call_at(delivery, self._deliver, data)
+
+    def _deliver(self, data: bytes):
+        if self._transport is None:
+            self._waiting.append(data)
+        elif not self._transport.is_closing():
+            self._transport.write(data)
+
+    def close(self):
+        """ Closes the receiving side once all data that was sent has been delivered. """
+        self._loop.call_at(max(self._last_delivery, self._loop.time()), self._close)
+
+    def _close(self):
+        self._closed = True
+        if self._transport is not None:
+            self._transport.close()
+
+
+class _ProxySide(asyncio.Protocol):
+    """ One of the two connections of a proxied link. Data it receives is sent on `outgoing`. """
+
+    def __init__(self, outgoing: _ShapedStream, incoming: _ShapedStream):
+        self.outgoing = outgoing
+        self.incoming = incoming
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.incoming.attach(transport)
+
+    def data_received(self, data: bytes):
+        self.outgoing.send(data)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.outgoing.close()
+
+
+class _SimulatedNode(Protocol):
+    """
+    A protocol that only connects to the peers the simulation tells it to, and that mines blocks
+    and creates transactions when the simulation asks it to.
+    """
+
+    def __init__(self, simulation: 'Simulation', index: int, max_peers: int):
+        super().__init__([], GENESIS_BLOCK, 0, "127.0.0.1", max_peers)
+        self.simulation = simulation
+        self.index = index
+        self.chainbuilder = ChainBuilder(self)
+
+    def received_peer(self, peer_addr: list, sender: PeerConnection):
+        """ Peer addresses are ignored; the links are fixed by the simulation. """
+
+    def received_connect_peers(self, _, sender: PeerConnection):
+        """ The links are fixed by the simulation. """
+
+    def received_connect(self, addr: tuple, sender: PeerConnection):
+        """ Connects to `addr`. (Sent by the simulation, not by a peer.) """
+        self.peers.append(PeerConnection(addr, self))
+
+    def received_mine(self, _, sender: PeerConnection):
+        """ Mines a block on top of our primary block chain. (Sent by the simulation.) """
+        chain = self.chainbuilder.primary_block_chain
+        # `create_block` cannot compute the fees of transactions that spend unconfirmed ones
+        transactions = [t for t in self.chainbuilder.unconfirmed_transactions.values()
+                        if all((i.transaction_hash, i.output_idx) in chain.unspent_coins for i in t.inputs)]
+        block = ProofOfWork(create_block(chain, transactions, self.simulation.key)).run()
+        self.simulation._object_created(self, "block", block.hash)
+        self.broadcast_primary_block(block)
+
+    def received_spend(self, _, sender: PeerConnection):
+        """
+        Creates a transaction that splits a confirmed coin no other transaction of the simulation
+        spent yet into `SPLIT_OUTPUTS` coins. (Sent by the simulation.)
+        """
+        coin = self.simulation._unspent_coin(self.chainbuilder.primary_block_chain)
+        if coin is None:
+            return
+        (trans_hash, output_idx), output = coin
+        key = self.simulation.key
+        count = min(SPLIT_OUTPUTS, output.amount)
+        targets = [TransactionTarget(TransactionTarget.pay_to_pubkey(key), output.amount // count)
+                   for _ in range(count)]
+        unsigned = Transaction([TransactionInput(trans_hash, output_idx, "")], targets, datetime.utcnow())
+        trans = Transaction([TransactionInput(trans_hash, output_idx, unsigned.sign(key))], targets,
+                            unsigned.timestamp)
+        self.simulation._object_created(self, "transaction", trans.get_hash())
+        self.received_transaction(trans, self._dummy_peer)
+
+
+class Simulation:
+    """
+    A simulated network of `node_count` nodes. Each node connects to `degree` other nodes chosen at
+    random, so that every node has about `2 * degree` links.
+
+    :ivar nodes: The protocols of all nodes. Each has a `chainbuilder` attribute.
+    :vartype nodes: List[Protocol]
+    :ivar links: The pairs of node indices that are connected, the first one connecting to the second.
+    :vartype links: List[Tuple[int, int]]
+    :ivar key: The key that receives all mining rewards and signs all transactions.
+    :vartype key: Key
+    """
+
+    def __init__(self, node_count: int, degree: int = 4, link: LinkConfig = LinkConfig(0.05, 1e6, 0.0),
+                 seed: int = 0):
+        self._rng = random.Random(seed)
+        self.link = link
+        self.key = Key.generate_private_key()
+        self._lock = Lock()
+        self._created = {"block": {}, "transaction": {}}
+        self._seen = {"block": {}, "transaction": {}}
+        self._orphan_arrivals = 0
+        self._spent_coins = set()
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self._proxy_servers = []
+        self._loss_rng = random.Random(seed + 1)
+
+        self.nodes = [_SimulatedNode(self, i, node_count) for i in range(node_count)]
+        for node in self.nodes:
+            node.block_receive_handlers.append(lambda block, node=node: self._block_seen(node, block))
+            node.trans_batch_receive_handlers.append(
+                lambda transactions, node=node: self._transactions_seen(node, transactions))
+
+        self.links = []
+        for i in range(node_count):
+            others = [j for j in range(node_count) if j != i and (j, i) not in self.links]
+            for j in self._rng.sample(others, min(degree, len(others))):
+                self.links.append((i, j))
+
+        for i, j in self.links:
+            proxy = asyncio.run_coroutine_threadsafe(self._start_proxy(self.nodes[j].server_address),
+                                                     self._loop).result()
+            self.nodes[i].received("connect", proxy, None, 0)
+        self._wait_connected()
+
+    async def _start_proxy(self, dest_addr: tuple) -> tuple:
+        """ Starts a proxy for a link to `dest_addr` and returns the address to connect to. """
+
+        def accept():
+            to_dest = _ShapedStream(self._loop, self.link, self._loss_rng)
+            to_src = _ShapedStream(self._loop, self.link, self._loss_rng)
+            self._loop.create_task(self._loop.create_connection(lambda: _ProxySide(to_src, to_dest),
+                                                                *dest_addr))
+            return _ProxySide(to_dest, to_src)
+
+        server = await self._loop.create_server(accept, "127.0.0.1", 0)
+        self._proxy_servers.append(server)
+        return server.sockets[0].getsockname()
+
+    def shutdown(self):
+        """ Shuts down all nodes and the proxies between them. """
+        for node in self.nodes:
+            node.shutdown()
+        asyncio.run_coroutine_threadsafe(self._stop_proxies(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+
+    async def _stop_proxies(self):
+        for server in self._proxy_servers:
+            server.close()
+        # let the proxies see that the nodes closed their connections
+        await asyncio.sleep(0.1)
+
+    def _wait_connected(self):
+        expected = [0] * len(self.nodes)
+        for i, j in self.links:
+            expected[i] += 1
+            expected[j] += 1
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while any(sum(1 for p in node.peers if p.is_connected) < count
+                  for (node, count) in zip(self.nodes, expected)):
+            if time.monotonic() > deadline:
+                raise TimeoutError("the simulated network did not connect")
+            time.sleep(0.05)
+
+    def _object_created(self, node: _SimulatedNode, obj_type: str, obj_hash: bytes):
+        with self._lock:
+            self._created[obj_type][obj_hash] = (node.index, time.monotonic())
+
+    def _unspent_coin(self, chain) -> 'Optional[Tuple[Tuple[bytes, int], TransactionTarget]]':
+        """
+        Returns a confirmed coin in `chain` that no transaction of the simulation spent yet. The
+        nodes drop unconfirmed transactions that spend unconfirmed ones when a block arrives, so
+        only confirmed coins are spent.
+        """
+        with self._lock:
+            for outpoint, output in chain.unspent_coins.items():
+                if outpoint not in self._spent_coins and output.amount > 0:
+                    self._spent_coins.add(outpoint)
+                    return outpoint, output
+        return None
+
+    def _block_seen(self, node: _SimulatedNode, block):
+        if block.height == 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen["block"].setdefault(node.index, {})
+            if block.hash in seen:
+                return
+            if block.height > 1 and block.prev_block_hash not in seen:
+                self._orphan_arrivals += 1
+            seen[block.hash] = now
+            seen_transactions = self._seen["transaction"].setdefault(node.index, {})
+            for trans in block.transactions[1:]:
+                seen_transactions.setdefault(trans.get_hash(), now)
+
+    def _transactions_seen(self, node: _SimulatedNode, transactions: 'List[Transaction]'):
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen["transaction"].setdefault(node.index, {})
+            for trans in transactions:
+                seen.setdefault(trans.get_hash(), now)
+
+    def run(self, duration: float, block_interval: float = 2.0, tx_rate: float = 10.0,
+            settle_time: float = 5.0) -> dict:
+        """
+        Mines blocks every `block_interval` seconds and creates `tx_rate` transactions per second
+        on average, for `duration` seconds. Then waits `settle_time` seconds for the last objects to
+        propagate, and returns the `report`.
+        """
+        events = []
+        for kind, rate in (("mine", 1 / block_interval), ("spend", tx_rate)):
+            t = 0.0
+            while rate > 0:
+                t += self._rng.expovariate(rate)
+                if t >= duration:
+                    break
+                events.append((t, kind, self._rng.randrange(len(self.nodes))))
+        events.sort()
+
+        start = time.monotonic()
+        for t, kind, node in events:
+            delay = start + t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.nodes[node].received(kind, None, None, 0)
+        time.sleep(max(0.0, start + duration - time.monotonic()) + settle_time)
+        return self.report()
+
+    def _propagation(self, obj_type: str) -> dict:
+        """ Summarizes how long the objects of one type took to reach the other nodes. """
+        delays = []
+        complete = 0
+        with self._lock:
+            created = dict(self._created[obj_type])
+            seen = {node: dict(hashes) for (node, hashes) in self._seen[obj_type].items()}
+        for obj_hash, (origin, created_at) in created.items():
+            reached = [seen.get(node.index, {}).get(obj_hash) for node in self.nodes
+                       if node.index != origin]
+            delays.extend(t - created_at for t in reached if t is not None)
+            complete += all(t is not None for t in reached)
+        others = len(created) * (len(self.nodes) - 1)
+        return {
+            'created': len(created),
+            'coverage': len(delays) / others if others else None,
+            'reached_all': complete,
+            'delay': percentiles(delays),
+        }
+
+    def report(self) -> dict:
+        """
+        Returns a JSON-serializable summary of the simulation so far:
+
+        * 'blocks' and 'transactions': how many were created, the share of (object, node) pairs
+          where the object reached the node, how many reached all nodes, and percentiles of the
+          delays in seconds until they reached the other nodes.
+        * 'stale_rate': the share of mined blocks that are not part of the longest chain of any node.
+        * 'orphan_arrivals': the share of blocks that reached a node before their parent did.
+        * 'traffic': the number of messages and bytes all nodes sent.
+        """
+        best = max((node.chainbuilder.primary_block_chain for node in self.nodes),
+                   key=lambda chain: chain.head.height)
+        blocks = self._propagation("block")
+        with self._lock:
+            mined = list(self._created["block"])
+            arrivals = sum(len(seen) for seen in self._seen["block"].values())
+            orphan_arrivals = self._orphan_arrivals
+        stale = sum(1 for block_hash in mined if block_hash not in best.block_indices)
+
+        traffic = {'messages': 0, 'bytes': 0}
+        for node in self.nodes:
+            for stats in node.network_stats():
+                for sent in stats['sent'].values():
+                    traffic['messages'] += sent['messages']
+                    traffic['bytes'] += sent['bytes']
+
+        return {
+            'nodes': len(self.nodes),
+            'links': len(self.links),
+            'link': self.link._asdict(),
+            'height': best.head.height,
+            'blocks': blocks,
+            'stale_rate': stale / len(mined) if mined else None,
+            'orphan_arrivals': orphan_arrivals / arrivals if arrivals else None,
+            'transactions': self._propagation("transaction"),
+            'traffic': traffic,
+        }
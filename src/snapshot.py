@@ -0,0 +1,292 @@
+"""
+Snapshots of the unspent coins, used to bootstrap new nodes without downloading and validating the
+complete block chain first.
+
+A snapshot is a compact binary file containing the headers of all blocks up to a certain height and
+the unspent coins at that height. It is identified by the SHA-256 hash over its contents. A node
+that loads a snapshot with a trusted hash can serve balances and extend the block chain right away,
+while the `SnapshotValidator` downloads and validates the history in the background.
+
+File format (all integers little-endian)::
+
+    magic (8 bytes) | version (u16) | header count (u64) | headers | coin count (u64) | coins
+
+    header: prev_block_hash | merkle_root_hash | time (i64, microseconds since the epoch) |
+            nonce | target | id
+    coin:   transaction_hash | output_idx (i64) | amount (i64) | pubkey_script
+
+where hashes, scripts and arbitrarily large integers are stored as a u32 length followed by the raw
+bytes.
+"""
+
+import logging
+import os
+import tempfile
+from binascii import hexlify
+from datetime import datetime, timedelta
+from functools import partial
+from struct import calcsize, pack, unpack_from
+from threading import Condition, Thread
+
+from .config import *
+from .crypto import get_hasher
+from .block import Block
+from .blockchain import Blockchain, GENESIS_BLOCK, GENESIS_BLOCK_HASH
+from .transaction import TransactionTarget
+from .utils import compute_blockreward_next_block
+
+__all__ = ['write_utxo_snapshot', 'read_utxo_snapshot', 'utxo_set_hash', 'SnapshotValidator']
+
+SNAPSHOT_MAGIC = b"sarnutxo"
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_DOWNLOAD_WINDOW = 64
+""" The number of blocks the `SnapshotValidator` requests from our peers at the same time. """
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _pack_bytes(val: bytes) -> bytes:
+    return pack("<I", len(val)) + val
+
+
+def _pack_int(val: int) -> bytes:
+    return _pack_bytes(val.to_bytes((val.bit_length() + 8) // 8, 'little', signed=True))
+
+
+def _pack_coins(unspent_coins: dict):
+    """ Yields the encoded unspent coins, in a well-defined order. """
+    for (tx_hash, output_idx), target in sorted(unspent_coins.items(), key=lambda c: c[0]):
+        yield _pack_bytes(tx_hash) + pack("<qq", output_idx, target.amount) + \
+              _pack_bytes(target.pubkey_script.encode())
+
+
+class _Reader:
+    """ Reads the values written by the `_pack_*` functions from a bytes buffer. """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt: str) -> tuple:
+        vals = unpack_from(fmt, self.data, self.pos)
+        self.pos += calcsize(fmt)
+        return vals
+
+    def bytes(self) -> bytes:
+        length, = unpack_from("<I", self.data, self.pos)
+        self.pos += 4 + length
+        if self.pos > len(self.data):
+            raise ValueError("truncated snapshot")
+        return self.data[self.pos - length:self.pos]
+
+    def int(self) -> int:
+        return int.from_bytes(self.bytes(), 'little', signed=True)
+
+
+def utxo_set_hash(unspent_coins: dict) -> bytes:
+    """ Computes a hash over a set of unspent coins, as they would be stored in a snapshot. """
+    hasher = get_hasher()
+    for coin in _pack_coins(unspent_coins):
+        hasher.update(coin)
+    return hasher.digest()
+
+
+def write_utxo_snapshot(chain: 'Blockchain', path: str) -> bytes:
+    """
+    Writes a snapshot of the headers and unspent coins of `chain` to the file at `path`.
+
+    :return: The hash of the snapshot, which a node needs to trust when loading the snapshot.
+    """
+    parts = [SNAPSHOT_MAGIC, pack("<HQ", SNAPSHOT_VERSION, len(chain.blocks))]
+    for block in chain.blocks:
+        micros = (block.time - _EPOCH) // timedelta(microseconds=1)
+        parts.append(_pack_bytes(block.prev_block_hash) + _pack_bytes(block.merkle_root_hash) +
+                     pack("<q", micros) + _pack_int(block.nonce) + _pack_int(block.target) +
+                     _pack_int(block.id))
+    parts.append(pack("<Q", len(chain.unspent_coins)))
+    parts.extend(_pack_coins(chain.unspent_coins))
+    data = b"".join(parts)
+
+    dirname = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile("wb", delete=False, dir=dirname) as fp:
+        try:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+            os.rename(fp.name, path)
+        except Exception as e:
+            os.unlink(fp.name)
+            raise e
+
+    hasher = get_hasher()
+    hasher.update(data)
+    return hasher.digest()
+
+
+def read_utxo_snapshot(path: str, trusted_hash: bytes) -> 'Blockchain':
+    """
+    Reads the snapshot at `path` and returns a block chain with its unspent coins. All blocks of
+    that chain except the genesis block only contain their headers.
+
+    The proof of work, targets and links of the headers are checked, but the transactions are
+    trusted because the snapshot has the hash `trusted_hash`. Raises a `ValueError` otherwise.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    hasher = get_hasher()
+    hasher.update(data)
+    if hasher.digest() != trusted_hash:
+        raise ValueError("the snapshot does not have the trusted hash")
+
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("not a snapshot file")
+    reader = _Reader(data)
+    reader.pos = len(SNAPSHOT_MAGIC)
+    version, = reader.unpack("<H")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("unsupported snapshot version {}".format(version))
+
+    chain = Blockchain()
+    block_count, = reader.unpack("<Q")
+    for height in range(block_count):
+        prev_block_hash = reader.bytes()
+        merkle_root_hash = reader.bytes()
+        micros, = reader.unpack("<q")
+        block = Block(prev_block_hash, _EPOCH + timedelta(microseconds=micros), reader.int(), height,
+                      datetime.utcnow(), reader.int(), [], merkle_root_hash, reader.int())
+        if height == 0:
+            if block.hash != GENESIS_BLOCK_HASH:
+                raise ValueError("the snapshot is for a different genesis block")
+            continue
+
+        block.is_header_only = True
+        if not (block.verify_prev_block(chain.head, chain.compute_target_next_block())
+                and block.verify_difficulty()):
+            raise ValueError("invalid block header at height {}".format(height))
+        chain.block_indices[block.hash] = height
+        chain.blocks.append(block)
+        chain.undo_data.append(None)
+        chain.total_difficulty += GENESIS_TARGET - block.target
+
+    coin_count, = reader.unpack("<Q")
+    for _ in range(coin_count):
+        tx_hash = reader.bytes()
+        output_idx, amount = reader.unpack("<qq")
+        chain.unspent_coins[(tx_hash, output_idx)] = TransactionTarget(reader.bytes().decode(), amount)
+
+    return chain
+
+
+class SnapshotValidator:
+    """
+    Downloads the blocks of a chain that was loaded from a snapshot from our peers, and validates
+    them from the genesis block on in a background thread, once `start` is called. The transactions
+    of validated blocks are filled in to the header-only blocks of the snapshot by the main thread
+    of the protocol. Once all blocks are validated, the unspent coins are compared to those in the
+    snapshot.
+
+    :ivar snapshot_chain: The block chain loaded from the snapshot.
+    :vartype snapshot_chain: Blockchain
+    :ivar validated_height: The height up to which the history has been validated.
+    :vartype validated_height: int
+    :ivar finished: Whether the history has been validated and matches the snapshot.
+    :vartype finished: bool
+    :ivar failed: Whether the history turned out to be invalid or not to match the snapshot. The
+                  snapshot must not be trusted in that case.
+    :vartype failed: bool
+    :ivar failure_handlers: Functions to be called without arguments when the validation fails.
+                            They are called from the background thread.
+    :vartype failure_handlers: List[Callable]
+    :ivar _received: Downloaded blocks that have not been validated yet.
+    :vartype _received: Dict[bytes, Block]
+    """
+
+    def __init__(self, protocol: 'Protocol', snapshot_chain: 'Blockchain'):
+        self.protocol = protocol
+        self.snapshot_chain = snapshot_chain
+        self.validated_height = 0
+        self.finished = False
+        self.failed = False
+        self.failure_handlers = []
+        self._expected_utxo_hash = utxo_set_hash(snapshot_chain.unspent_coins)
+        self._received = {}
+        self._requested = {}
+        self._cond = Condition()
+
+    def start(self):
+        """ Starts validating in the background; the `failure_handlers` should be set up before. """
+        self.protocol.block_receive_handlers.append(self._block_received)
+        Thread(target=self._validator_thread, daemon=True).start()
+
+    def _block_received(self, block: 'Block'):
+        """ Event handler that collects the blocks we are waiting for. """
+        with self._cond:
+            if block.hash in self._requested:
+                del self._requested[block.hash]
+                self._received[block.hash] = block
+                self._cond.notify()
+
+    def _next_block(self, height: int) -> 'Block':
+        """ Waits until the block at `height` was downloaded, requesting it and its successors. """
+        target_hash = self.snapshot_chain.blocks[height].hash
+        with self._cond:
+            while target_hash not in self._received:
+                if not any(peer.is_connected for peer in self.protocol.peers):
+                    self._cond.wait(1)
+                    continue
+                now = datetime.utcnow()
+                last = min(height + SNAPSHOT_DOWNLOAD_WINDOW, len(self.snapshot_chain.blocks))
+                for header in self.snapshot_chain.blocks[height:last]:
+                    if header.hash in self._received:
+                        continue
+                    if self._requested.get(header.hash, _EPOCH) + BLOCK_REQUEST_RETRY_INTERVAL < now:
+                        self._requested[header.hash] = now
+                        self.protocol.send_block_request(header.hash)
+                self._cond.wait(BLOCK_REQUEST_RETRY_INTERVAL.total_seconds())
+            return self._received.pop(target_hash)
+
+    def _validator_thread(self):
+        unspent_coins = {}
+        for tx in GENESIS_BLOCK.transactions:
+            for i, target in enumerate(tx.targets):
+                if target.is_pay_to_pubkey or target.is_pay_to_pubkey_lock:
+                    unspent_coins[(tx.get_hash(), i)] = target
+
+        headers = self.snapshot_chain.blocks
+        for height in range(1, len(headers)):
+            block = self._next_block(height)
+            header = headers[height]
+            if not block.verify(headers[height - 1], header.target, unspent_coins, {},
+                                compute_blockreward_next_block(height - 1)):
+                logging.error("block %s of the snapshot history is invalid", hexlify(block.hash))
+                self._fail()
+                return
+            Blockchain.apply_block(unspent_coins, block)
+
+            self.protocol.call_in_main_thread(partial(self._fill_in, header, block))
+            self.validated_height = height
+            if height % 1000 == 0:
+                logging.info("validated snapshot history up to height %d", height)
+
+        if utxo_set_hash(unspent_coins) != self._expected_utxo_hash:
+            logging.error("the unspent coins of the snapshot do not match its block chain")
+            self._fail()
+            return
+        self.protocol.call_in_main_thread(self._finish)
+
+    @staticmethod
+    def _fill_in(header: 'Block', block: 'Block'):
+        """ Fills the transactions of the validated `block` in to its header in the snapshot chain. """
+        header.transactions = block.transactions
+        header.is_header_only = False
+
+    def _finish(self):
+        """ Called by the main thread once all blocks are filled in. """
+        self.finished = True
+        logging.info("snapshot history validated")
+
+    def _fail(self):
+        self.failed = True
+        for handler in self.failure_handlers:
+            handler()
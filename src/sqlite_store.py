@@ -0,0 +1,323 @@
+"""
+An optional index of the primary block chain in an SQLite database, to answer the lookups of the
+RPC server (blocks by hash or height, transactions by hash, balances and address histories) without
+scanning the whole block chain.
+
+The `SqliteStore` follows the primary block chain of a `ChainBuilder`: a background thread writes
+every newly connected block in one database transaction, and removes the blocks that are no longer
+part of the primary block chain after a reorganization. The database uses write-ahead logging, so
+that the RPC server can read from it while it is being written.
+
+Tables::
+
+    headers(height, hash, prev_block_hash, time, target, transaction_count)
+    blocks(height, data)                          -- the block in the binary wire encoding
+    transactions(hash, height, position)
+    utxos(transaction_hash, output_idx, address, pubkey_script, amount, height, spent_height)
+    address_history(address, height, position, transaction_hash, sent)
+
+Spent coins stay in the `utxos` table with the height of the block that spent them, so that a
+reorganization can restore them. Addresses are the public keys of pay-to-pubkey outputs, in the
+format of `Key.as_bytes`.
+
+The RPC server reads the unspent coins of addresses from the store (see `SqliteStore.unspent_coins`),
+but the validation of blocks still uses the unspent coins of the in-memory `Blockchain`.
+"""
+
+import logging
+import sqlite3
+from collections import OrderedDict
+from threading import Condition, Lock, Thread, local
+from typing import Callable, List, Optional, Tuple
+
+from .crypto import Key
+from .transaction import TransactionTarget
+from .wire import encode_binary, decode_binary
+
+__all__ = ['SqliteStore']
+
+CACHE_SIZE = 1024
+""" The maximum number of decoded blocks and transactions the `SqliteStore` keeps in memory. """
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    height INTEGER PRIMARY KEY,
+    hash BLOB NOT NULL UNIQUE,
+    prev_block_hash BLOB NOT NULL,
+    time TEXT NOT NULL,
+    target TEXT NOT NULL,
+    transaction_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    height INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    hash BLOB PRIMARY KEY,
+    height INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_height ON transactions (height);
+CREATE TABLE IF NOT EXISTS utxos (
+    transaction_hash BLOB NOT NULL,
+    output_idx INTEGER NOT NULL,
+    address BLOB NOT NULL,
+    pubkey_script TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    spent_height INTEGER,
+    PRIMARY KEY (transaction_hash, output_idx)
+);
+CREATE INDEX IF NOT EXISTS utxos_address ON utxos (address, spent_height);
+CREATE INDEX IF NOT EXISTS utxos_height ON utxos (height);
+CREATE INDEX IF NOT EXISTS utxos_spent_height ON utxos (spent_height);
+CREATE TABLE IF NOT EXISTS address_history (
+    address BLOB NOT NULL,
+    height INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    transaction_hash BLOB NOT NULL,
+    sent INTEGER NOT NULL,
+    PRIMARY KEY (address, height, position, sent)
+);
+CREATE INDEX IF NOT EXISTS address_history_height ON address_history (height);
+"""
+
+
+class _LRUCache:
+    """ A thread-safe mapping that forgets the least recently used entries beyond `max_size`. """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            val = self._entries.get(key)
+            if val is not None:
+                self._entries.move_to_end(key)
+            return val
+
+    def put(self, key, val):
+        with self._lock:
+            self._entries[key] = val
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SqliteStore:
+    """
+    An index of the primary block chain of `chainbuilder` in the SQLite database at `path`.
+    The lookup methods are thread-safe.
+
+    Blocks of which the primary block chain only contains the header are read with `block_source`,
+    e.g. `Persistence.block_by_hash`. Without it, the index stops before the first such block.
+
+    :ivar path: The path of the database.
+    :vartype path: str
+    :ivar height: The height of the last block that was written to the database.
+    :vartype height: int
+    """
+
+    def __init__(self, path: str, chainbuilder: 'ChainBuilder',
+                 block_source: 'Optional[Callable[[bytes], Optional[Block]]]' = None):
+        self.path = path
+        self.block_source = block_source
+        self._local = local()
+        self._cache = _LRUCache(CACHE_SIZE)
+        self._store_cond = Condition()
+        self._store_chain = None
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        self._hashes = [row[0] for row in conn.execute("SELECT hash FROM headers ORDER BY height")]
+        self._hashes_lock = Lock()
+        self.height = len(self._hashes) - 1
+
+        chainbuilder.chain_change_handlers.append(self.store)
+        self.chainbuilder = chainbuilder
+        Thread(target=self._store_thread, daemon=True).start()
+        self.store()
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Returns the database connection of the current thread. """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def store(self):
+        """
+        Asynchronously updates the database to the current primary block chain.
+
+        Used as an event handler in the chainbuilder.
+        """
+        with self._store_cond:
+            self._store_chain = self.chainbuilder.primary_block_chain
+            self._store_cond.notify()
+
+    def _store_thread(self):
+        conn = self._connection()
+        while True:
+            with self._store_cond:
+                while self._store_chain is None:
+                    self._store_cond.wait()
+                chain = self._store_chain
+                self._store_chain = None
+
+            fork = min(len(self._hashes), len(chain.blocks)) - 1
+            while fork >= 0 and self._hashes[fork] != chain.blocks[fork].hash:
+                fork -= 1
+            if fork < len(self._hashes) - 1:
+                with conn:
+                    self._disconnect_blocks(conn, fork)
+                with self._hashes_lock:
+                    del self._hashes[fork + 1:]
+                self.height = fork
+                logging.info("removed the blocks after height %d from %s", fork, self.path)
+            for block in chain.blocks[fork + 1:]:
+                if block.is_header_only and self.block_source is not None:
+                    block = self.block_source(block.hash) or block
+                if block.is_header_only:
+                    # the transactions are needed to keep track of the unspent coins
+                    break
+                with conn:
+                    self._connect_block(conn, block)
+                with self._hashes_lock:
+                    self._hashes.append(block.hash)
+                self.height = block.height
+
+    @staticmethod
+    def _address(target: 'TransactionTarget') -> Optional[bytes]:
+        if target.is_pay_to_pubkey or target.is_pay_to_pubkey_lock:
+            return target.get_pubkey.as_bytes()
+        return None
+
+    def _connect_block(self, conn: sqlite3.Connection, block: 'Block'):
+        height = block.height
+        conn.execute("INSERT INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                     (height, block.hash, block.prev_block_hash, block.time.isoformat(),
+                      str(block.target), len(block.transactions)))
+        conn.execute("INSERT INTO blocks VALUES (?, ?)", (height, encode_binary(block)))
+        for position, trans in enumerate(block.transactions):
+            trans_hash = trans.get_hash()
+            conn.execute("INSERT OR REPLACE INTO transactions VALUES (?, ?, ?)",
+                         (trans_hash, height, position))
+            for inp in trans.inputs:
+                if inp.is_coinbase:
+                    continue
+                coin = (inp.transaction_hash, inp.output_idx)
+                row = conn.execute("SELECT address FROM utxos WHERE transaction_hash = ? AND output_idx = ?",
+                                   coin).fetchone()
+                if row is None:
+                    continue
+                conn.execute("UPDATE utxos SET spent_height = ? WHERE transaction_hash = ? AND output_idx = ?",
+                             (height,) + coin)
+                conn.execute("INSERT OR IGNORE INTO address_history VALUES (?, ?, ?, ?, 1)",
+                             (row[0], height, position, trans_hash))
+            for idx, target in enumerate(trans.targets):
+                address = self._address(target)
+                if address is None:
+                    continue
+                conn.execute("INSERT OR REPLACE INTO utxos VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                             (trans_hash, idx, address, target.pubkey_script, target.amount, height))
+                conn.execute("INSERT OR IGNORE INTO address_history VALUES (?, ?, ?, ?, 0)",
+                             (address, height, position, trans_hash))
+
+    @staticmethod
+    def _disconnect_blocks(conn: sqlite3.Connection, height: int):
+        """ Removes all blocks after `height`, and restores the coins they spent. """
+        for table in ("headers", "blocks", "transactions", "utxos", "address_history"):
+            conn.execute("DELETE FROM {} WHERE height > ?".format(table), (height,))
+        conn.execute("UPDATE utxos SET spent_height = NULL WHERE spent_height > ?", (height,))
+
+    def _decode_block(self, block_hash: bytes, data: bytes) -> 'Block':
+        block = self._cache.get(block_hash)
+        if block is None:
+            block = decode_binary(data)
+            self._cache.put(block_hash, block)
+        return block
+
+    def _is_primary(self, block: 'Block') -> bool:
+        """ Whether `block` is still part of the stored primary block chain, i.e. not orphaned. """
+        with self._hashes_lock:
+            return block.height < len(self._hashes) and self._hashes[block.height] == block.hash
+
+    def block_at(self, height: int) -> 'Optional[Block]':
+        """ Returns the block at `height` of the primary block chain. """
+        row = self._connection().execute(
+            "SELECT headers.hash, data FROM headers JOIN blocks USING (height) WHERE height = ?",
+            (height,)).fetchone()
+        return None if row is None else self._decode_block(*row)
+
+    def block_by_hash(self, block_hash: bytes) -> 'Optional[Block]':
+        """ Returns the block with the hash `block_hash`, if it is part of the primary block chain. """
+        block = self._cache.get(block_hash)
+        if block is not None and self._is_primary(block):
+            return block
+        row = self._connection().execute(
+            "SELECT data FROM headers JOIN blocks USING (height) WHERE hash = ?", (block_hash,)).fetchone()
+        return None if row is None else self._decode_block(block_hash, row[0])
+
+    def transaction(self, trans_hash: bytes) -> 'Optional[Tuple[Transaction, Block]]':
+        """ Returns a confirmed transaction and the block it is in. """
+        row = self._connection().execute(
+            "SELECT height, position FROM transactions WHERE hash = ?", (trans_hash,)).fetchone()
+        if row is None:
+            return None
+        block = self.block_at(row[0])
+        if block is None:
+            return None
+        return block.transactions[row[1]], block
+
+    def balance(self, key: Key) -> int:
+        """ Returns the sum of the unspent coins of the public key `key`. """
+        row = self._connection().execute(
+            "SELECT SUM(amount) FROM utxos WHERE address = ? AND spent_height IS NULL",
+            (key.as_bytes(),)).fetchone()
+        return row[0] or 0
+
+    def address_history(self, key: Key) -> 'List[Tuple[Transaction, Block, bool]]':
+        """
+        Returns the confirmed transactions that pay to the public key `key` or spend its coins, in
+        the order of the block chain, with the blocks they are in and whether they spend its coins.
+        """
+        rows = self._connection().execute(
+            "SELECT height, position, sent FROM address_history WHERE address = ? "
+            "ORDER BY height, position, sent", (key.as_bytes(),)).fetchall()
+        result = []
+        for height, position, sent in rows:
+            block = self.block_at(height)
+            if block is not None:
+                result.append((block.transactions[position], block, bool(sent)))
+        return result
+
+    def unspent_coins(self, key: Key) -> 'List[Tuple[Tuple[bytes, int], TransactionTarget]]':
+        """
+        Returns the unspent coins of the public key `key`, in the format of the items of
+        `Blockchain.unspent_coins`, ordered by the height of the block that created them.
+        """
+        rows = self._connection().execute(
+            "SELECT transaction_hash, output_idx, pubkey_script, amount FROM utxos "
+            "WHERE address = ? AND spent_height IS NULL ORDER BY height, transaction_hash, output_idx",
+            (key.as_bytes(),)).fetchall()
+        return [((trans_hash, idx), TransactionTarget(pubkey_script, amount))
+                for trans_hash, idx, pubkey_script, amount in rows]
+
+    def first_payments(self, height: int, position: int,
+                       limit: Optional[int]) -> 'List[Tuple[bytes, int, int]]':
+        """
+        Returns up to `limit` (or all) addresses with the height and position of the first
+        transaction that paid to them, ordered by these, starting with the transaction at `height`
+        and `position`.
+        """
+        return self._connection().execute(
+            "SELECT address, height, position FROM address_history AS first "
+            "WHERE sent = 0 AND (height, position) >= (?, ?) AND NOT EXISTS ("
+            "    SELECT 1 FROM address_history WHERE address = first.address AND sent = 0 AND "
+            "    (height, position) < (first.height, first.position)) "
+            "ORDER BY height, position, address LIMIT ?",
+            (height, position, -1 if limit is None else limit)).fetchall()
@@ -224,6 +224,19 @@ class Transaction:
             return False
         return True
 
+    def verify_syntax(self) -> bool:
+        """
+        Verifies the parts of this transaction that do not depend on a block chain, and computes
+        its hash.
+        """
+        self.get_hash()
+        if not self.inputs or not self._verify_amounts():
+            return False
+        if len(self.inputs) > 1 and any(inp.is_coinbase for inp in self.inputs):
+            logging.warning("A coinbase transaction can only have one coinbase.")
+            return False
+        return True
+
     def validate_tx(self, unspent_coins: dict) -> bool:
         """
         Validate the transaction
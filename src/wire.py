@@ -0,0 +1,566 @@
+"""
+Encodings of P2P messages on the wire.
+
+Two peers agree on one of the encodings in `ENCODINGS` during the handshake (see `protocol`). The
+`json` encoding is understood by every peer and used as the fallback.
+
+The binary encoding (`bin1`) is a compact, self-describing encoding of the same JSON-compatible
+values. Every value starts with a one-byte tag, followed by its data. Integers are stored as
+zigzag-encoded variable-length integers, strings, lists and dicts are prefixed with their length.
+Some kinds of strings that are common in our messages are stored more compactly:
+
+* lower-case hex strings (hashes, signatures, keys) are stored as the raw bytes they represent,
+* scripts are split into their tokens, so that hex-encoded data in a script is stored as raw bytes,
+* timestamps in our `"%Y-%m-%dT%H:%M:%S.%f UTC"` format are stored as microseconds since the epoch,
+* dict keys from `_KNOWN_KEYS` are stored as a single byte.
+
+`Block` and `Transaction` objects are encoded directly with their fields in a fixed order and
+decoded into objects again, without going through their JSON-compatible representation. Decoding
+any other value yields exactly the JSON-compatible value that was encoded. The `json` encoding
+converts objects to their JSON-compatible representation.
+
+Encoded messages are framed with their decimal length and a new-line (see `frame_message`). The
+`MessageFramer` splits a stream of framed messages into the individual messages again.
+
+If two peers agree on one or more of the `COMPRESSIONS`, each encoded message is prefixed with a
+byte indicating how the rest of it is compressed (see `compress_message`). Small messages are sent
+uncompressed, large ones with zlib, and bulk transfers with lzma.
+"""
+
+import json
+import lzma
+import re
+import zlib
+from binascii import hexlify
+from datetime import datetime, timedelta
+from struct import pack, unpack_from
+from typing import List, Optional, Tuple, Union
+
+from .block import Block
+from .transaction import Transaction, TransactionInput, TransactionTarget
+
+__all__ = ['ENCODINGS', 'JSON_ENCODING', 'BINARY_ENCODING', 'encode_binary', 'decode_binary',
+           'COMPRESSIONS', 'compress_message', 'decompress_message', 'frame_message', 'MessageFramer']
+
+JSON_ENCODING = "json"
+BINARY_ENCODING = "bin1"
+
+READ_BUFFER_SIZE = 64 * 1024
+""" The minimum amount of free space the `MessageFramer` offers for each read from a socket. """
+
+ZLIB_THRESHOLD = 1024
+""" The minimum size of an encoded message to be compressed with zlib. """
+
+LZMA_THRESHOLD = 256 * 1024
+""" The minimum size of an encoded message to be compressed with lzma, which is slower than zlib. """
+
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+""" The maximum size of a compressed message after decompressing it. """
+
+MAX_FRAME_SIZE = MAX_DECOMPRESSED_SIZE
+"""
+The maximum length of a framed message. The `MessageFramer` rejects longer messages when it reads
+their length prefix, before it allocates memory for them.
+"""
+
+MAX_LENGTH_PREFIX = 20
+""" The maximum number of bytes of the length prefix of a framed message, including the new-line. """
+
+_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f UTC"
+_EPOCH = datetime(1970, 1, 1)
+
+_TIME_RE = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{6} UTC")
+
+_TAG_NONE = 0
+_TAG_FALSE = 1
+_TAG_TRUE = 2
+_TAG_INT = 3
+_TAG_FLOAT = 4
+_TAG_STR = 5
+_TAG_HEX = 6
+_TAG_LIST = 7
+_TAG_DICT = 8
+_TAG_SCRIPT = 9
+_TAG_TIME = 10
+_TAG_BLOCK = 11
+_TAG_TRANSACTION = 12
+
+_KNOWN_KEYS = ['msg_type', 'msg_param', 'id', 'hash', 'prev_block_hash', 'merkle_root_hash', 'time',
+               'nonce', 'height', 'target', 'transactions', 'inputs', 'targets', 'timestamp', 'iv',
+               'transaction_hash', 'output_idx', 'sig_script', 'pubkey_script', 'amount']
+""" Dict keys that are encoded as a single byte. The order must never change within a version. """
+_KNOWN_KEY_INDICES = {key: i + 1 for (i, key) in enumerate(_KNOWN_KEYS)}
+
+
+def _write_varint(out: bytearray, val: int):
+    """ Appends the non-negative integer `val` in LEB128 encoding. """
+    if val < 0x80:
+        out.append(val)
+        return
+    while val >= 0x80:
+        out.append((val & 0x7f) | 0x80)
+        val >>= 7
+    out.append(val)
+
+
+def _write_str(out: bytearray, val: str):
+    data = val.encode()
+    _write_varint(out, len(data))
+    out += data
+
+
+def _write_zigzag(out: bytearray, val: int):
+    """ Appends the integer `val` in zigzag encoding. """
+    _write_varint(out, val * 2 if val >= 0 else -val * 2 - 1)
+
+
+def _write_bytes(out: bytearray, val: bytes):
+    _write_varint(out, len(val))
+    out += val
+
+
+def _write_time(out: bytearray, val: datetime):
+    _write_zigzag(out, (val - _EPOCH) // timedelta(microseconds=1))
+
+
+def _write_transaction(out: bytearray, tx: 'Transaction'):
+    if tx.iv is None:
+        out.append(_TAG_NONE)
+    else:
+        out.append(_TAG_HEX)
+        _write_bytes(out, tx.iv)
+    _write_time(out, tx.timestamp)
+    _write_varint(out, len(tx.inputs))
+    for inp in tx.inputs:
+        _write_bytes(out, inp.transaction_hash)
+        _write_zigzag(out, inp.output_idx)
+        _write_value(out, inp.sig_script)
+    _write_varint(out, len(tx.targets))
+    for target in tx.targets:
+        _write_value(out, target.pubkey_script)
+        _write_zigzag(out, target.amount)
+
+
+def _write_block(out: bytearray, block: 'Block'):
+    _write_bytes(out, block.prev_block_hash)
+    _write_bytes(out, block.merkle_root_hash)
+    _write_time(out, block.time)
+    _write_zigzag(out, block.nonce)
+    _write_zigzag(out, block.height)
+    _write_zigzag(out, block.target)
+    _write_zigzag(out, block.id)
+    _write_varint(out, len(block.transactions))
+    for tx in block.transactions:
+        _write_transaction(out, tx)
+
+
+def _from_hex(val: str) -> 'Optional[bytes]':
+    """ Returns the bytes represented by `val` if it is a non-empty lower-case hex string. """
+    try:
+        data = bytes.fromhex(val)
+    except ValueError:
+        return None
+    if data and data.hex() == val:
+        return data
+    return None
+
+
+def _write_token(out: bytearray, val: str):
+    """ Writes a string that is known not to be a timestamp or script. """
+    data = _from_hex(val)
+    if data is not None:
+        out.append(_TAG_HEX)
+        _write_bytes(out, data)
+    else:
+        out.append(_TAG_STR)
+        _write_str(out, val)
+
+
+def _write_value(out: bytearray, val):
+    if val is None:
+        out.append(_TAG_NONE)
+    elif val is True:
+        out.append(_TAG_TRUE)
+    elif val is False:
+        out.append(_TAG_FALSE)
+    elif isinstance(val, int):
+        out.append(_TAG_INT)
+        _write_zigzag(out, val)
+    elif isinstance(val, float):
+        out.append(_TAG_FLOAT)
+        out += pack("<d", val)
+    elif isinstance(val, str):
+        if " " in val:
+            if _TIME_RE.fullmatch(val):
+                time = datetime.strptime(val, _TIME_FORMAT)
+                if time.strftime(_TIME_FORMAT) == val:
+                    out.append(_TAG_TIME)
+                    _write_time(out, time)
+                    return
+            tokens = val.split(" ")
+            if all(tokens) and any(_from_hex(t) is not None for t in tokens):
+                out.append(_TAG_SCRIPT)
+                _write_varint(out, len(tokens))
+                for token in tokens:
+                    _write_token(out, token)
+                return
+            out.append(_TAG_STR)
+            _write_str(out, val)
+        else:
+            _write_token(out, val)
+    elif isinstance(val, (list, tuple)):
+        out.append(_TAG_LIST)
+        _write_varint(out, len(val))
+        for item in val:
+            _write_value(out, item)
+    elif isinstance(val, dict):
+        out.append(_TAG_DICT)
+        _write_varint(out, len(val))
+        for key, item in val.items():
+            idx = _KNOWN_KEY_INDICES.get(key)
+            if idx is None:
+                out.append(0)
+                _write_str(out, key)
+            else:
+                out.append(idx)
+            _write_value(out, item)
+    elif isinstance(val, Transaction):
+        out.append(_TAG_TRANSACTION)
+        _write_transaction(out, val)
+    elif isinstance(val, Block):
+        out.append(_TAG_BLOCK)
+        _write_block(out, val)
+    else:
+        raise TypeError("cannot encode values of type {}".format(type(val).__name__))
+
+
+def encode_binary(val) -> bytes:
+    """ Encodes a JSON-compatible value in the binary encoding. """
+    out = bytearray()
+    _write_value(out, val)
+    return bytes(out)
+
+
+class _Decoder:
+    """ Decodes one value in the binary encoding from a buffer. """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def varint(self) -> int:
+        data = self.data
+        pos = self.pos
+        val = data[pos]
+        pos += 1
+        if val >= 0x80:
+            val &= 0x7f
+            shift = 7
+            while True:
+                byte = data[pos]
+                pos += 1
+                val |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+        self.pos = pos
+        return val
+
+    def zigzag(self) -> int:
+        val = self.varint()
+        return val >> 1 if not val & 1 else -((val + 1) >> 1)
+
+    def time(self) -> datetime:
+        return _EPOCH + timedelta(microseconds=self.zigzag())
+
+    def transaction(self) -> 'Transaction':
+        iv = self.value()
+        timestamp = self.time()
+        inputs = [TransactionInput(self.raw(), self.zigzag(), self.value()) for _ in range(self.varint())]
+        targets = [TransactionTarget(self.value(), self.zigzag()) for _ in range(self.varint())]
+        return Transaction(inputs, targets, timestamp, None if iv is None else bytes.fromhex(iv))
+
+    def block(self) -> 'Block':
+        prev_block_hash = self.raw()
+        merkle_root_hash = self.raw()
+        time = self.time()
+        nonce, height, target, id = self.zigzag(), self.zigzag(), self.zigzag(), self.zigzag()
+        transactions = [self.transaction() for _ in range(self.varint())]
+        return Block(prev_block_hash, time, nonce, height, datetime.utcnow(), target, transactions,
+                     merkle_root_hash, id)
+
+    def raw(self) -> bytes:
+        length = self.varint()
+        end = self.pos + length
+        if end > len(self.data):
+            raise ValueError("truncated message")
+        val = bytes(self.data[self.pos:end])
+        self.pos = end
+        return val
+
+    def value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == _TAG_STR:
+            return self.raw().decode()
+        elif tag == _TAG_HEX:
+            return hexlify(self.raw()).decode()
+        elif tag == _TAG_INT:
+            return self.zigzag()
+        elif tag == _TAG_DICT:
+            val = {}
+            for _ in range(self.varint()):
+                idx = self.data[self.pos]
+                self.pos += 1
+                key = _KNOWN_KEYS[idx - 1] if idx else self.raw().decode()
+                val[key] = self.value()
+            return val
+        elif tag == _TAG_LIST:
+            return [self.value() for _ in range(self.varint())]
+        elif tag == _TAG_SCRIPT:
+            return " ".join(self.value() for _ in range(self.varint()))
+        elif tag == _TAG_TRANSACTION:
+            return self.transaction()
+        elif tag == _TAG_BLOCK:
+            return self.block()
+        elif tag == _TAG_TIME:
+            return self.time().strftime(_TIME_FORMAT)
+        elif tag == _TAG_NONE:
+            return None
+        elif tag == _TAG_TRUE:
+            return True
+        elif tag == _TAG_FALSE:
+            return False
+        elif tag == _TAG_FLOAT:
+            val, = unpack_from("<d", self.data, self.pos)
+            self.pos += 8
+            return val
+        raise ValueError("unknown tag {}".format(tag))
+
+
+def decode_binary(data) -> object:
+    """ Decodes a value in the binary encoding from a bytes-like object. """
+    decoder = _Decoder(data)
+    val = decoder.value()
+    if decoder.pos != len(data):
+        raise ValueError("trailing data after message")
+    return val
+
+
+def _encode_json(val) -> bytes:
+    return json.dumps(val, indent=4, default=lambda o: o.to_json_compatible()).encode() + b"\n"
+
+
+def _decode_json(data) -> object:
+    return json.loads(bytes(data).decode())
+
+
+ENCODINGS = {
+    BINARY_ENCODING: (encode_binary, decode_binary),
+    JSON_ENCODING: (_encode_json, _decode_json),
+}
+"""
+The encodings we support, with their encode and decode functions, in the order of preference.
+"""
+
+
+_UNCOMPRESSED = b"\x00"
+_ZLIB = b"\x01"
+_LZMA = b"\x02"
+
+COMPRESSIONS = ['zlib', 'lzma']
+""" The compression methods we support. """
+
+
+def compress_message(data: bytes, compressions: 'List[str]') -> 'Tuple[bytes, bytes]':
+    """
+    Compresses an encoded message with the best of `compressions` for its size.
+
+    :return: The compression flag byte and the (possibly compressed) message.
+    """
+    if len(data) >= LZMA_THRESHOLD and 'lzma' in compressions:
+        flag, compressed = _LZMA, lzma.compress(data)
+    elif len(data) >= ZLIB_THRESHOLD and 'zlib' in compressions:
+        flag, compressed = _ZLIB, zlib.compress(data)
+    else:
+        return _UNCOMPRESSED, data
+    if len(compressed) >= len(data):
+        return _UNCOMPRESSED, data
+    return flag, compressed
+
+
+def decompress_message(data) -> 'Union[bytes, memoryview]':
+    """ Decompresses a message with a compression flag byte, as created by `compress_message`. """
+    flag = data[:1]
+    if flag == _UNCOMPRESSED:
+        return data[1:]
+    if flag == _ZLIB:
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data[1:], MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("compressed message too large")
+    elif flag == _LZMA:
+        decompressor = lzma.LZMADecompressor()
+        result = decompressor.decompress(data[1:], MAX_DECOMPRESSED_SIZE)
+        if not decompressor.eof:
+            raise ValueError("compressed message too large or truncated")
+    else:
+        raise ValueError("unknown compression {}".format(flag))
+    return result
+
+
+def frame_message(data: bytes) -> bytes:
+    """ Prefixes an encoded message with its length. """
+    return b"%d\n%s" % (len(data), data)
+
+
+class MessageFramer:
+    """
+    Splits a stream of framed messages into the individual messages.
+
+    Data is read directly into a buffer that is reused for all messages: a reader writes into the
+    memory returned by `get_buffer` (e.g. with `socket.recv_into`) and reports the number of bytes
+    it wrote with `buffer_updated`. `messages` then returns views of all complete messages in the
+    buffer, so that one read can yield many small messages without copying them. Only the start of
+    an incomplete message at the end of the buffer is moved to the front when more space is needed.
+    Messages that must outlive the next read are returned by `take_messages` instead.
+
+    :ivar _buf: The buffer the data is read into.
+    :vartype _buf: bytearray
+    :ivar _start: The offset of the first byte in `_buf` that was not consumed yet.
+    :vartype _start: int
+    :ivar _end: The offset after the last byte in `_buf` that was read.
+    :vartype _end: int
+    :ivar _msg_length: The length of the message at `_start`, if its length prefix was consumed.
+    :vartype _msg_length: Optional[int]
+    """
+
+    def __init__(self):
+        self._buf = bytearray(2 * READ_BUFFER_SIZE)
+        self._start = 0
+        self._end = 0
+        self._msg_length = None
+
+    @property
+    def has_partial_message(self) -> bool:
+        """ Whether the buffer contains the start of a message that is not complete yet. """
+        return self._start != self._end or self._msg_length is not None
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        """ Returns the memory the next read should write into. """
+        if self._start == self._end:
+            self._start = self._end = 0
+
+        needed = max(READ_BUFFER_SIZE, sizehint)
+        if self._msg_length is not None:
+            needed = max(needed, self._msg_length - (self._end - self._start))
+
+        if len(self._buf) - self._end < needed:
+            pending = self._end - self._start
+            if len(self._buf) < pending + needed:
+                buf = bytearray(pending + needed)
+                buf[:pending] = memoryview(self._buf)[self._start:self._end]
+                self._buf = buf
+            else:
+                self._buf[:pending] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = pending
+
+        return memoryview(self._buf)[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        """ Records that `nbytes` were written into the memory returned by `get_buffer`. """
+        self._end += nbytes
+
+    def read_line(self, max_length: int) -> 'Optional[bytes]':
+        """
+        Consumes a new-line terminated line of at most `max_length` bytes from the buffer, for data
+        that is sent without framing. Returns `None` if the line is not complete yet.
+        """
+        newline = self._buf.find(b"\n", self._start, min(self._end, self._start + max_length))
+        if newline < 0:
+            if self._end - self._start >= max_length:
+                raise ValueError("line too long")
+            return None
+        line = bytes(self._buf[self._start:newline + 1])
+        self._start = newline + 1
+        return line
+
+    def _read_length(self) -> bool:
+        """ Consumes the length prefix of the next message, if necessary. Returns whether it is known. """
+        if self._msg_length is None:
+            newline = self._buf.find(b"\n", self._start, min(self._end, self._start + MAX_LENGTH_PREFIX))
+            if newline < 0:
+                if self._end - self._start >= MAX_LENGTH_PREFIX:
+                    raise ValueError("invalid message length prefix")
+                return False
+            length = int(bytes(self._buf[self._start:newline]))
+            if not 0 <= length <= MAX_FRAME_SIZE:
+                raise ValueError("invalid message length prefix")
+            self._msg_length = length
+            self._start = newline + 1
+        return True
+
+    def read_message(self, max_length: int) -> 'Optional[bytes]':
+        """
+        Consumes the next message, which must not be longer than `max_length` bytes, and returns a
+        copy of it. Returns `None` if the message is not complete yet.
+        """
+        if not self._read_length():
+            return None
+        if self._msg_length > max_length:
+            raise ValueError("message too long")
+        end = self._start + self._msg_length
+        if end > self._end:
+            return None
+        msg = bytes(self._buf[self._start:end])
+        self._start = end
+        self._msg_length = None
+        return msg
+
+    def take_messages(self) -> 'List[Union[bytes, memoryview]]':
+        """
+        Consumes the complete messages in the buffer and returns them such that they stay valid
+        after the next read, e.g. to decode them in another thread. If they take up at least
+        `READ_BUFFER_SIZE` bytes, like a large block, the buffer is handed over with them, and the
+        framer continues with a new one that only gets the start of an incomplete message. Smaller
+        messages are copied, which is cheaper than a new buffer.
+        """
+        spans = []
+        while self._read_length():
+            end = self._start + self._msg_length
+            if end > self._end:
+                break
+            spans.append((self._start, end))
+            self._start = end
+            self._msg_length = None
+        if not spans or spans[-1][1] - spans[0][0] < READ_BUFFER_SIZE:
+            return [bytes(self._buf[start:end]) for start, end in spans]
+
+        buf = self._buf
+        pending = self._end - self._start
+        self._buf = bytearray(max(2 * READ_BUFFER_SIZE, pending + READ_BUFFER_SIZE))
+        self._buf[:pending] = memoryview(buf)[self._start:self._end]
+        self._start = 0
+        self._end = pending
+        view = memoryview(buf)
+        return [view[start:end] for start, end in spans]
+
+    def messages(self):
+        """
+        Yields views of the complete messages in the buffer. A view is only valid until the next
+        call of `get_buffer`.
+        """
+        view = memoryview(self._buf)
+        try:
+            while self._read_length():
+                end = self._start + self._msg_length
+                if end > self._end:
+                    return
+                msg = view[self._start:end]
+                self._start = end
+                self._msg_length = None
+                yield msg
+                msg.release()
+        finally:
+            view.release()
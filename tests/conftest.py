@@ -0,0 +1,113 @@
+""" Fixtures shared by the test modules. """
+
+import time
+from datetime import datetime
+
+import pytest
+
+from src.blockchain import Blockchain
+from src.block import Block
+from src.crypto import Key
+from src.mining_strategy import create_block
+from src.protocol import Protocol
+from src.transaction import Transaction, TransactionInput, TransactionTarget
+
+
+class DummyProtocol:
+    """ Records the broadcasts of a chain builder instead of sending them to peers. """
+
+    def __init__(self):
+        self.block_receive_handlers = []
+        self.trans_receive_handlers = []
+        self.trans_batch_receive_handlers = []
+        self.block_request_handlers = []
+        self.transaction_request_handlers = []
+        self.transaction_pool_handlers = []
+        self.broadcast = []
+        self.block_requests = []
+
+    def broadcast_transaction(self, trans):
+        self.broadcast.append(trans.get_hash())
+
+    def broadcast_primary_block(self, block):
+        pass
+
+    def send_block_request(self, block_hash):
+        self.block_requests.append(block_hash)
+
+
+def _spend(trans, key, out_idx=0):
+    """ Creates a transaction sending the output `out_idx` of `trans` back to `key`. """
+    target = TransactionTarget(TransactionTarget.pay_to_pubkey(key), trans.targets[out_idx].amount)
+    unsigned = Transaction([TransactionInput(trans.get_hash(), out_idx, "")], [target], datetime.utcnow())
+    return Transaction([TransactionInput(trans.get_hash(), out_idx, unsigned.sign(key))], [target],
+                       unsigned.timestamp)
+
+
+def _build_chain(chain, length, key):
+    """ Mines `length` blocks on top of `chain`, each spending the coinbase of the block before it. """
+    unconfirmed = []
+    for _ in range(length):
+        block = create_block(chain, unconfirmed, key)
+        chain = chain.try_append(block)
+        unconfirmed = [_spend(block.transactions[0], key)]
+    return chain
+
+
+def _make_block(tx_count: int) -> Block:
+    """ Creates a block with `tx_count` signed transactions; they need not be valid together. """
+    key = Key.generate_private_key()
+    chain = Blockchain()
+    block = create_block(chain, [], key)
+    chain = chain.try_append(block)
+    block = create_block(chain, [], key)
+    block.transactions += [_spend(chain.head.transactions[0], key) for _ in range(tx_count)]
+    return block
+
+
+def _wait_for(condition):
+    """ Polls `condition` for up to ten seconds, and fails the test if it never holds. """
+    for _ in range(200):
+        if condition():
+            return
+        time.sleep(0.05)
+    assert condition()
+
+
+@pytest.fixture
+def dummy_protocol():
+    return DummyProtocol()
+
+
+@pytest.fixture
+def make_protocol():
+    """ Creates `Protocol` instances that are shut down when the test ends. """
+    protocols = []
+
+    def make(*args, **kwargs):
+        proto = Protocol(*args, **kwargs)
+        protocols.append(proto)
+        return proto
+    yield make
+    for proto in protocols:
+        proto.shutdown()
+
+
+@pytest.fixture(scope="session")
+def spend():
+    return _spend
+
+
+@pytest.fixture(scope="session")
+def build_chain():
+    return _build_chain
+
+
+@pytest.fixture(scope="session")
+def make_block():
+    return _make_block
+
+
+@pytest.fixture(scope="session")
+def wait_for():
+    return _wait_for
@@ -0,0 +1,84 @@
+import socket
+import time
+
+from src.addressbook import AddressBook, RETRY_INTERVAL
+from src.blockchain import GENESIS_BLOCK
+from src.protocol import Protocol
+
+
+def test_score_order():
+    book = AddressBook()
+    for port in (1, 2, 3, 4):
+        book.add(("127.0.0.1", port))
+
+    book.connection_attempted(("127.0.0.1", 1))
+    book.connection_succeeded(("127.0.0.1", 1))
+    book.disconnected(("127.0.0.1", 1), 0.02, 100000)
+
+    book.connection_attempted(("127.0.0.1", 2))
+    book.connection_succeeded(("127.0.0.1", 2))
+    book.disconnected(("127.0.0.1", 2), 0.1, 1000)
+
+    book.connection_attempted(("127.0.0.1", 3))
+    book.connection_failed(("127.0.0.1", 3))
+
+    assert book.best(4, set()) == [("127.0.0.1", 1), ("127.0.0.1", 2), ("127.0.0.1", 4)]
+    assert book.best(1, {("127.0.0.1", 1)}) == [("127.0.0.1", 2)]
+
+
+def test_retry_backoff():
+    book = AddressBook()
+    addr = ("127.0.0.1", 1)
+    book.connection_attempted(addr)
+    book.connection_failed(addr)
+    peer = book.get(addr)
+    assert not peer.can_retry(time.time())
+    assert peer.can_retry(peer.last_attempt + RETRY_INTERVAL)
+
+    book.connection_attempted(addr)
+    book.connection_failed(addr)
+    assert not peer.can_retry(peer.last_attempt + RETRY_INTERVAL)
+    assert peer.can_retry(peer.last_attempt + 2 * RETRY_INTERVAL)
+
+
+def test_save_load(tmpdir):
+    path = str(tmpdir.join("peers.json"))
+    book = AddressBook(path)
+    book.connection_attempted(("127.0.0.1", 1))
+    book.connection_succeeded(("127.0.0.1", 1))
+    book.disconnected(("127.0.0.1", 1), 0.05, 2000)
+    book.add(("::1", 2, 0, 0))
+    book.save()
+
+    loaded = AddressBook(path)
+    loaded.load()
+    assert len(loaded) == 2
+    assert ("::1", 2, 0, 0) in loaded
+    peer = loaded.get(("127.0.0.1", 1))
+    assert (peer.attempts, peer.successes, peer.rtt, peer.throughput) == (1, 1, 0.05, 2000)
+    assert loaded.best(2, set()) == book.best(2, set())
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_connect_from_address_book():
+    listener = Protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        dead_addr = s.getsockname()
+
+    book = AddressBook()
+    book.add(listener.server_address)
+    book.add(dead_addr)
+    proto = Protocol([], GENESIS_BLOCK, 0, "127.0.0.1", address_book=book)
+    proto.received("connect_peers", None, None)
+
+    _wait_for(lambda: book.get(dead_addr).failures_in_a_row == 1 and
+              book.get(listener.server_address).successes == 1)
+    assert [peer._dial_addr for peer in proto.peers] == [listener.server_address]
+    assert book.best(2, set()) == [listener.server_address]
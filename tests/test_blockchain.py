@@ -0,0 +1,41 @@
+from src.blockchain import Blockchain
+from src.crypto import Key
+from src.mining_strategy import create_block
+
+
+def test_rewind_restores_unspent_coins(spend):
+    key = Key.generate_private_key()
+    chains = [Blockchain()]
+    unconfirmed = []
+    for _ in range(6):
+        chain = chains[-1]
+        block = create_block(chain, unconfirmed, key)
+        chains.append(chain.try_append(block))
+        unconfirmed = [spend(block.transactions[0], key)]
+
+    head = chains[-1]
+    for height, chain in enumerate(chains):
+        rewound = head.rewind(height)
+        assert rewound.head.hash == chain.head.hash
+        assert rewound.unspent_coins == chain.unspent_coins
+        assert rewound.block_indices == chain.block_indices
+        assert rewound.total_difficulty == chain.total_difficulty
+
+    assert head.rewind(len(chains)) is None
+
+
+def test_prune_keeps_headers_and_coins(build_chain):
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 6, key)
+
+    pruned = chain.prune(3)
+    assert [b.hash for b in pruned.blocks] == [b.hash for b in chain.blocks]
+    assert all(b.is_header_only and not b.transactions for b in pruned.blocks[1:4])
+    assert not any(b.is_header_only for b in pruned.blocks[4:] + chain.blocks)
+    assert pruned.unspent_coins == chain.unspent_coins
+    assert pruned.can_rewind(3) and not pruned.can_rewind(2)
+    assert pruned.rewind(4).unspent_coins == chain.rewind(4).unspent_coins
+    assert pruned.prune(2) is pruned
+
+    block = create_block(pruned, [], key)
+    assert pruned.try_append(block).head.hash == block.hash
@@ -0,0 +1,16 @@
+from src.blockchain import Blockchain
+from src.chainbuilder import ChainBuilder
+from src.crypto import Key
+
+
+def test_requested_blocks_continue_chain(build_chain, dummy_protocol):
+    chain = build_chain(Blockchain(), 5, Key.generate_private_key())
+    cb = ChainBuilder(dummy_protocol)
+
+    # a node that is behind learns of the head first, and then receives the blocks it asks for
+    cb.new_block_received(chain.head)
+    for block in reversed(chain.blocks[1:-1]):
+        assert dummy_protocol.block_requests[-1] == block.hash
+        cb.new_block_received(block)
+    assert cb.primary_block_chain.head.hash == chain.head.hash
+    assert not cb._block_requests
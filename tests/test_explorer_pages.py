@@ -0,0 +1,161 @@
+import json
+import os
+import tempfile
+from binascii import hexlify
+from datetime import datetime
+
+import pytest
+
+from src import rpc_server
+from src.blockchain import Blockchain
+from src.chainbuilder import ChainBuilder
+from src.crypto import Key
+from src.mining_strategy import create_block
+from src.sqlite_store import SqliteStore
+from src.transaction import Transaction, TransactionInput, TransactionTarget
+
+LIMITS = [1, 2, 3, 7, 100]
+
+
+def pay_many(trans, key, count):
+    """ Creates a transaction splitting the first output of `trans` among `count` new keys. """
+    amount = trans.targets[0].amount // count
+    targets = [TransactionTarget(TransactionTarget.pay_to_pubkey(Key.generate_private_key()), amount)
+               for _ in range(count)]
+    unsigned = Transaction([TransactionInput(trans.get_hash(), 0, "")], targets, datetime.utcnow())
+    return Transaction([TransactionInput(trans.get_hash(), 0, unsigned.sign(key))], targets,
+                       unsigned.timestamp)
+
+
+def first_payments(chain):
+    """ The addresses in the order they were first paid to, sorted within each transaction. """
+    seen = []
+    for block in chain.blocks:
+        for trans in block.transactions:
+            new = {t.get_pubkey.as_bytes() for t in trans.targets} - set(seen)
+            seen.extend(sorted(new))
+    return [hexlify(address).decode() for address in seen]
+
+
+@pytest.fixture(scope="module")
+def chain(spend):
+    """ A chain with transactions paying several new addresses, so that pages end within them. """
+    key = Key.generate_private_key()
+    chain = Blockchain()
+    unconfirmed = []
+    for count in [4, 1, 3, 0, 4, 0]:
+        block = create_block(chain, unconfirmed, key)
+        chain = chain.try_append(block)
+        coinbase = block.transactions[0]
+        unconfirmed = [pay_many(coinbase, key, count) if count else spend(coinbase, key)]
+    return chain
+
+
+@pytest.fixture(params=["chain", "sqlite"])
+def explorer(request, monkeypatch, chain, dummy_protocol, wait_for):
+    chainbuilder = ChainBuilder(dummy_protocol)
+    chainbuilder.primary_block_chain = chain
+    monkeypatch.setattr(rpc_server, "cb", chainbuilder)
+    monkeypatch.setattr(rpc_server, "store", None)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if request.param == "sqlite":
+            store = SqliteStore(os.path.join(tmpdir, "chain.sqlite"), chainbuilder)
+            wait_for(lambda: store.height == chainbuilder.primary_block_chain.head.height)
+            monkeypatch.setattr(rpc_server, "store", store)
+        yield rpc_server.app.test_client(), chainbuilder
+
+
+def walk_pages(client, path, limit):
+    """ Requests all pages of a paginated endpoint, and returns their entries. """
+    entries = []
+    cursor = None
+    while True:
+        query = {'limit': limit}
+        if cursor is not None:
+            query['cursor'] = cursor
+        response = client.get(path, query_string=query)
+        assert response.status_code == 200
+        page = json.loads(response.get_data(as_text=True))
+        cursor = page['next_cursor']
+        assert response.headers.get(rpc_server.NEXT_CURSOR_HEADER) == cursor
+        assert len(page['items']) == limit or (cursor is None and page['items'])
+        entries.extend(page['items'])
+        if cursor is None:
+            return entries
+
+
+def test_blocks_pages(explorer):
+    client, chainbuilder = explorer
+    chain = chainbuilder.primary_block_chain
+    expected = [hexlify(b.hash).decode() for b in reversed(chain.blocks)]
+    for limit in LIMITS:
+        assert [b['hash'] for b in walk_pages(client, "/explorer/blocks", limit)] == expected
+    assert [b['hash'] for b in json.loads(client.get("/explorer/blocks").get_data(as_text=True))] == expected
+
+
+def test_transactions_pages(explorer):
+    client, chainbuilder = explorer
+    chain = chainbuilder.primary_block_chain
+    expected = [hexlify(t.get_hash()).decode() for b in reversed(chain.blocks)
+                for t in reversed(b.transactions)]
+    for limit in LIMITS:
+        assert [t['hash'] for t in walk_pages(client, "/explorer/transactions", limit)] == expected
+    assert [t['hash'] for t in json.loads(client.get("/explorer/transactions").get_data(as_text=True))] == \
+        expected
+
+
+def test_addresses_pages(explorer):
+    client, chainbuilder = explorer
+    expected = first_payments(chainbuilder.primary_block_chain)
+    assert len(expected) == len(set(expected)) >= 12
+    for limit in LIMITS:
+        assert walk_pages(client, "/explorer/addresses", limit) == expected
+    assert json.loads(client.get("/explorer/addresses").get_data(as_text=True)) == expected
+
+
+def test_addresses_after_reorganization(explorer, wait_for):
+    client, chainbuilder = explorer
+    chain = chainbuilder.primary_block_chain
+    assert walk_pages(client, "/explorer/addresses", 5) == first_payments(chain)
+
+    fork = chain.rewind(2)
+    for _ in range(len(chain.blocks) - 2):
+        fork = fork.try_append(create_block(fork, [], Key.generate_private_key()))
+    chainbuilder.primary_block_chain = fork
+    if rpc_server.store is not None:
+        rpc_server.store.store()
+        wait_for(lambda: rpc_server.store.height == fork.head.height and rpc_server.store._is_primary(fork.head))
+    assert walk_pages(client, "/explorer/addresses", 5) == first_payments(fork)
+
+
+def test_cursor_stays_valid(explorer):
+    client, chainbuilder = explorer
+    chain = chainbuilder.primary_block_chain
+    response = client.get("/explorer/transactions", query_string={'limit': 3})
+    first_page = json.loads(response.get_data(as_text=True))
+    cursor = first_page['next_cursor']
+
+    chainbuilder.primary_block_chain = chain.try_append(create_block(chain, [], Key.generate_private_key()))
+    response = client.get("/explorer/transactions", query_string={'cursor': cursor})
+    rest = json.loads(response.get_data(as_text=True))
+    assert rest['next_cursor'] is None
+    assert [t['hash'] for t in first_page['items'] + rest['items']] == \
+           [hexlify(t.get_hash()).decode() for b in reversed(chain.blocks) for t in reversed(b.transactions)]
+
+
+@pytest.mark.parametrize("path,query", [
+    ("/explorer/blocks", {'limit': 0}),
+    ("/explorer/blocks", {'limit': rpc_server.MAX_PAGE_SIZE + 1}),
+    ("/explorer/blocks", {'limit': "ten"}),
+    ("/explorer/blocks", {'cursor': "-1"}),
+    ("/explorer/blocks", {'cursor': "1:0"}),
+    ("/explorer/transactions", {'cursor': "3"}),
+    ("/explorer/transactions", {'cursor': "3:x"}),
+    ("/explorer/transactions", {'limit': -5}),
+    ("/explorer/addresses", {'cursor': "1:0"}),
+    ("/explorer/addresses", {'cursor': "1:0:-1"}),
+    ("/explorer/addresses", {'cursor': ""}),
+])
+def test_invalid_page_requests(explorer, path, query):
+    client, _ = explorer
+    assert client.get(path, query_string=query).status_code == 400
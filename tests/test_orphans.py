@@ -0,0 +1,67 @@
+from datetime import datetime
+
+import pytest
+
+from src.chainbuilder import ChainBuilder, MAX_ORPHAN_TRANSACTIONS
+from src.crypto import Key
+from src.mining_strategy import create_block
+from src.transaction import Transaction, TransactionInput, TransactionTarget
+
+
+@pytest.fixture
+def chainbuilder_with_coin(dummy_protocol):
+    key = Key.generate_private_key()
+    cb = ChainBuilder(dummy_protocol)
+    block = create_block(cb.primary_block_chain, [], key)
+    cb.primary_block_chain = cb.primary_block_chain.try_append(block)
+    return cb, key, block.transactions[0]
+
+
+def test_orphan_resolved_when_parent_arrives(chainbuilder_with_coin, spend):
+    cb, key, coinbase = chainbuilder_with_coin
+    parent = spend(coinbase, key)
+    child = spend(parent, key)
+    grandchild = spend(child, key)
+
+    cb.new_transaction_received(grandchild)
+    cb.new_transaction_received(child)
+    assert len(cb.orphan_transactions) == 2
+    assert not cb.unconfirmed_transactions
+
+    cb.new_transaction_received(parent)
+    assert len(cb.orphan_transactions) == 0
+    assert cb.protocol.broadcast == [parent.get_hash(), child.get_hash(), grandchild.get_hash()]
+
+
+def test_nonexistent_output_rejected(chainbuilder_with_coin, spend):
+    cb, key, coinbase = chainbuilder_with_coin
+    parent = spend(coinbase, key)
+    cb.new_transaction_received(parent)
+    cb.new_transaction_received(spend(parent, key, out_idx=0))
+
+    bad = Transaction([TransactionInput(parent.get_hash(), 5, "")], parent.targets, datetime.utcnow())
+    cb.new_transaction_received(bad)
+    assert bad.get_hash() not in cb.unconfirmed_transactions
+    assert bad.get_hash() not in cb.orphan_transactions
+
+
+def test_orphan_pool_bounded(chainbuilder_with_coin, spend):
+    cb, key, coinbase = chainbuilder_with_coin
+    for i in range(MAX_ORPHAN_TRANSACTIONS + 10):
+        unknown = Transaction([], [TransactionTarget("x", i)], datetime.utcnow(), iv=bytes([i % 256, i // 256]))
+        cb.new_transaction_received(spend(unknown, key))
+    assert len(cb.orphan_transactions) == MAX_ORPHAN_TRANSACTIONS
+
+
+def test_transaction_batch(chainbuilder_with_coin, spend):
+    cb, key, coinbase = chainbuilder_with_coin
+    parent = spend(coinbase, key)
+    child = spend(parent, key)
+    changes = []
+    cb.transaction_change_handlers.append(lambda: changes.append(None))
+
+    cb.new_transactions_received([parent, child])
+    assert len(cb.orphan_transactions) == 0
+    assert set(cb.unconfirmed_transactions) == {parent.get_hash(), child.get_hash()}
+    assert cb.protocol.broadcast == [parent.get_hash(), child.get_hash()]
+    assert len(changes) == 1
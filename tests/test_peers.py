@@ -0,0 +1,582 @@
+import json
+import socket
+import threading
+import time
+from binascii import hexlify
+from datetime import datetime
+
+import pytest
+
+from src.block import Block
+from src.blockchain import Blockchain, GENESIS_BLOCK
+from src.chainbuilder import ChainBuilder
+from src.crypto import Key
+from src.merkle import merkle_tree
+from src.mining_strategy import create_block
+from src import protocol
+from src.protocol import HELLO_MSG, SharedMessage, _short_id
+from src.transaction import Transaction, TransactionInput
+from src.wire import MessageFramer, ENCODINGS, JSON_ENCODING, frame_message
+
+PEER_COUNT = 200
+
+
+class RawPeer:
+    """ A minimal P2P client that talks to a `Protocol` over a plain blocking socket. """
+
+    def __init__(self, addr: tuple, compact_blocks: bool = False, rcvbuf: int = 0, notfound: bool = False,
+                 legacy: bool = False):
+        self.socket = socket.socket(socket.AF_INET)
+        self.socket.settimeout(30)
+        if rcvbuf:
+            # must be set before connecting to limit the TCP window
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.socket.connect(addr)
+        self.framer = MessageFramer()
+        self.socket.sendall(HELLO_MSG)
+        if legacy:
+            # peers of earlier versions start with a 'myport' message, without features
+            self.send("myport", 1)
+        else:
+            features = {'encodings': [JSON_ENCODING], 'compact_blocks': compact_blocks, 'notfound': notfound}
+            self.send("id", "raw peer", features=features)
+
+    def _fill(self):
+        read = self.socket.recv_into(self.framer.get_buffer())
+        assert read, "connection closed"
+        self.framer.buffer_updated(read)
+
+    def handshake(self) -> dict:
+        """ Reads the hello message and returns the features of the first message. """
+        line = self.framer.read_line(4096)
+        while line is None:
+            self._fill()
+            line = self.framer.read_line(4096)
+        assert line == HELLO_MSG
+        msg = self.read_msg()
+        assert msg['msg_type'] == "id"
+        return msg['features']
+
+    def send(self, msg_type: str, msg_param, **extra):
+        encode = ENCODINGS[JSON_ENCODING][0]
+        self.socket.sendall(frame_message(encode(dict(extra, msg_type=msg_type, msg_param=msg_param))))
+
+    def read_msg(self) -> dict:
+        decode = ENCODINGS[JSON_ENCODING][1]
+        while True:
+            for buf in self.framer.messages():
+                return decode(buf)
+            self._fill()
+
+    def read_until(self, msg_type: str) -> object:
+        while True:
+            msg = self.read_msg()
+            if msg['msg_type'] == msg_type:
+                return msg['msg_param']
+
+
+def test_many_peers(make_protocol):
+    threads_at_start = threading.active_count()
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1", max_peers=PEER_COUNT + 10)
+    threads_before = threading.active_count()
+
+    start = time.perf_counter()
+    peers = [RawPeer(proto.server_address) for _ in range(PEER_COUNT)]
+    for peer in peers:
+        peer.handshake()
+        assert peer.read_until("inv") == {'block': [GENESIS_BLOCK.to_json_compatible()['hash']]}
+    print("{} peers connected in {:.2f}s".format(PEER_COUNT, time.perf_counter() - start))
+
+    assert len(proto.peers) == PEER_COUNT
+    assert threading.active_count() == threads_before
+
+    chain = Blockchain()
+    block = create_block(chain, [], Key.generate_private_key())
+    start = time.perf_counter()
+    proto.broadcast_primary_block(block)
+    for peer in peers:
+        assert peer.read_until("inv") == {'block': [block.to_json_compatible()['hash']]}
+        peer.send("getdata", {'block': [block.to_json_compatible()['hash']]})
+    for peer in peers:
+        assert peer.read_until("block")['hash'] == block.to_json_compatible()['hash']
+    print("block broadcast to {} peers in {:.2f}s".format(PEER_COUNT, time.perf_counter() - start))
+
+    for peer in peers:
+        peer.socket.close()
+    for _ in range(50):
+        if not proto.peers:
+            break
+        time.sleep(0.1)
+    assert not proto.peers
+
+    proto.shutdown()
+    assert threading.active_count() == threads_at_start
+    with pytest.raises(ConnectionRefusedError):
+        socket.create_connection(proto.server_address, 5)
+
+
+def test_max_peers(make_protocol):
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1", max_peers=2)
+    peers = [RawPeer(proto.server_address) for _ in range(2)]
+    for peer in peers:
+        peer.handshake()
+
+    rejected = socket.create_connection(proto.server_address, 5)
+    assert rejected.recv(1) == b""
+    assert len(proto.peers) == 2
+
+
+def test_inventory_relay(spend, make_protocol):
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    proto.trans_receive_handlers.append(proto.broadcast_transaction)
+    sender, receiver = RawPeer(proto.server_address), RawPeer(proto.server_address)
+    for peer in (sender, receiver):
+        peer.handshake()
+        peer.read_until("inv")
+
+    key = Key.generate_private_key()
+    block = create_block(Blockchain(), [], key)
+    trans = spend(block.transactions[0], key)
+    trans_hash = trans.to_json_compatible()['hash']
+
+    sender.send("inv", {'transaction': [trans_hash]})
+    assert sender.read_until("getdata") == {'transaction': [trans_hash]}
+    sender.send("transaction", trans.to_json_compatible())
+
+    assert receiver.read_until("inv") == {'transaction': [trans_hash]}
+    receiver.send("getdata", {'transaction': [trans_hash]})
+    assert receiver.read_until("transaction")['hash'] == trans_hash
+
+    # neither is the transaction announced back to its sender, nor do we ask for it again
+    sender.send("inv", {'transaction': [trans_hash]})
+    sender.send("getdata", {'transaction': [trans_hash]})
+    assert sender.read_msg()['msg_type'] == "transaction"
+
+
+@pytest.fixture
+def chain_with_transactions(spend):
+    """ Creates a chain and a block on top of it that spends the coinbases of two earlier blocks. """
+    key = Key.generate_private_key()
+    chain = Blockchain()
+    for _ in range(2):
+        chain = chain.try_append(create_block(chain, [], key))
+    transactions = [spend(b.transactions[0], key) for b in chain.blocks[1:]]
+    block = create_block(chain, transactions, key)
+    assert len(block.transactions) == 3
+    return block, transactions
+
+
+def test_compact_block_sent(chain_with_transactions, make_protocol):
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    peer = RawPeer(proto.server_address, compact_blocks=True)
+    peer.handshake()
+    peer.read_until("inv")
+
+    block, transactions = chain_with_transactions
+    proto.broadcast_primary_block(block)
+    compact_block = peer.read_until("cmpctblock")
+    assert compact_block['block']['hash'] == block.to_json_compatible()['hash']
+    assert len(compact_block['block']['transactions']) == 1
+    assert len(compact_block['short_ids']) == 2
+
+    peer.send("getblocktxn", {'hash': compact_block['block']['hash'], 'indexes': [2]})
+    response = peer.read_until("blocktxn")
+    assert [t['hash'] for t in response['transactions']] == [transactions[1].to_json_compatible()['hash']]
+
+
+def test_compact_block_rebuilt(chain_with_transactions, make_protocol):
+    block, transactions = chain_with_transactions
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    proto.transaction_pool_handlers.append(lambda: transactions[:1])
+    received = []
+    proto.block_receive_handlers.append(received.append)
+
+    peer = RawPeer(proto.server_address, compact_blocks=True)
+    peer.handshake()
+    peer.read_until("inv")
+
+    header = block.to_json_compatible()
+    header['transactions'] = header['transactions'][:1]
+    short_ids = [hexlify(_short_id(block.hash, t.get_hash())).decode() for t in transactions]
+    peer.send("cmpctblock", {'block': header, 'short_ids': short_ids})
+    assert peer.read_until("getblocktxn") == {'hash': header['hash'], 'indexes': [2]}
+
+    peer.send("blocktxn", {'hash': header['hash'], 'transactions': [transactions[1].to_json_compatible()]})
+    for _ in range(50):
+        if received:
+            break
+        time.sleep(0.1)
+    assert received[0].hash == block.hash
+    assert received[0].verify_merkle()
+
+    # the rebuilt block is recorded like a full block we received
+    conn, = proto.peers
+    peer.send("block", block.to_json_compatible())
+    _sync(peer)
+    time.sleep(0.2)
+    assert len(received) == 1
+    assert conn.stats.duplicates == {'block': 1}
+
+
+def test_legacy_peer(spend, make_protocol):
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    proto.trans_receive_handlers.append(proto.broadcast_transaction)
+    legacy, peer = RawPeer(proto.server_address, legacy=True), RawPeer(proto.server_address)
+    legacy.handshake()
+    assert legacy.read_until("block")['hash'] == hexlify(GENESIS_BLOCK.hash).decode()
+    peer.handshake()
+    peer.read_until("inv")
+    for _ in range(50):
+        if len([p for p in proto.peers if p.is_connected]) == 2 and \
+                all(p.peer_addr is not None for p in proto.peers if p.legacy):
+            break
+        time.sleep(0.1)
+    legacy_conn = next(p for p in proto.peers if p.legacy)
+    assert legacy_conn.encoding == JSON_ENCODING and not legacy_conn.compressions
+    assert legacy_conn.peer_addr[1] == 1
+
+    # legacy peers get new transactions pushed instead of announced, and are not pinged
+    key = Key.generate_private_key()
+    trans = spend(create_block(Blockchain(), [], key).transactions[0], key)
+    trans_hash = trans.to_json_compatible()['hash']
+    peer.send("inv", {'transaction': [trans_hash]})
+    assert peer.read_until("getdata") == {'transaction': [trans_hash]}
+    peer.send("transaction", trans.to_json_compatible())
+    proto._send_pings()
+    msg = legacy.read_msg()
+    while msg['msg_type'] == "peer":
+        msg = legacy.read_msg()
+    assert msg['msg_type'] == "transaction" and msg['msg_param']['hash'] == trans_hash
+
+    # and they can ask for blocks
+    proto.block_request_handlers.append({GENESIS_BLOCK.hash: GENESIS_BLOCK}.get)
+    legacy.send("getblock", hexlify(GENESIS_BLOCK.hash).decode())
+    assert legacy.read_until("block")['hash'] == hexlify(GENESIS_BLOCK.hash).decode()
+
+
+def test_pruned_block_not_found(make_protocol):
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    chainbuilder = ChainBuilder(proto, prune_depth=2)
+    key = Key.generate_private_key()
+    chain = Blockchain()
+    for _ in range(5):
+        chain = chain.try_append(create_block(chain, [], key))
+        proto.received("block", chain.head, None, 2)
+    for _ in range(50):
+        if chainbuilder.primary_block_chain.head.hash == chain.head.hash:
+            break
+        time.sleep(0.1)
+    pruned = chainbuilder.primary_block_chain
+    assert [b.is_header_only for b in pruned.blocks] == [False, True, True, True, False, False]
+    assert chain.blocks[2].hash not in chainbuilder.block_cache
+
+    peer = RawPeer(proto.server_address, notfound=True)
+    peer.handshake()
+    peer.read_until("inv")
+    hashes = [b.to_json_compatible()['hash'] for b in chain.blocks]
+    peer.send("getblock", hashes[2])
+    assert peer.read_until("notfound") == {'block': [hashes[2]]}
+    peer.send("getdata", {'block': [hashes[5], "00" * 32]})
+    assert peer.read_msg() == {'msg_type': "block", 'msg_param': chain.blocks[5].to_json_compatible()}
+    assert peer.read_until("notfound") == {'block': ["00" * 32]}
+
+
+def test_ping_and_stats(make_protocol):
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    peer = RawPeer(proto.server_address)
+    peer.handshake()
+    peer.read_until("inv")
+
+    # pings are handled without the main thread, which is busy here
+    busy = threading.Event()
+    proto.call_in_main_thread(lambda: busy.wait(10))
+    peer.send("ping", 42)
+    assert peer.read_until("pong") == 42
+
+    conn, = proto.peers
+    conn.send_ping()
+    peer.send("pong", peer.read_until("ping"))
+    for _ in range(50):
+        if conn.stats.ping_rtt is not None:
+            break
+        time.sleep(0.1)
+    assert conn.stats.ping_rtt is not None
+    busy.set()
+
+    stats, = proto.network_stats()
+    assert stats['sent']['inv']['messages'] == 1
+    assert stats['sent']['pong']['messages'] == 1
+    assert stats['received']['ping']['messages'] == 1
+    assert stats['received']['pong']['bytes'] > 0
+    assert stats['seconds_since_last_message'] >= 0
+    assert stats['queued_messages'] == 0
+    json.dumps(stats)
+
+
+def test_compressed_connection(chain_with_transactions, make_protocol):
+    proto1 = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    proto2 = make_protocol([proto1.server_address], GENESIS_BLOCK, 0, "127.0.0.1")
+    received = []
+    proto2.block_receive_handlers.append(received.append)
+    for _ in range(50):
+        if proto1.peers and proto1.peers[0].is_connected:
+            break
+        time.sleep(0.1)
+    assert proto1.peers[0].compressions == ['zlib', 'lzma']
+
+    block, _ = chain_with_transactions
+    proto1.broadcast_primary_block(block)
+    for _ in range(50):
+        if received:
+            break
+        time.sleep(0.1)
+    assert received[0].hash == block.hash
+
+
+def test_broadcast_benchmark(make_block, make_protocol):
+    """
+    CPU time spent encoding one block broadcast to many peers, including the blocks sent to the
+    peers that ask for it after the announcement.
+    """
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1", max_peers=20)
+    peers = [RawPeer(proto.server_address, compact_blocks=i % 2 == 0) for i in range(10)]
+    for peer in peers:
+        peer.handshake()
+        peer.read_until("inv")
+
+    block = make_block(200)
+    block_hash = hexlify(block.hash).decode()
+    encode_time = -sum(conn.stats.encode_time for conn in proto.peers)
+    proto.broadcast_primary_block(block)
+    for i, peer in enumerate(peers):
+        if i % 2 == 0:
+            peer.read_until("cmpctblock")
+        else:
+            assert peer.read_until("inv") == {'block': [block_hash]}
+            peer.send("getdata", {'block': [block_hash]})
+    for peer in peers[1::2]:
+        assert peer.read_until("block")['hash'] == block_hash
+
+    encode_time += sum(conn.stats.encode_time for conn in proto.peers)
+    print("encoding a block broadcast to {} peers took {:.2f}ms".format(len(peers), encode_time * 1000))
+
+
+def test_block_flood_latency(make_block, make_protocol):
+    """ Round-trip times of one peer while another peer floods us with large invalid blocks. """
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    ChainBuilder(proto)
+    received = []
+    proto.block_receive_handlers.append(received.append)
+    flooder, pinger = RawPeer(proto.server_address), RawPeer(proto.server_address)
+    for peer in (flooder, pinger):
+        peer.handshake()
+        peer.read_until("inv")
+
+    # the merkle root of these blocks does not match their transactions
+    block = make_block(200).to_json_compatible()
+
+    def send_flood():
+        for _ in range(50):
+            flooder.send("block", block)
+        flooder.send("ping", -1)
+        flooder.read_until("pong")
+
+    flood = threading.Thread(target=send_flood)
+    start = time.perf_counter()
+    flood.start()
+    rtts = []
+    while flood.is_alive() or not rtts:
+        ping_start = time.perf_counter()
+        pinger.send("ping", len(rtts))
+        assert pinger.read_until("pong") == len(rtts)
+        rtts.append(time.perf_counter() - ping_start)
+    flood.join()
+    assert not received, "invalid blocks must not reach the main thread"
+    print("flood of 50 blocks took {:.2f}s, ping rtt max {:.1f}ms, median {:.1f}ms".format(
+        time.perf_counter() - start, max(rtts) * 1000, sorted(rtts)[len(rtts) // 2] * 1000))
+
+
+def _fill_send_queue(conn) -> int:
+    """ Sends large messages to a peer that does not read until its write buffer is full. """
+    count = 0
+    while not conn._write_paused:
+        conn.send_msg("getblock", "0" * 100000)
+        count += 1
+        time.sleep(0.01)
+        assert count < 1000, "the connection never filled up"
+    return count
+
+
+def test_announcements_wait_for_trickle(monkeypatch, make_protocol):
+    monkeypatch.setattr(protocol, "TRICKLE_INTERVAL", 1000)
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    peer = RawPeer(proto.server_address)
+    peer.handshake()
+    peer.read_until("inv")
+    conn, = proto.peers
+
+    tx_hash = bytes(range(32))
+    conn.announce("transaction", tx_hash)
+    conn.send_msg("ping", 1)
+    assert peer.read_msg() == {'msg_type': "ping", 'msg_param': 1}
+    assert conn.stats_to_json_compatible()['pending_announcements'] == 1
+
+    proto._loop.call_soon_threadsafe(conn._send_announcements)
+    assert peer.read_until("inv") == {'transaction': [tx_hash.hex()]}
+
+
+def test_send_queue_priorities(monkeypatch, make_protocol):
+    monkeypatch.setattr(protocol, "MAX_QUEUE_BYTES", 1024 ** 3)
+    monkeypatch.setattr(protocol, "TRICKLE_INTERVAL", 0.001)
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    peer = RawPeer(proto.server_address, rcvbuf=4096)
+    peer.handshake()
+    peer.read_until("inv")
+    conn, = proto.peers
+
+    fillers = _fill_send_queue(conn)
+    conn.send_msg("peer", ["127.0.0.1", 1])
+    tx_hashes = [hexlify(bytes([i]) * 32).decode() for i in range(3)]
+    for tx_hash in tx_hashes:
+        conn.send_shared(SharedMessage("inv", {"transaction": [tx_hash]}))
+    conn.send_msg("inv", {"block": ["00" * 32]})
+    conn.send_msg("ping", 1)
+    time.sleep(0.1)
+    assert conn.stats_to_json_compatible()['queued_bytes'] > 0
+
+    received = []
+    while not received or received[-1]['msg_type'] != "peer":
+        received.append(peer.read_msg())
+    assert len([msg for msg in received if msg['msg_type'] == "getblock"]) == fillers
+    ordered = [msg for msg in received if msg['msg_type'] != "getblock"]
+    assert ordered == [
+        {'msg_type': "ping", 'msg_param': 1},
+        {'msg_type': "inv", 'msg_param': {"block": ["00" * 32]}},
+        {'msg_type': "inv", 'msg_param': {"transaction": tx_hashes}},
+        {'msg_type': "peer", 'msg_param': ["127.0.0.1", 1]},
+    ]
+    assert conn.stats.write_pauses >= 1
+
+
+def test_slow_peer_disconnected(monkeypatch, make_protocol):
+    monkeypatch.setattr(protocol, "MAX_QUEUE_BYTES", 2 * 1024 * 1024)
+    monkeypatch.setattr(protocol, "QUEUE_LIMIT_TIMEOUT", 0.5)
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    peer = RawPeer(proto.server_address, rcvbuf=4096)
+    peer.handshake()
+    peer.read_until("inv")
+    conn, = proto.peers
+
+    _fill_send_queue(conn)
+    conn.send_shared(SharedMessage("inv", {"transaction": ["11" * 32]}))
+    conn.send_msg("peer", ["127.0.0.1", 1])
+    for _ in range(30):
+        conn.send_msg("getblock", "0" * 100000)
+    for _ in range(50):
+        if not conn.is_connected:
+            break
+        time.sleep(0.1)
+    assert not conn.is_connected
+    assert conn.stats.max_queued_bytes > protocol.MAX_QUEUE_BYTES
+    assert conn.stats.dropped == {"inv": 1, "peer": 1}
+
+
+def _sync(peer: RawPeer):
+    """ Waits until the protocol has decoded everything the peer sent so far. """
+    peer.send("ping", -1)
+    peer.read_until("pong")
+
+
+def test_duplicate_objects_dropped(make_block, make_protocol):
+    proto = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    received = []
+    proto.block_receive_handlers.append(received.append)
+    proto.trans_receive_handlers.append(received.append)
+    first, second = RawPeer(proto.server_address), RawPeer(proto.server_address)
+    for peer in (first, second):
+        peer.handshake()
+        peer.read_until("inv")
+    conn_first, conn_second = proto.peers
+
+    block = make_block(200).to_json_compatible()
+    block['merkle_root_hash'] = merkle_tree(Block.from_json_compatible(block).transactions) \
+        .get_hash().hex()
+    block_hash = Block.from_json_compatible(block).hash
+
+    # an invalid block with the same header must not hide the valid one
+    first.send("block", dict(block, transactions=block['transactions'][:-1]))
+    first.send("block", block)
+    first.send("transaction", block['transactions'][1])
+    _sync(first)
+    first_time = conn_first.stats.decode_time
+    for _ in range(10):
+        second.send("block", block)
+    second.send("transaction", block['transactions'][1])
+    _sync(second)
+    identical_time = conn_second.stats.decode_time
+    for i in range(10):
+        # the same block, but a different message
+        second.send("block", dict(block, relayed=i))
+    _sync(second)
+    reencoded_time = conn_second.stats.decode_time - identical_time
+
+    for _ in range(50):
+        if len(received) >= 2:
+            break
+        time.sleep(0.1)
+    time.sleep(0.2)
+    assert [getattr(obj, 'hash', None) or obj.get_hash() for obj in received] == \
+        [block_hash, Block.from_json_compatible(block).transactions[1].get_hash()]
+    assert conn_second.stats.duplicates == {'block': 20, 'transaction': 1}
+    assert block_hash in conn_second.known_inventory
+
+    # a block we ask for again is not dropped
+    proto.send_block_request(block_hash)
+    assert second.read_until("getblock") == block_hash.hex()
+    second.send("block", block)
+    _sync(second)
+    for _ in range(50):
+        if len(received) >= 3:
+            break
+        time.sleep(0.1)
+    assert received[2].hash == block_hash
+
+    print("decoding took {:.2f}ms for two blocks and a transaction, {:.2f}ms for 11 identical "
+          "duplicates, {:.2f}ms for 10 re-encoded duplicate blocks".format(
+              first_time * 1000, identical_time * 1000, reencoded_time * 1000))
+
+
+def test_transaction_relay_batched(make_block, make_protocol):
+    """ Throughput of transaction relay between two protocols, in transactions per second. """
+    proto1 = make_protocol([], GENESIS_BLOCK, 0, "127.0.0.1")
+    proto2 = make_protocol([proto1.server_address], GENESIS_BLOCK, 0, "127.0.0.1")
+    batches = []
+    proto2.trans_batch_receive_handlers.append(batches.append)
+    for _ in range(50):
+        if proto1.peers and proto1.peers[0].is_connected:
+            break
+        time.sleep(0.1)
+    conn, = proto1.peers
+    assert conn.tx_batches
+
+    coinbase = make_block(0).transactions[0]
+    # the relay layer does not check signatures or whether the inputs exist
+    transactions = [Transaction([TransactionInput(coinbase.get_hash(), i, "")], coinbase.targets,
+                                datetime.utcnow()) for i in range(2000)]
+    by_hash = {trans.get_hash(): trans for trans in transactions}
+    proto1.transaction_request_handlers.append(by_hash.get)
+
+    start = time.perf_counter()
+    for trans in transactions:
+        proto1.broadcast_transaction(trans)
+    for _ in range(300):
+        if sum(len(batch) for batch in batches) >= len(transactions):
+            break
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    assert {trans.get_hash() for batch in batches for trans in batch} == set(by_hash)
+    assert len(batches) < len(transactions) / 10
+    assert conn.stats.sent_messages['inv'] <= 3 + len(transactions) // protocol.MAX_INV_SIZE
+    print("relayed {} transactions in {} messages: {:.0f} tx/s".format(
+        len(transactions), sum(conn.stats.sent_messages.values()), len(transactions) / elapsed))
@@ -0,0 +1,317 @@
+import gzip
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+from src import persistence
+from src.blockchain import Blockchain, GENESIS_BLOCK
+from src.chainbuilder import ChainBuilder
+from src.crypto import Key
+from src.mining_strategy import create_block
+from src.persistence import BlockLog, Persistence, PersistencePolicy, load_chain_state
+
+
+def reopen(log):
+    log.close()
+    log = BlockLog(log.path)
+    log.open()
+    return log
+
+
+@pytest.fixture
+def start_node(make_protocol):
+    def start(path, base_chain=None, policy=PersistencePolicy(0, 0), prune_depth=None):
+        proto = make_protocol([], GENESIS_BLOCK, 0)
+        chainbuilder = ChainBuilder(proto, base_chain, prune_depth)
+        persist = Persistence(path, chainbuilder, policy)
+        try:
+            persist.load()
+        except FileNotFoundError:
+            pass
+        return proto, chainbuilder, persist
+    return start
+
+
+def test_block_log_append_and_fork(build_chain):
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 5, key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log = BlockLog(os.path.join(tmpdir, "blocks"))
+        log.open()
+        assert log.write_chain(chain.blocks) > 0
+        assert log.write_chain(chain.blocks) == 0
+        assert log.write_chain(chain.blocks[:3]) == 0
+
+        longer = build_chain(chain, 2, key)
+        size = os.path.getsize(log.segment_path(0))
+        log.write_chain(longer.blocks)
+        assert os.path.getsize(log.segment_path(0)) - size < size
+
+        fork = build_chain(chain.rewind(2), 6, key)
+        log.write_chain(fork.blocks)
+
+        log = reopen(log)
+        assert log.hashes == [b.hash for b in fork.blocks]
+        block = log.read_block(4)
+        assert block.hash == fork.blocks[4].hash
+        assert [t.get_hash() for t in block.transactions] == \
+               [t.get_hash() for t in fork.blocks[4].transactions]
+        assert log.block_at(3).hash == fork.blocks[3].hash
+        assert log.block_by_hash(fork.blocks[5].hash).height == 5
+        assert log.block_by_hash(chain.blocks[4].hash) is None
+        assert log.block_at(len(fork.blocks)) is None
+        log.close()
+
+
+def test_block_log_recovery(build_chain):
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 4, key)
+    fork = build_chain(chain.rewind(1), 4, key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log = BlockLog(os.path.join(tmpdir, "blocks"))
+        log.open()
+        log.write_chain(chain.blocks)
+        log.write_chain(fork.blocks)
+        log.close()
+
+        # a lost index and a partially written record at the end
+        os.unlink(log.index_path)
+        with open(log.segment_path(0), "ab") as f:
+            f.write(b"\x10\x00\x00\x00\x01")
+
+        log = BlockLog(log.path)
+        log.open()
+        assert log.hashes == [b.hash for b in fork.blocks]
+        log.write_chain(build_chain(fork, 1, key).blocks)
+        log = reopen(log)
+        assert len(log) == len(fork.blocks) + 1
+        log.close()
+
+
+def test_block_log_segments(monkeypatch, build_chain):
+    monkeypatch.setattr(persistence, "SEGMENT_SIZE", 1500)
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 5, key)
+    fork = build_chain(chain.rewind(3), 5, key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log = BlockLog(os.path.join(tmpdir, "blocks"))
+        log.open()
+        log.write_chain(chain.blocks)
+        log.write_chain(fork.blocks)
+        assert log._segment > 2
+        log = reopen(log)
+        assert log.hashes == [b.hash for b in fork.blocks]
+
+        # only segments whose blocks are all pruned are rewritten, and each only once
+        pruned_height = 6
+        assert log.prune(pruned_height) > 0
+        assert log.prune(pruned_height) == 0
+        header_only = [log.block_at(h).is_header_only for h in range(len(fork.blocks))]
+        kept = header_only.index(False, 1)
+        assert 1 < kept <= pruned_height + 1 and not any(header_only[kept:])
+        assert log._segments[kept] == log._pruned_segments
+        assert [b.hash for b in map(log.block_at, range(len(fork.blocks)))] == [b.hash for b in fork.blocks]
+
+        # a crash while a segment was replaced
+        open(log.path + ".pruning", "wb").close()
+        log = reopen(log)
+        assert log.hashes == [b.hash for b in fork.blocks]
+        assert [log.block_at(h).is_header_only for h in range(len(fork.blocks))] == header_only
+        assert not os.path.exists(log.path + ".pruning")
+
+        # a partially written segment at the end
+        log.write_chain(build_chain(fork, 1, key).blocks)
+        with open(log.segment_path(log._segment), "r+b") as f:
+            f.truncate(os.path.getsize(f.name) - 1)
+        log = reopen(log)
+        assert log.hashes == [b.hash for b in fork.blocks]
+        log.close()
+
+
+def test_fast_restart(monkeypatch, build_chain, wait_for, start_node):
+    monkeypatch.setattr(persistence, "CHAIN_STATE_INTERVAL", 5)
+    monkeypatch.setattr(persistence, "CHAIN_STATE_DEPTH", 2)
+    monkeypatch.setattr(persistence, "LOAD_QUEUE_SIZE", 2)
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 8, key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "state")
+        proto, chainbuilder, persist = start_node(path)
+        for block in chain.blocks[1:]:
+            proto.received("block", block, None, 2)
+        wait_for(lambda: len(persist.block_log) == len(chain.blocks) and persist._chain_state_height > 0)
+
+        loaded = load_chain_state(path)
+        height = loaded.head.height
+        assert height == persist._chain_state_height
+        assert loaded.head.hash == chain.blocks[height].hash
+        assert loaded.unspent_coins == chain.rewind(height).unspent_coins
+        assert all(b.is_header_only for b in loaded.blocks[1:])
+
+        _, chainbuilder, persist = start_node(path, loaded)
+        wait_for(lambda: chainbuilder.primary_block_chain.head.hash == chain.head.hash)
+        for block in chain.blocks[1:height + 1]:
+            assert chainbuilder.primary_block_chain.blocks[block.height].is_header_only
+            assert len(persist.block_by_hash(block.hash).transactions) == len(block.transactions)
+
+        # the loaded chain has no undo data below the chain state, but the block log has the blocks
+        assert not chainbuilder.primary_block_chain.can_rewind(height - 1)
+        rebuilt = persist.rebuild_chain(height - 1)
+        assert [b.hash for b in rebuilt.blocks] == [b.hash for b in chain.blocks[:height]]
+        assert rebuilt.unspent_coins == chain.rewind(height - 1).unspent_coins
+        assert rebuilt.total_difficulty == chain.rewind(height - 1).total_difficulty
+        assert rebuilt.rewind(1).unspent_coins == chain.rewind(1).unspent_coins
+
+        assert sorted(f for f in os.listdir(tmpdir) if ".utxo" in f) == ["state.utxo.{}".format(height)]
+        with open(path + ".utxo.{}".format(height), "ab") as f:
+            f.write(b"x")
+        assert load_chain_state(path) is None
+
+
+def test_mempool_round_trip(build_chain, spend, wait_for, start_node):
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 3, key)
+    trans = spend(chain.head.transactions[0], key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "state")
+        proto, chainbuilder, persist = start_node(path)
+        for block in chain.blocks[1:]:
+            proto.received("block", block, None, 2)
+        wait_for(lambda: chainbuilder.primary_block_chain.head.hash == chain.head.hash)
+        proto.received("transaction", trans, None, 2)
+
+        def mempool_stored():
+            if not os.path.exists(persist.mempool_path):
+                return False
+            with gzip.open(persist.mempool_path, "rt") as f:
+                return trans.get_hash().hex() in f.read()
+        wait_for(mempool_stored)
+
+        _, chainbuilder, _ = start_node(path)
+        wait_for(lambda: trans.get_hash() in chainbuilder.unconfirmed_transactions)
+        assert chainbuilder.primary_block_chain.head.hash == chain.head.hash
+
+        # a damaged mempool file does not prevent loading the blocks
+        with gzip.open(persist.mempool_path, "wt") as f:
+            f.write('{"transaction": {')
+        _, chainbuilder, _ = start_node(path)
+        wait_for(lambda: chainbuilder.primary_block_chain.head.hash == chain.head.hash)
+
+
+def test_write_behind_policy(build_chain, wait_for, start_node):
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 4, key)
+    with pytest.raises(ValueError):
+        BlockLog("unused", fsync="sometimes")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        policy = PersistencePolicy(chain_interval=60, mempool_interval=60, max_blocks_at_risk=3, fsync="none")
+        proto, chainbuilder, persist = start_node(os.path.join(tmpdir, "state"), policy=policy)
+        for block in chain.blocks[1:3]:
+            proto.received("block", block, None, 2)
+        wait_for(lambda: persist.stats()['unwritten_blocks'] == 2)
+        assert len(persist.block_log) == 0
+        assert persist.stats()['unwritten_chain_seconds'] > 0
+
+        for block in chain.blocks[3:]:
+            proto.received("block", block, None, 2)
+        wait_for(lambda: len(persist.block_log) >= 4)
+        stats = persist.stats()
+        assert stats['chain']['writes'] >= 1 and stats['chain']['bytes'] > 0
+        assert stats['chain']['max_latency'] >= stats['chain']['last_latency'] > 0
+        assert stats['mempool']['writes'] == 0
+        assert stats['policy']['fsync'] == "none"
+
+
+def test_release_stored_blocks(monkeypatch, build_chain, wait_for, start_node):
+    monkeypatch.setattr(persistence, "CHAIN_STATE_DEPTH", 2)
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 8, key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "state")
+        proto, chainbuilder, persist = start_node(path)
+        for block in chain.blocks[1:]:
+            proto.received("block", block, None, 2)
+            wait_for(lambda: len(persist.block_log) == block.height + 1)
+
+        primary = chainbuilder.primary_block_chain
+        assert [b.is_header_only for b in primary.blocks] == [False] + [True] * 6 + [False] * 2
+        assert primary.can_rewind(0)
+        assert not any(b.hash in chainbuilder.block_cache for b in chain.blocks[1:7])
+        assert all(b.hash in chainbuilder.block_cache for b in chain.blocks[7:])
+
+        # a fork below the released blocks needs their transactions to be validated again
+        fork = build_chain(chain.rewind(2), 7, Key.generate_private_key())
+        for block in fork.blocks[3:]:
+            proto.received("block", block, None, 2)
+        wait_for(lambda: chainbuilder.primary_block_chain.head.hash == fork.head.hash)
+        assert chainbuilder.primary_block_chain.unspent_coins == fork.unspent_coins
+
+
+def test_chain_state_crash(monkeypatch, build_chain, wait_for, start_node):
+    monkeypatch.setattr(persistence, "CHAIN_STATE_INTERVAL", 2)
+    monkeypatch.setattr(persistence, "CHAIN_STATE_DEPTH", 2)
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 8, key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "state")
+        proto, chainbuilder, persist = start_node(path, prune_depth=3)
+        for block in chain.blocks[1:8]:
+            proto.received("block", block, None, 2)
+            wait_for(lambda: len(persist.block_log) == block.height + 1)
+        wait_for(lambda: persist._pruned_height == 4)
+
+        # the miner crashes after writing the next snapshot, before the chain state refers to it
+        crashed = threading.Event()
+        def crash(info):
+            crashed.set()
+            threading.Event().wait()
+        monkeypatch.setattr(persist, "_write_chain_state_info", crash)
+        proto.received("block", chain.head, None, 2)
+        wait_for(crashed.is_set)
+        assert sorted(f for f in os.listdir(tmpdir) if ".utxo" in f) == ["state.utxo.4", "state.utxo.6"]
+        assert persist._chain_state_height == 4 and persist._pruned_height == 4
+
+        loaded = load_chain_state(path)
+        assert loaded.head.hash == chain.blocks[4].hash
+        _, chainbuilder, persist = start_node(path, loaded, prune_depth=3)
+        wait_for(lambda: chainbuilder.primary_block_chain.head.hash == chain.head.hash)
+        assert chainbuilder.primary_block_chain.unspent_coins == chain.unspent_coins
+
+
+def test_pruned_node(monkeypatch, build_chain, wait_for, start_node):
+    # one block per segment, so that all pruned blocks lose their transactions
+    monkeypatch.setattr(persistence, "SEGMENT_SIZE", 1)
+    monkeypatch.setattr(persistence, "CHAIN_STATE_INTERVAL", 5)
+    monkeypatch.setattr(persistence, "CHAIN_STATE_DEPTH", 2)
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 8, key)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "state")
+        proto, chainbuilder, persist = start_node(path, prune_depth=3)
+        for block in chain.blocks[1:]:
+            proto.received("block", block, None, 2)
+        wait_for(lambda: persist._pruned_height == 5)
+        assert persist.stats()['prune']['bytes'] > 0
+
+        log = persist.block_log
+        assert [b.hash for b in map(log.block_at, range(9))] == [b.hash for b in chain.blocks]
+        assert all(log.block_at(h).is_header_only for h in range(1, 6))
+        assert not any(log.block_at(h).is_header_only for h in range(6, 9))
+        assert persist.block_by_hash(chain.blocks[4].hash) is None
+        assert len(persist.block_by_hash(chain.blocks[7].hash).transactions) == 2
+        assert persist.rebuild_chain(6) is None
+
+        _, chainbuilder, _ = start_node(path, load_chain_state(path), prune_depth=3)
+        wait_for(lambda: chainbuilder.primary_block_chain.head.hash == chain.head.hash)
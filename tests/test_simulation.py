@@ -0,0 +1,27 @@
+from src.simulation import Simulation, LinkConfig, percentiles
+
+
+def test_percentiles():
+    assert percentiles([]) == {'p50': None, 'p90': None, 'p99': None, 'p100': None}
+    values = list(range(100, 0, -1))
+    assert percentiles(values) == {'p50': 50, 'p90': 90, 'p99': 99, 'p100': 100}
+    assert percentiles([3], (10, 50)) == {'p10': 3, 'p50': 3}
+
+
+def test_small_network():
+    sim = Simulation(4, 2, LinkConfig(0.01, 1e6, 0.01), seed=1)
+    assert len(sim.links) == 6
+    try:
+        report = sim.run(4, block_interval=1, tx_rate=10, settle_time=3)
+        heads = {node.chainbuilder.primary_block_chain.head.hash for node in sim.nodes}
+    finally:
+        sim.shutdown()
+
+    assert report['blocks']['created'] > 0
+    assert report['blocks']['coverage'] == 1
+    assert report['blocks']['reached_all'] == report['blocks']['created']
+    assert report['blocks']['delay']['p50'] >= 0.01
+    assert 0 <= report['stale_rate'] <= 1
+    assert report['height'] > 0
+    assert len(heads) == 1
+    assert report['traffic']['bytes'] > 0
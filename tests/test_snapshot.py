@@ -0,0 +1,94 @@
+import os
+import tempfile
+import time
+from threading import Thread
+
+import pytest
+
+from src.blockchain import Blockchain
+from src.crypto import Key
+from src.block import Block
+from src.snapshot import read_utxo_snapshot, write_utxo_snapshot, SnapshotValidator
+
+
+class FakePeer:
+    is_connected = True
+
+
+class FakeProtocol:
+    """ Serves the blocks of `history` to a `SnapshotValidator` without any networking. """
+
+    def __init__(self, history):
+        self.peers = [FakePeer()]
+        self.block_receive_handlers = []
+        self.history = {block.hash: block for block in history}
+
+    def send_block_request(self, block_hash):
+        def deliver():
+            for handler in self.block_receive_handlers:
+                handler(self.history[block_hash])
+        Thread(target=deliver).start()
+
+    def call_in_main_thread(self, function):
+        function()
+
+
+def validate_snapshot(history, snapshot_chain):
+    failures = []
+    validator = SnapshotValidator(FakeProtocol(history), snapshot_chain)
+    validator.failure_handlers.append(lambda: failures.append(True))
+    validator.start()
+    for _ in range(100):
+        if validator.finished or failures:
+            break
+        time.sleep(0.1)
+    assert validator.failed == bool(failures)
+    return validator
+
+
+def test_snapshot_roundtrip(build_chain):
+    chain = build_chain(Blockchain(), 12, Key.generate_private_key())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "snapshot")
+        snapshot_hash = write_utxo_snapshot(chain, path)
+        loaded = read_utxo_snapshot(path, snapshot_hash)
+
+        with pytest.raises(ValueError):
+            read_utxo_snapshot(path, bytes(32))
+
+    assert loaded.unspent_coins == chain.unspent_coins
+    assert loaded.block_indices == chain.block_indices
+    assert loaded.total_difficulty == chain.total_difficulty
+    assert loaded.compute_target_next_block() == chain.compute_target_next_block()
+    assert all(b.is_header_only for b in loaded.blocks[1:])
+    assert not loaded.can_rewind(loaded.head.height - 1)
+
+
+def test_snapshot_validation(build_chain):
+    chain = build_chain(Blockchain(), 8, Key.generate_private_key())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "snapshot")
+        snapshot_hash = write_utxo_snapshot(chain, path)
+
+        validator = validate_snapshot(chain.blocks, read_utxo_snapshot(path, snapshot_hash))
+        assert validator.finished and not validator.failed
+        assert not any(b.is_header_only for b in validator.snapshot_chain.blocks)
+
+        # a block with the header of the original, but different transactions
+        original = chain.blocks[4]
+        tampered = Block(original.prev_block_hash, original.time, original.nonce, original.height,
+                         original.received_time, original.target, original.transactions[:1],
+                         original.merkle_root_hash, original.id)
+        assert tampered.hash == original.hash
+        history = chain.blocks[:4] + [tampered] + chain.blocks[5:]
+        validator = validate_snapshot(history, read_utxo_snapshot(path, snapshot_hash))
+        assert validator.failed and not validator.finished
+        assert validator.validated_height == 3
+
+        # a snapshot whose coins do not match its history
+        snapshot_chain = read_utxo_snapshot(path, snapshot_hash)
+        snapshot_chain.unspent_coins.popitem()
+        validator = validate_snapshot(chain.blocks, snapshot_chain)
+        assert validator.failed and not validator.finished
+        assert validator.validated_height == chain.head.height
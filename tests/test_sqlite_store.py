@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+import pytest
+
+from src.blockchain import Blockchain
+from src.chainbuilder import ChainBuilder
+from src.crypto import Key
+from src.sqlite_store import SqliteStore
+
+
+@pytest.fixture
+def check_store(wait_for):
+    def check(store, chain, key):
+        wait_for(lambda: store.height == chain.head.height)
+        for block in chain.blocks:
+            assert store.block_at(block.height).hash == block.hash
+            assert store.block_by_hash(block.hash).height == block.height
+            for trans in block.transactions:
+                found, found_block = store.transaction(trans.get_hash())
+                assert found.get_hash() == trans.get_hash() and found_block.hash == block.hash
+        assert store.block_at(chain.head.height + 1) is None
+        assert store.balance(key) == sum(c.amount for c in chain.unspent_coins.values()
+                                         if c.get_pubkey == key)
+        assert sorted(store.unspent_coins(key)) == \
+            sorted((coin, c) for (coin, c) in chain.unspent_coins.items() if c.get_pubkey == key)
+    return check
+
+
+def test_sqlite_store(build_chain, check_store, dummy_protocol, wait_for):
+    key = Key.generate_private_key()
+    chain = build_chain(Blockchain(), 6, key)
+    chainbuilder = ChainBuilder(dummy_protocol)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "chain.sqlite")
+        store = SqliteStore(path, chainbuilder)
+        chainbuilder.primary_block_chain = chain
+        store.store()
+        check_store(store, chain, key)
+
+        history = store.address_history(key)
+        assert [(t.get_hash(), sent) for (t, _, sent) in history if sent] == \
+               [(t.get_hash(), True) for b in chain.blocks[2:] for t in b.transactions[1:]]
+        assert len([t for (t, _, sent) in history if not sent]) == \
+               sum(len(b.transactions) for b in chain.blocks[1:])
+
+        orphaned = chain.blocks[4].transactions[1]
+        fork_key = Key.generate_private_key()
+        fork = build_chain(chain.rewind(2), 5, fork_key)
+        chainbuilder.primary_block_chain = fork
+        store.store()
+        check_store(store, fork, key)
+        assert store.transaction(orphaned.get_hash()) is None
+        for block in chain.blocks[3:]:
+            assert store.block_by_hash(block.hash) is None
+
+        assert store.first_payments(0, 0, 10) == [(key.as_bytes(), 1, 0), (fork_key.as_bytes(), 3, 0)]
+        assert store.first_payments(1, 1, 10) == [(fork_key.as_bytes(), 3, 0)]
+        assert store.first_payments(0, 0, 1) == [(key.as_bytes(), 1, 0)]
+
+        store = SqliteStore(path, chainbuilder)
+        assert store.height == fork.head.height
+        check_store(store, fork, key)
+        # the store thread must have opened the database before the directory is removed
+        wait_for(lambda: store._store_chain is None)
@@ -0,0 +1,182 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from src.blockchain import GENESIS_BLOCK
+from src.block import Block
+from src.transaction import Transaction
+from src.wire import ENCODINGS, BINARY_ENCODING, JSON_ENCODING, encode_binary, decode_binary, \
+    frame_message, MessageFramer, compress_message, decompress_message, ZLIB_THRESHOLD, LZMA_THRESHOLD, \
+    MAX_FRAME_SIZE, READ_BUFFER_SIZE
+
+
+def test_binary_roundtrip_values():
+    values = [None, True, False, 0, -1, 2 ** 70, -2 ** 70, 1.5, "", "abc", "ABCD", "abc", "0a1",
+              "00ff", "2017-03-06T15:54:51.123456 UTC", "2017-03-06T15:54:51 UTC",
+              "OP_CHECKSIG 00ff", "a  b", "ümlaut", [], [1, [2, "x"]], {},
+              {"msg_type": "block", "unknown key": {"hash": "00"}}]
+    for val in values:
+        assert decode_binary(encode_binary(val)) == val
+
+
+def test_binary_roundtrip_objects(make_block):
+    block = make_block(5)
+    decoded = decode_binary(encode_binary({"msg_type": "block", "msg_param": block}))["msg_param"]
+    assert isinstance(decoded, Block)
+    assert decoded.hash == block.hash
+    assert decoded.to_json_compatible() == block.to_json_compatible()
+
+    trans = block.transactions[1]
+    decoded = decode_binary(encode_binary(trans))
+    assert isinstance(decoded, Transaction)
+    assert decoded.get_hash() == trans.get_hash()
+
+    decoded = decode_binary(encode_binary(GENESIS_BLOCK))
+    assert decoded.hash == GENESIS_BLOCK.hash
+
+
+def test_encoding_benchmark(make_block):
+    block = make_block(200)
+    msg = {"msg_type": "block", "msg_param": block}
+    rounds = 20
+    results = {}
+    for name in (BINARY_ENCODING, JSON_ENCODING):
+        encode, decode = ENCODINGS[name]
+        start = time.perf_counter()
+        for _ in range(rounds):
+            data = encode(msg)
+        encode_time = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            param = decode(data)["msg_param"]
+            if not isinstance(param, Block):
+                Block.from_json_compatible(param)
+        decode_time = (time.perf_counter() - start) / rounds
+        results[name] = len(data)
+        print("{}: {} bytes, encode {:.2f}ms, decode {:.2f}ms".format(
+            name, len(data), encode_time * 1000, decode_time * 1000))
+
+    assert results[BINARY_ENCODING] < results[JSON_ENCODING] / 2
+
+
+def test_framer_splits_messages():
+    msgs = [b"", b"a", b"x" * 100000, b"hello"] + [bytes([i]) * i for i in range(200)]
+    stream = b"".join(frame_message(m) for m in msgs)
+
+    for chunk_size in (1, 7, 4096, len(stream)):
+        framer = MessageFramer()
+        received = []
+        for pos in range(0, len(stream), chunk_size):
+            chunk = stream[pos:pos + chunk_size]
+            framer.get_buffer(len(chunk))[:len(chunk)] = chunk
+            framer.buffer_updated(len(chunk))
+            received.extend(bytes(m) for m in framer.messages())
+        assert received == msgs
+        assert not framer.has_partial_message
+
+
+@pytest.mark.parametrize("data", [b"1" * 100, b"%d\n" % (MAX_FRAME_SIZE + 1), b"-1\n"])
+def test_framer_rejects_invalid_length(data):
+    framer = MessageFramer()
+    framer.get_buffer()[:len(data)] = data
+    framer.buffer_updated(len(data))
+    with pytest.raises(ValueError):
+        list(framer.messages())
+
+
+def test_framer_hands_over_messages():
+    small = [bytes([i]) * i for i in range(100)]
+    large = b"x" * (2 * READ_BUFFER_SIZE)
+    framer = MessageFramer()
+    taken = []
+    for msgs in (small, [large], small + [large] + small):
+        stream = b"".join(frame_message(m) for m in msgs) + b"5\nab"
+        for pos in range(0, len(stream), READ_BUFFER_SIZE):
+            chunk = stream[pos:pos + READ_BUFFER_SIZE]
+            framer.get_buffer(len(chunk))[:len(chunk)] = chunk
+            framer.buffer_updated(len(chunk))
+            taken.extend(framer.take_messages())
+        framer.get_buffer(3)[:3] = b"cde"
+        framer.buffer_updated(3)
+        taken.extend(framer.take_messages())
+    # the messages taken before stay valid while the framer reads more data
+    assert [bytes(m) for m in taken] == [m for msgs in (small, [large], small + [large] + small)
+                                         for m in msgs + [b"abcde"]]
+    assert not framer.has_partial_message
+
+
+def read_framed(sock, count: int):
+    """ Reads `count` framed messages from `sock` like `PeerConnection.reader_thread`. """
+    framer = MessageFramer()
+    received = 0
+    while received < count:
+        framer.buffer_updated(sock.recv_into(framer.get_buffer()))
+        received += sum(1 for _ in framer.messages())
+
+
+def read_framed_bytewise(sock, count: int):
+    """ Reads `count` framed messages from `sock` with one syscall per length prefix byte. """
+    for _ in range(count):
+        buf = b""
+        while not buf or buf[-1] != ord('\n'):
+            buf += sock.recv(1)
+        msg = bytearray(int(buf))
+        read = 0
+        while read < len(msg):
+            read += sock.recv_into(memoryview(msg)[read:])
+
+
+def test_loopback_throughput():
+    msg = frame_message(encode_binary({"msg_type": "myport", "msg_param": 1234}))
+    count = 20000
+    for reader in (read_framed_bytewise, read_framed):
+        with socket.socket() as server:
+            server.bind(("127.0.0.1", 0))
+            server.listen(1)
+            a = socket.create_connection(server.getsockname())
+            b, _ = server.accept()
+        writer = threading.Thread(target=lambda: a.sendall(msg * count))
+        start = time.perf_counter()
+        writer.start()
+        reader(b, count)
+        elapsed = time.perf_counter() - start
+        writer.join()
+        a.close()
+        b.close()
+        print("{}: {:.0f} messages/s".format(reader.__name__, count / elapsed))
+
+
+def test_compression_roundtrip():
+    small = b"x" * (ZLIB_THRESHOLD - 1)
+    assert compress_message(small, ['zlib', 'lzma']) == (b"\x00", small)
+
+    for size in (ZLIB_THRESHOLD, LZMA_THRESHOLD):
+        data = b"abc" * size
+        for compressions in ([], ['zlib'], ['lzma'], ['zlib', 'lzma']):
+            flag, compressed = compress_message(data, compressions)
+            assert len(compressed) <= len(data)
+            assert bytes(decompress_message(flag + compressed)) == data
+
+    with pytest.raises(ValueError):
+        decompress_message(b"\x07abc")
+
+
+def test_compression_benchmark(make_block):
+    """ Bytes on the wire and CPU time for sending a batch of blocks, as during a sync. """
+    blocks = [make_block(200) for _ in range(10)]
+    for name in (BINARY_ENCODING, JSON_ENCODING):
+        encode = ENCODINGS[name][0]
+        messages = [encode({"msg_type": "block", "msg_param": block}) for block in blocks]
+        for compressions in ([], ['zlib'], ['zlib', 'lzma']):
+            start = time.perf_counter()
+            compressed = [b"".join(compress_message(msg, compressions)) for msg in messages]
+            compress_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for msg in compressed:
+                decompress_message(msg)
+            decompress_time = time.perf_counter() - start
+            print("{} {}: {} bytes, compress {:.1f}ms, decompress {:.1f}ms".format(
+                name, "+".join(compressions) or "uncompressed", sum(len(m) for m in compressed),
+                compress_time * 1000, decompress_time * 1000))